@@ -7,6 +7,7 @@ from aiohttp import web
 import redis
 
 import notification
+from notification import codec
 import notification.tasks
 
 import livemetrics
@@ -26,7 +27,7 @@ async def error_middleware(request, handler):
         raise
     except Exception as exc:
         logging.exception("Exception caught in middleware: [%s]", str(exc))
-        return web.json_response(dict(code=0, message=str(exc)), status=500)
+        return codec.json_response(dict(code=0, message=str(exc)), status=500)
 
 
 # _____________________________________________________________________________
@@ -130,16 +131,16 @@ LM.gauge('subscriptions',gauge_subscription)
 
 
 def s_encode(subscription):
-    return json.dumps(subscription)
+    return codec.dumps(subscription)
 
 def s_decode(subscription):
-    return json.loads(subscription)
+    return codec.loads(subscription)
 
 def t_encode(topic):
-    return json.dumps(topic)
+    return codec.dumps(topic)
 
 def t_decode(topic):
-    return json.loads(topic)
+    return codec.loads(topic)
 
 # _____________________________________________________________________________
 # Subscriber services
@@ -158,21 +159,21 @@ async def subscribe(request):
 
     # Check input parameters
     if protocol != 'http':
-        return web.json_response(dict(code=1, message="Invalid protocol (only http is supported in this implementation)"), status=400)
+        return codec.json_response(dict(code=1, message="Invalid protocol (only http is supported in this implementation)"), status=400)
 
     try:
         countdown,max = [int(x) for x in policy.split(',')]
         if countdown<0:
             raise Exception()
     except:
-        return web.json_response(dict(code=2, message="Invalid policy. Excepting 2 integers, first one must be positive"), status=400)
+        return codec.json_response(dict(code=2, message="Invalid policy. Excepting 2 integers, first one must be positive"), status=400)
 
     # check if already there
     for s_idx in range(R.llen('SUBSCRIPTIONS')):
         s = s_decode(R.lindex('SUBSCRIPTIONS',s_idx))
         if s['topic']==topic and s['address']==address and s['protocol']==protocol:
             LM.mark("subscribe","ALREADY")
-            return web.json_response(s, status=200)
+            return codec.json_response(s, status=200)
 
     # New subscription
     s = dict(uuid=str(uuid.uuid1()),topic=topic, address=address, protocol=protocol, policy=policy,active=False)
@@ -183,7 +184,7 @@ async def subscribe(request):
     notification.tasks.request_confirmation.delay(s['protocol'],s['address'],token,topic,s['uuid'], s['policy'])
     LM.mark("subscribe","OK")
 
-    return web.json_response(s, status=200)
+    return codec.json_response(s, status=200)
 
 # _____________________________________________________________________________
 @routes.get('/v1/subscriptions')
@@ -195,7 +196,7 @@ async def listSubscription(request):
     for s_idx in range(R.llen('SUBSCRIPTIONS')):
         s = s_decode(R.lindex('SUBSCRIPTIONS',s_idx))
         S.append(s)
-    return web.json_response(S, status=200)
+    return codec.json_response(S, status=200)
 
 # _____________________________________________________________________________
 @routes.delete('/v1/subscriptions/{uuid}')
@@ -224,7 +225,7 @@ async def confirm(request):
     try:
         token = json.loads(base64.b64decode(token).decode('UTF-8'))
     except:
-        return web.json_response(dict(code=1, message="Invalid token"), status=400)
+        return codec.json_response(dict(code=1, message="Invalid token"), status=400)
 
     for s_idx in range(R.llen('SUBSCRIPTIONS')):
         s = s_decode(R.lindex('SUBSCRIPTIONS',s_idx))
@@ -234,7 +235,7 @@ async def confirm(request):
                 s['active'] = True
                 R.lset('SUBSCRIPTIONS',s_idx,s_encode(s))
             return web.Response(status=200, body="")
-    return web.json_response(dict(code=2, message="Invalid token"), status=400)
+    return codec.json_response(dict(code=2, message="Invalid token"), status=400)
 
 # _____________________________________________________________________________
 # Publisher services
@@ -252,12 +253,12 @@ async def createTopic(request):
         t = t_decode(R.lindex('TOPICS',t_idx))
         if t['name'] == name:
             LM.mark("createTopic","ALREADY")
-            return web.json_response(t, status=200)
+            return codec.json_response(t, status=200)
     t = dict(uuid=str(uuid.uuid1()), name=name)
     LM.mark("createTopic","OK")
     R.lpush('TOPICS',t_encode(t))
     logging.debug("Topic <%s> created (uuid: %s)",name,t['uuid'])
-    return web.json_response(t, status=200)
+    return codec.json_response(t, status=200)
 
 
 # _____________________________________________________________________________
@@ -269,7 +270,7 @@ async def listTopics(request):
     T = []
     for t_idx in range(R.llen('TOPICS')):
         T.append( t_decode(R.lindex('TOPICS',t_idx)) )
-    return web.json_response(T, status=200)
+    return codec.json_response(T, status=200)
 
 
 # _____________________________________________________________________________
@@ -7,6 +7,7 @@ import aiohttp
 from aiohttp import web
 
 import orchestrator
+from orchestrator import codec
 import orchestrator.tasks
 
 import livemetrics
@@ -35,7 +36,7 @@ async def error_middleware(request, handler):
         raise
     except Exception as exc:
         logging.exception("Exception caught in middleware: [%s]", str(exc))
-        return web.json_response(dict(code=0, message=str(exc)), status=500)
+        return codec.json_response(dict(code=0, message=str(exc)), status=500)
 
 
 # _____________________________________________________________________________
@@ -126,7 +127,7 @@ async def register_topic(app):
 @LM.timer("cr_event", ok_status, "error")
 async def cr_event(request):
     logging.debug('Receiving notification')
-    m = await request.json()
+    m = await codec.read_json(request)
 
     if m['type']=='SubscriptionConfirmation':
         logging.info("Confirming subscription")
@@ -144,7 +145,7 @@ async def cr_event(request):
         logging.debug('Headers: '+str(request.headers))
         logging.debug(str(m))
         if m['subject']=='liveBirth':
-            event = json.loads(m['message'])
+            event = codec.loads(m['message'])
             logging.info("Live birth notification received from [%s] for uin [%s]", event['source'], event['uin'])
             t = orchestrator.tasks.workflow(event['uin'], 'liveBirth')
         else:
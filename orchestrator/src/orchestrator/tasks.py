@@ -3,13 +3,13 @@
 The Celery tasks executed as part of the workflow
 """
 
-import json
 import os
 import asyncio
 import logging
 import io
 import datetime
 
+from orchestrator import codec
 from orchestrator.celery import app
 from orchestrator.clients import pr, cr
 
@@ -42,7 +42,7 @@ def createPerson_PR(self,ctx, url,enrollment_id, transaction_id):
         person = {}
         person['status'] = 'ACTIVE'
         person['physicalStatus'] = 'ALIVE'
-        data = io.BytesIO(json.dumps(person).encode('latin-1'))
+        data = io.BytesIO(codec.dumps(person))
         res = asyncio.run( pr.createPerson(url, transaction_id, ctx['UIN'], data) )
     except Exception as exc:
         logging.exception("error")
@@ -69,7 +69,7 @@ def createIdentity_PR(self,ctx, url,enrollment_id, transaction_id):
             documentData=[]
         )
 
-        data = io.BytesIO(json.dumps(identity).encode('latin-1'))
+        data = io.BytesIO(codec.dumps(identity))
         identity_id = ctx.get('identityId', None)
         if identity_id is None:
             identity_id = asyncio.run( pr.createIdentity(url, transaction_id, ctx['UIN'], data) )
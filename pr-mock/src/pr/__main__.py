@@ -6,6 +6,7 @@ import configargparse
 
 import pr
 import pr.pr
+import pr.codec
 
 # _____________________________________________________________________________
 #
@@ -26,6 +27,8 @@ def main(argv=sys.argv[1:]):
     parser.add_argument("-l", "--loglevel", default='INFO', dest='loglevel', env_var='PR_LOGLEVEL', help="Log level")
     parser.add_argument("-f", "--logfile", default=None, dest='logfile', env_var='PR_LOGFILE', help="Log file")
 
+    parser.add_argument(      "--json-codec", default='orjson', dest='json_codec', choices=['orjson', 'json'], env_var='PR_JSON_CODEC', help="Library used to encode and decode the JSON documents. json (standard library) is used if orjson is not installed")
+
     parser.add_argument("-M", "--max-size", type=int, dest='input_max_size', env_var='INPUT_MAX_SIZE',
                         default=10,
                         help="The buffer maximum size accepted (in MB)")
@@ -67,6 +70,7 @@ def main(argv=sys.argv[1:]):
         logging.getLogger().addHandler(fh)
 
     logging.info('Starting')
+    pr.codec.setup(pr.args.json_codec)
     pr.pr.serve()
 
 
@@ -8,6 +8,7 @@ import aiohttp
 from aiohttp import web
 
 import pr
+from pr import codec
 
 import livemetrics
 import livemetrics.publishers.aiohttp
@@ -35,7 +36,7 @@ async def error_middleware(request, handler):
         raise
     except Exception as exc:
         logging.exception("Exception caught in middleware: [%s]", str(exc))
-        return web.json_response(dict(code=0, message=str(exc)), status=500)
+        return codec.json_response(dict(code=0, message=str(exc)), status=500)
 
 
 # _____________________________________________________________________________
@@ -120,7 +121,7 @@ async def findPersons(request):
     offset = int(request.query.get('offset', 0))
     limit = int(request.query.get('limit', 100))
 
-    data = await request.json()
+    data = await codec.read_json(request)
     logging.info("[%s] - findPersons", transaction_id)
 
     # filter
@@ -150,7 +151,7 @@ async def findPersons(request):
                 elif pred['operator']=='>=':
                     f = v.__ge__
                 else:
-                    return web.json_response({'code':1, 'message': 'Invalid operator'}, status=400)
+                    return codec.json_response({'code':1, 'message': 'Invalid operator'}, status=400)
                 if not f(pred['value']):
                     x = False
                     break
@@ -176,7 +177,7 @@ async def findPersons(request):
 
     ret2 = ret2[offset:offset+limit]
 
-    return web.json_response(ret2, status=200)
+    return codec.json_response(ret2, status=200)
 
 # _____________________________________________________________________________
 @routes.post('/v1/persons/{personId}')
@@ -185,7 +186,7 @@ async def createPerson(request):
     transaction_id = request.query['transactionId']
     person_id = request.match_info['personId']
 
-    data = await request.json()
+    data = await codec.read_json(request)
     logging.info("[%s] - createPerson for personId [%s]", transaction_id, person_id)
     if person_id in PERSONS:
         return web.Response(status=409)
@@ -204,7 +205,7 @@ async def readPerson(transaction_id, person_id):
     data = copy.copy(PERSONS[person_id])
     del data['identities']
     data['personId'] = person_id
-    return web.json_response(data, status=200)
+    return codec.json_response(data, status=200)
 
 # _____________________________________________________________________________
 @routes.put('/v1/persons/{personId}')
@@ -213,7 +214,7 @@ async def updatePerson(request):
     transaction_id = request.query['transactionId']
     person_id = request.match_info['personId']
 
-    data = await request.json()
+    data = await codec.read_json(request)
     logging.info("[%s] - updatePerson for personId [%s]", transaction_id, person_id)
     if person_id not in PERSONS:
         return web.Response(status=404)
@@ -248,7 +249,7 @@ async def readIdentities(request):
     if person_id not in PERSONS:
         return web.Response(status=404)
 
-    return web.json_response(PERSONS[person_id]['identities'], status=200)
+    return codec.json_response(PERSONS[person_id]['identities'], status=200)
 
 # _____________________________________________________________________________
 @routes.post('/v1/persons/{personId}/identities')
@@ -258,7 +259,7 @@ async def createIdentity(request):
     person_id = request.match_info['personId']
     identity_id = uuid.uuid4().hex
 
-    data = await request.json()
+    data = await codec.read_json(request)
     logging.info("[%s] - createIdentity for personId [%s]", transaction_id, person_id)
     p = PERSONS.get(person_id, None)
     if p is None:
@@ -267,7 +268,7 @@ async def createIdentity(request):
     p['identities'].append (data)
     p['identities'][-1]['identityId'] = identity_id
 
-    return web.json_response({'identityId': identity_id}, status=200)
+    return codec.json_response({'identityId': identity_id}, status=200)
 
 # _____________________________________________________________________________
 @routes.post('/v1/persons/{personId}/identities/{identityId}')
@@ -277,7 +278,7 @@ async def createIdentityWithId(request):
     person_id = request.match_info['personId']
     identity_id = request.match_info['identityId']
 
-    data = await request.json()
+    data = await codec.read_json(request)
     logging.info("[%s] - createIdentityWithId for personId [%s]/[%s]", transaction_id, person_id, identity_id)
     p = PERSONS.get(person_id, None)
     if p is None:
@@ -306,7 +307,7 @@ async def readIdentity(request):
 
     for i in p['identities']:
         if i['identityId'] == identity_id:
-            return web.json_response(i, status=200)
+            return codec.json_response(i, status=200)
 
     return web.Response(status=404)
 
@@ -349,7 +350,7 @@ async def readReference(request):
 
     for i in p['identities']:
         if i.get('is_reference', False):
-            return web.json_response(i, status=200)
+            return codec.json_response(i, status=200)
 
     return web.Response(status=404)
 
@@ -378,7 +379,7 @@ async def getPersonWithId(request):
 async def matchPersonAttributes(request):
     uin = request.match_info['uin']
 
-    data = await request.json()
+    data = await codec.read_json(request)
     logging.info("matchPersonAttributes for UIN [%s]", uin)
 
     # check person exists and has an identity
@@ -397,7 +398,7 @@ async def matchPersonAttributes(request):
             ret.append(dict(attributeName=k, errorCode=0))
         elif i['biographicData'][k] != v:
             ret.append(dict(attributeName=k, errorCode=1))
-    return web.json_response(ret, status=200)
+    return codec.json_response(ret, status=200)
 
 
 # _____________________________________________________________________________
@@ -432,7 +433,7 @@ async def queryPersonList(request):
     ret = ret[offset:offset+limit]
 
     if len(names)==0:
-        return web.json_response(ret, status=200)
+        return codec.json_response(ret, status=200)
     
     ret2 = []
     for uin in ret:
@@ -445,7 +446,7 @@ async def queryPersonList(request):
         if 'personId' in names:
             r2['personId'] = uin
         ret2.append(r2)
-    return web.json_response(ret2, status=200)
+    return codec.json_response(ret2, status=200)
 
 
 # _____________________________________________________________________________
@@ -469,5 +470,5 @@ async def readPersonAttributes(uin, names):
     for k in names:
         if k in i['biographicData']:
             ret[k] = i['biographicData'][k]
-    return web.json_response(ret, status=200)
+    return codec.json_response(ret, status=200)
 
@@ -0,0 +1,89 @@
+"""
+Throughput of the JSON codecs on identity documents.
+
+Usage: python benchmarks/codec.py [--count N]
+"""
+import os
+import sys
+import time
+import base64
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import pr.codec
+
+def identity(image_size):
+    image = base64.b64encode(os.urandom(image_size)).decode('ascii')
+    return {
+        "identityId": "001",
+        "status": "VALID",
+        "identityType": "CIVIL",
+        "galleries": ["ALL", "G1"],
+        "clientData": base64.b64encode(os.urandom(256)).decode('ascii'),
+        "biographicData": {
+            "firstName": "John",
+            "lastName": "Doo",
+            "dateOfBirth": "1985-01-01",
+            "nationality": "FRA",
+            "gender": "M",
+            "height": 1.82,
+            "eyesColor": "BLUE",
+        },
+        "contextualData": {
+            "enrollmentDate": "2019-01-01",
+            "enrollmentOperator": "OPE",
+        },
+        "biometricData": [
+            {
+                "biometricType": "FINGER",
+                "biometricSubType": finger,
+                "image": image,
+                "captureDate": "2019-05-21T12:00:00Z",
+                "mimeType": "image/png",
+                "quality": 80,
+            } for finger in ['RIGHT_INDEX', 'RIGHT_THUMB', 'LEFT_INDEX', 'LEFT_THUMB']
+        ],
+        "documentData": [
+            {
+                "documentType": "FORM",
+                "parts": [{"pages": [1], "data": image, "mimeType": "image/png"}]
+            }
+        ]
+    }
+
+def bench(name, documents):
+    dumps, loads = pr.codec.CODECS[name]
+    encoded = [dumps(d) for d in documents]
+    size = sum(len(e) for e in encoded)
+
+    start = time.perf_counter()
+    for d in documents:
+        dumps(d)
+    encode = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for e in encoded:
+        loads(e)
+    decode = time.perf_counter() - start
+
+    print("{:8} {:>10} {:>12.0f} {:>12.1f} {:>12.0f} {:>12.1f}".format(
+        name, len(documents),
+        len(documents)/encode, size/encode/1e6,
+        len(documents)/decode, size/decode/1e6))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=200, help="Number of documents")
+    args = parser.parse_args()
+
+    for label, image_size in [('small identities (no image)', 0), ('identities with 4 fingers + 1 page of 50KB', 50*1024)]:
+        documents = [identity(image_size) for i in range(args.count)]
+        print(label)
+        print("{:8} {:>10} {:>12} {:>12} {:>12} {:>12}".format('codec', 'documents', 'encode/s', 'encode MB/s', 'decode/s', 'decode MB/s'))
+        for name in pr.codec.CODECS:
+            bench(name, documents)
+        print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Throughput of the identity serializers: marshmallow schema and compiled
+serializer, as used by readIdentities (dump) and createIdentity (load).
+
+Usage: python benchmarks/serialize.py [--count N]
+"""
+import os
+import sys
+import time
+import copy
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import pr.__main__
+import pr.model
+
+IDENTITY = {
+    "status": "CLAIMED",
+    "identityType": "TEST",
+    "galleries": ["G1", "G2"],
+    "clientData": "Q0xJRU5U",
+    "biographicData": {
+        "firstName": "John",
+        "lastName": "Doo",
+        "dateOfBirth": "1985-01-01",
+        "gender": "M",
+        "nationality": "FRA",
+        "fBoolean": False,
+        "fInteger64": 12345678901,
+        "fNumberDouble": -2.25,
+    },
+    "contextualData": {
+        "operator": "OPE",
+        "operationDateTime": "2020-03-01T12:30:45.123000+00:00",
+        "device": {"name": "D1", "brand": "B"},
+    },
+    "biometricData": [
+        {
+            "biometricType": "FINGER",
+            "biometricSubType": finger,
+            "image": "SU1BR0U=",
+            "width": 500,
+            "height": 500,
+            "mimeType": "image/png",
+            "missing": [{"biometricSubType": "RIGHT_THUMB", "presence": "BANDAGED"}],
+        } for finger in ['RIGHT_INDEX', 'RIGHT_THUMB', 'LEFT_INDEX', 'LEFT_THUMB']
+    ],
+    "documentData": [
+        {
+            "documentType": "FORM",
+            "parts": [{"pages": [1, 2], "data": "UEFSVA==", "mimeType": "image/png"}],
+        },
+    ],
+}
+
+def bench(label, function, documents):
+    start = time.perf_counter()
+    for d in documents:
+        function(d)
+    duration = time.perf_counter() - start
+    print("{:28} {:>10} {:>12.0f}".format(label, len(documents), len(documents)/duration))
+    return duration
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=2000, help="Number of identities")
+    args = parser.parse_args()
+
+    pr.__main__.main(['--do-not-start', '--custo-filename', os.path.join(os.path.dirname(__file__), '..', 'tests', 'custo.yaml')])
+    logging.disable(logging.WARNING)
+    # the schemas are built from the custo
+    from pr import serialize
+
+    schema = serialize.IdentitySchema()
+    data = [copy.deepcopy(IDENTITY) for i in range(args.count)]
+    # the identities are dumped as read from the database
+    import sqlalchemy as sa
+    from sqlalchemy.orm import Session
+    engine = sa.create_engine('sqlite://')
+    pr.model.Base.metadata.create_all(engine)
+    with Session(engine) as session, session.begin():
+        for i, d in enumerate(data):
+            ident = serialize.IDENTITY.load(copy.deepcopy(d))
+            ident.identityId = str(i)
+            ident.position = 0
+            ident.personId = 'BENCH'
+            session.add(ident)
+    session = Session(engine)
+    identities = list(session.execute(sa.select(pr.model.Identity).options(*pr.model.IDENTITY_FULL)).scalars())
+
+    print("{:28} {:>10} {:>12}".format('serializer', 'identities', 'identities/s'))
+    d1 = bench('dump marshmallow', schema.dump, identities)
+    d2 = bench('dump compiled', serialize.IDENTITY.dump, identities)
+    print("speedup x{:.1f}".format(d1/d2))
+    d1 = bench('load marshmallow', lambda d: schema.load(copy.deepcopy(d), transient=True), data)
+    d2 = bench('load compiled', lambda d: serialize.IDENTITY.load(copy.deepcopy(d)), data)
+    print("speedup x{:.1f}".format(d1/d2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Micro benchmark of the JSON validation of large identities.
+
+Compare the validation with a validator built for each request (as it was done
+before the validators were cached) with the cached validators of pr.server.
+
+Usage::
+
+    python benchmarks/validate.py [count]
+"""
+
+import os
+import sys
+import time
+import base64
+
+import jsonschema
+import referencing
+import referencing.jsonschema
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import pr
+import pr.__main__
+
+pr.__main__.main(['--do-not-start',
+                '--loglevel', 'WARNING',
+                '--custo-filename', os.path.join(os.path.dirname(__file__), '..', 'tests', 'custo.yaml')])
+
+import pr.server
+
+FINGERS = ['RIGHT_THUMB', 'RIGHT_INDEX', 'RIGHT_MIDDLE', 'RIGHT_RING', 'RIGHT_LITTLE',
+           'LEFT_THUMB', 'LEFT_INDEX', 'LEFT_MIDDLE', 'LEFT_RING', 'LEFT_LITTLE']
+
+def large_identity():
+    image = base64.b64encode(os.urandom(200*1024)).decode('ascii')
+    return {
+        "status": "CLAIMED",
+        "identityType": "BENCH",
+        "galleries": ["BENCH"],
+        "biographicData": {
+            "firstName": "John",
+            "lastName": "Doo",
+            "dateOfBirth": "1985-11-30",
+            "gender": "M",
+            "nationality": "FRA"
+        },
+        "contextualData": {
+            "operator": "OPE",
+            "operationDateTime": "2019-05-21T12:00:00+02:00",
+            "device": {"name": "DEVICE", "brand": "BRAND"}
+        },
+        "biometricData": [
+            {
+                "biometricType": "FINGER",
+                "biometricSubType": finger,
+                "image": image,
+                "mimeType": "image/png",
+                "width": 500,
+                "height": 500,
+                "captureDate": "2019-05-21T12:00:00+02:00",
+                "missing": []
+            } for finger in FINGERS
+        ] + [
+            {
+                "biometricType": "FACE",
+                "biometricSubType": "PORTRAIT",
+                "image": image,
+                "mimeType": "image/jpeg"
+            }
+        ],
+        "documentData": [
+            {
+                "documentType": "FORM",
+                "parts": [
+                    {"pages": [i], "data": image, "mimeType": "application/pdf"} for i in range(1, 6)
+                ]
+            }
+        ]
+    }
+
+API = None
+REGISTRY = None
+def validate_uncached(data, schema_name, with_required=True):
+    # reproduce the validation done before the validators were cached
+    global API
+    global REGISTRY
+    if not API:
+        API = pr.server.load_api()
+        REGISTRY = referencing.Registry().with_resource(
+            uri='',
+            resource=referencing.Resource.from_contents(API, default_specification=referencing.jsonschema.DRAFT7)
+        )
+        REGISTRY = REGISTRY.crawl()
+    v = jsonschema.Draft7Validator(schema=API['components']['schemas'][schema_name], registry=REGISTRY, _resolver=REGISTRY.resolver())
+    if with_required:
+        msg = "\n".join([error.message for error in v.iter_errors(instance=data)])
+    else:
+        msg = "\n".join([error.message for error in v.iter_errors(instance=data) if error.message.find('is a required property')<0 and error.message.find('None is not of type')<0])
+    return msg or None
+
+def bench(name, func, data, count, **kw):
+    assert func(data, 'Identity', **kw) is None
+    t0 = time.perf_counter()
+    for i in range(count):
+        func(data, 'Identity', **kw)
+    t1 = time.perf_counter()
+    rate = count/(t1-t0)
+    print("%-30s %10.1f req/s" % (name, rate))
+    return rate
+
+def main(count=200):
+    pr.server.setup_validators()
+    data = large_identity()
+    before = bench('uncached', validate_uncached, data, count)
+    after = bench('cached', pr.server.validate_json, data, count)
+    print("%-30s %10.1fx" % ('speedup', after/before))
+    before = bench('uncached (partial)', validate_uncached, data, count, with_required=False)
+    after = bench('cached (partial)', pr.server.validate_json, data, count, with_required=False)
+    print("%-30s %10.1fx" % ('speedup', after/before))
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:2]])
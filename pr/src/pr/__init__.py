@@ -5,4 +5,8 @@ __version__ = "0.1"
 engine = None
 # async engine
 aengine = None
+# async engines of the read replicas
+areplicas = []
+# store of the large buffers, when they are not kept in the database
+blob_store = None
 args = None
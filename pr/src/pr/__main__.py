@@ -8,6 +8,8 @@ import configargparse
 
 import pr
 import pr.model
+import pr.blob
+import pr.codec
 import pr.server
 
 # _____________________________________________________________________________
@@ -37,6 +39,7 @@ def main(argv=sys.argv[1:]):
                         help="Sanity check of the configuration - NOT FOR PRODUCTION")
     parser.add_argument("-i", "--ip", default='0.0.0.0', dest='ip', env_var='PR_IP', help="Listen IP")
     parser.add_argument("-p", "--port", default=8080, dest='port', type=int, env_var='PR_PORT', help="Port number")
+    parser.add_argument(      "--workers", default=1, dest='workers', type=int, env_var='PR_WORKERS', help="Number of worker processes sharing the listening port. The metrics of the workers are aggregated on the monitoring port, when defined")
     parser.add_argument(      "--monitoring-port", default=0, dest='monitoring_port', type=int, env_var='PR_MONITORING_PORT', help="Port number used for monitoring services. Default is to used the same port as for business services. When defined, monitoring services are exposed through HTTP.")
     parser.add_argument("-l", "--loglevel", default='INFO', dest='loglevel', env_var='PR_LOGLEVEL', help="Log level")
     parser.add_argument("-f", "--logfile", default=None, dest='logfile', env_var='PR_LOGFILE', help="Log file")
@@ -44,9 +47,27 @@ def main(argv=sys.argv[1:]):
     parser.add_argument(      "--custo-filename", default="custo.yaml", dest='custo_filename', env_var='PR_CUSTO_FILENAME', help="File containing the description of the custo (YAML)")
     parser.add_argument(      "--api-file", default=os.path.join(os.path.dirname(__file__), 'pr.yaml'), dest='api_file', env_var='PR_API_FILE', help="OpenAPI file for this server (YAML)")
     parser.add_argument(      "--database-url", default="sqlite:///file:testdb?mode=memory&cache=shared&uri=true", dest='database_url', env_var='PR_DATABASE_URL', help="String to connect to the database")
+    parser.add_argument(      "--database-replica-url", default=[], dest='database_replica_url', action='append', env_var='PR_DATABASE_REPLICA_URL', help="String to connect to a read replica of the database. Can be repeated. The read-only services are load-balanced on the replicas")
+    parser.add_argument(      "--replica-check-interval", default=5., dest='replica_check_interval', type=float, env_var='PR_REPLICA_CHECK_INTERVAL', help="Interval (in seconds) between two checks of the health and of the position of the read replicas")
     parser.add_argument(      "--dont-create-schema", default=False, action='store_true', dest='dont_create_schema', help="Default is to create the schema in the database when connecting. Use this flag to disable this behavior")
+    parser.add_argument(      "--db-pool-size", default=5, dest='db_pool_size', type=int, env_var='PR_DB_POOL_SIZE', help="Number of connections kept in the pool of each database engine")
+    parser.add_argument(      "--db-pool-max-overflow", default=10, dest='db_pool_max_overflow', type=int, env_var='PR_DB_POOL_MAX_OVERFLOW', help="Number of connections that can be opened beyond the pool size")
+    parser.add_argument(      "--db-pool-timeout", default=30., dest='db_pool_timeout', type=float, env_var='PR_DB_POOL_TIMEOUT', help="Number of seconds to wait for a connection before giving up")
+    parser.add_argument(      "--db-pool-recycle", default=-1, dest='db_pool_recycle', type=int, env_var='PR_DB_POOL_RECYCLE', help="Number of seconds after which a connection is recycled. -1 means no recycle")
+    parser.add_argument(      "--db-pool-pre-ping", default=False, action='store_true', dest='db_pool_pre_ping', env_var='PR_DB_POOL_PRE_PING', help="Test the connections when they are checked out of the pool")
     parser.add_argument(      "--dump-schema", default=False, action='store_true', dest='dump_schema', help="Used to dump the DDL of the database schema")
 
+    parser.add_argument(      "--blob-store", default=None, dest='blob_store', env_var='PR_BLOB_STORE', help="URL of the store of the biometric images & templates and of the document parts, e.g. file:///var/lib/pr/blobs. Default is to keep them in the database")
+    parser.add_argument(      "--bulk-batch-size", default=1000, dest='bulk_batch_size', type=int, env_var='PR_BULK_BATCH_SIZE', help="Number of records inserted in one transaction by the bulk service")
+    parser.add_argument(      "--counters-refresh", default=300, dest='counters_refresh', type=int, env_var='PR_COUNTERS_REFRESH', help="Interval (in seconds) between two reconciliations of the counters published as gauges with the database. Use 0 to disable")
+    parser.add_argument(      "--reference-cache-size", default=10000, dest='reference_cache_size', type=int, env_var='PR_REFERENCE_CACHE_SIZE', help="Number of reference identities kept in memory for the data access services. Use 0 to disable the cache")
+    parser.add_argument(      "--batch-max-size", default=1000, dest='batch_max_size', type=int, env_var='PR_BATCH_MAX_SIZE', help="Maximum number of items in a request of the batch data access service")
+    parser.add_argument(      "--warmup-connections", default=5, dest='warmup_connections', type=int, env_var='PR_WARMUP_CONNECTIONS', help="Number of connections of each database pool opened when the server starts, before it is ready. Limited to --db-pool-size")
+    parser.add_argument(      "--warmup-reference-cache", default=0, dest='warmup_reference_cache', type=int, env_var='PR_WARMUP_REFERENCE_CACHE', help="Number of reference identities loaded in the cache when the server starts, before it is ready")
+    parser.add_argument(      "--fast-request-time", default=50, dest='fast_request_time', type=int, env_var='PR_FAST_REQUEST_TIME', help="Duration (in milliseconds) of a fast request. The time between the startup and the first fast request is published as the time_to_first_fast_request gauge")
+
+    parser.add_argument(      "--json-codec", default='orjson', dest='json_codec', choices=['orjson', 'json'], env_var='PR_JSON_CODEC', help="Library used to encode and decode the JSON documents. json (standard library) is used if orjson is not installed")
+
     parser.add_argument("-M", "--max-size", type=int, dest='input_max_size', env_var='INPUT_MAX_SIZE',
                         default=10,
                         help="The buffer maximum size accepted (in MB)")
@@ -95,6 +116,8 @@ def main(argv=sys.argv[1:]):
     if pr.args.dump_schema:
         pr.model.dump()
         return
+    pr.codec.setup(pr.args.json_codec)
+    pr.blob.setup()
     pr.model.setup()
     pr.server.serve()
 
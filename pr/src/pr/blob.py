@@ -0,0 +1,86 @@
+import os
+import hashlib
+import logging
+import tempfile
+import urllib.parse
+
+import pr
+
+#______________________________________________________________________________
+# Blob stores
+# The large buffers (biometric images & templates, document parts) can be kept
+# out of the database. They are identified by the SHA-256 of their content, so
+# identical buffers are stored once.
+#______________________________________________________________________________
+class BlobStore:
+    """
+    Interface of the blob stores.
+    """
+    def put(self, data):
+        """Store the buffer and return its key (SHA-256, hexadecimal)"""
+        raise NotImplementedError()
+
+    def get(self, key):
+        """Return the buffer identified by key"""
+        raise NotImplementedError()
+
+    def path(self, key):
+        """Return the path of the file containing the buffer, or None if the store is not a local file system"""
+        return None
+
+    @staticmethod
+    def key(data):
+        return hashlib.sha256(data).hexdigest()
+
+
+class FileBlobStore(BlobStore):
+    """
+    Store the buffers in a local directory, sharded by the first bytes of the
+    hash: <root>/ab/cd/abcd....
+    """
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key[0:2], key[2:4], key)
+
+    def put(self, data):
+        key = self.key(data)
+        path = self.path(key)
+        if os.path.exists(path):
+            # already stored
+            return key
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write in a temporary file first, so that a partial file is never visible
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return key
+
+    def get(self, key):
+        with open(self.path(key), 'rb') as f:
+            return f.read()
+
+
+STORES = {
+    'file': lambda url: FileBlobStore(urllib.parse.unquote(url.path)),
+}
+
+def get_store(url):
+    u = urllib.parse.urlparse(url)
+    if u.scheme not in STORES:
+        raise Exception("Unsupported blob store [{}]".format(url))
+    return STORES[u.scheme](u)
+
+def setup():
+    if pr.args and pr.args.blob_store:
+        pr.blob_store = get_store(pr.args.blob_store)
+        logging.info("Blob store URL [%s]", pr.args.blob_store)
+    else:
+        pr.blob_store = None
@@ -0,0 +1,117 @@
+import collections
+import mmap
+import zlib
+import multiprocessing
+
+#______________________________________________________________________________
+# In-process cache
+#______________________________________________________________________________
+class LRUCache:
+    """
+    A size-bounded cache, evicting the least recently used entries.
+
+    Each invalidation increments a generation counter. A value read from the
+    database can be stored with the generation read before accessing the
+    database: it is ignored if an invalidation occurred in between.
+    A size of 0 disables the cache.
+
+    The caches of several processes can share their invalidations (see
+    SharedVersions).
+    """
+    def __init__(self, size=0):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.shared = None
+        self._generation = 0
+        # {key: (value, shared version of the key)}
+        self._data = collections.OrderedDict()
+
+    @property
+    def generation(self):
+        if self.shared is None:
+            return self._generation
+        return self._generation + self.shared.generation
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        if key in self._data:
+            value, version = self._data[key]
+            if self.shared is None or version == self.shared.version(key):
+                self.hits += 1
+                self._data.move_to_end(key)
+                return value
+            # invalidated by another process
+            del self._data[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value, generation=None):
+        if self.size <= 0:
+            return
+        if generation is not None and generation != self.generation:
+            return
+        self._data[key] = (value, self.shared.version(key) if self.shared is not None else None)
+        self._data.move_to_end(key)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, *keys):
+        self._generation += 1
+        if self.shared is not None:
+            self.shared.invalidate(*keys)
+        for key in keys:
+            self._data.pop(key, None)
+
+    def clear(self):
+        self._generation += 1
+        self._data.clear()
+
+    @property
+    def hit_rate(self):
+        if self.hits + self.misses == 0:
+            return 0.
+        return self.hits / (self.hits + self.misses)
+
+
+#______________________________________________________________________________
+# Invalidations shared by processes
+#______________________________________________________________________________
+class SharedVersions:
+    """
+    Versions of the keys of the caches of several processes, in a shared
+    memory created before the processes are forked.
+
+    The keys are hashed to a fixed number of slots: the version of a slot is
+    incremented when one of its keys is invalidated, and a cached value is
+    valid while the version of its slot is unchanged. The global generation is
+    incremented before the slots, so that a value read from the database
+    during an invalidation is not stored (see LRUCache.put).
+    """
+    def __init__(self, nb_slots=65536):
+        self.nb_slots = nb_slots
+        self._lock = multiprocessing.Lock()
+        # anonymous mapping: shared with the forked processes
+        self._memory = mmap.mmap(-1, 8 * (nb_slots + 1))
+        # the first value is the global generation
+        self._values = memoryview(self._memory).cast('q')
+
+    def _slot(self, key):
+        return 1 + zlib.crc32(str(key).encode()) % self.nb_slots
+
+    @property
+    def generation(self):
+        return self._values[0]
+
+    def version(self, key):
+        return self._values[self._slot(key)]
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._values[0] += 1
+            for key in keys:
+                self._values[self._slot(key)] += 1
@@ -1,16 +1,20 @@
 # https://www.sqlalchemy.org/
 
 import io
+import time
 import logging
-import json
 from typing import Optional
 
 import yaml
 
 import pr
+import pr.blob
+import pr.codec
+import pr.phonetic
 
 import sqlalchemy as sa
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
+from sqlalchemy.orm import selectinload, raiseload
 from sqlalchemy.ext.associationproxy import association_proxy, AssociationProxy
 from sqlalchemy.ext.orderinglist import ordering_list
 from sqlalchemy.ext.asyncio import AsyncAttrs
@@ -23,6 +27,20 @@ from sqlalchemy.types import TypeDecorator, VARCHAR
 #______________________________________________________________________________
 # The persistent schema
 #______________________________________________________________________________
+
+# Versions
+# Person and Identity have a version counter (version_id_col), incremented by
+# each UPDATE of the row and checked by the ORM: the UPDATE of a row changed
+# concurrently raises StaleDataError. The counters start at the creation time
+# (in ms), so that a re-created person does not reuse the versions of the
+# deleted one. The services changing the rows with UPDATE statements must also
+# increment the versions.
+def _initial_version():
+    return int(time.time()*1000)
+
+def next_version(version):
+    return version + 1 if version else _initial_version()
+
 class Base(AsyncAttrs,DeclarativeBase):
     pass
 
@@ -30,31 +48,35 @@ class Person(Base):
     __tablename__ = 'PERSON'
 
     personId: Mapped[str] = mapped_column(sa.String(100), primary_key=True)
+    version: Mapped[int] = mapped_column(sa.BigInteger, default=_initial_version)
     status: Mapped[str] = mapped_column(sa.Enum(*['ACTIVE','INACTIVE'], name='person_status_enum'), default='ACTIVE')
     physicalStatus: Mapped[str] = mapped_column(sa.Enum(*['ALIVE','DEAD'], name='person_physical_status_enum'), default='ALIVE')
 
     identities: Mapped[list["Identity"]] = relationship(
             back_populates="person", cascade="all, delete-orphan", lazy='select',
+            foreign_keys="Identity.personId",
             order_by="Identity.position",
             collection_class=ordering_list("position"))
 
+    # the reference identity, kept in sync with Identity.isReference (see _sync_reference)
+    referenceIdentityId: Mapped[Optional[int]] = mapped_column(
+            sa.ForeignKey("IDENTITY.id", use_alter=True, ondelete='SET NULL', name='fk_PERSON_referenceIdentityId'),
+            index=True)
+    reference: Mapped[Optional["Identity"]] = relationship(foreign_keys=[referenceIdentityId], post_update=True)
+
+    __mapper_args__ = {'version_id_col': version, 'version_id_generator': next_version}
+
     # https://docs.sqlalchemy.org/en/20/orm/queryguide/select.html#writing-select-statements-for-orm-mapped-classes
     @staticmethod
-    def find_by_id(session, personId):
-        res = session.scalars(select(Person).where(Person.personId==personId))
+    def find_by_id(session, personId, options=()):
+        res = session.scalars(select(Person).where(Person.personId==personId).options(*options))
         return list(res)
 
     @staticmethod
-    async def afind_by_id(session, personId):
-        res = await session.execute(select(Person).where(Person.personId==personId))
+    async def afind_by_id(session, personId, options=()):
+        res = await session.execute(select(Person).where(Person.personId==personId).options(*options))
         return list(res.scalars())
 
-    @property
-    def reference(self):
-        ref = [x for x in self.identities if x.isReference]
-        if len(ref)==1:
-            return ref[0]
-
 class Missing(Base):
     __tablename__ = 'BIOMETRIC_DATA_MISSING'
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
@@ -73,6 +95,8 @@ class BiometricData(Base):
     instance: Mapped[Optional[str]] = mapped_column(sa.String(100))
     identityId: Mapped[Optional[str]] = mapped_column(sa.String(100))
     image: Mapped[Optional[bytes]] = mapped_column(sa.LargeBinary)
+    imageHash: Mapped[Optional[str]] = mapped_column(sa.String(64))
+    imageSize: Mapped[Optional[int]]
     imageRef: Mapped[Optional[str]] = mapped_column(sa.String(255))
     captureDate: Mapped[Optional[str]] = mapped_column(sa.DateTime(timezone=True))
     captureDevice: Mapped[Optional[str]] = mapped_column(sa.String(100))
@@ -83,10 +107,12 @@ class BiometricData(Base):
     mimeType: Mapped[Optional[str]] = mapped_column(sa.String(100))
     resolution: Mapped[Optional[int]]
     compression: Mapped[Optional[str]] = mapped_column(sa.Enum(*['NONE', 'WSQ', 'JPEG', 'JPEG2000', 'PNG'], name='biometricdata_compression_type_enum'))
-    missing: Mapped[list[Missing]] = relationship(cascade="all, delete-orphan", lazy='immediate')
+    missing: Mapped[list[Missing]] = relationship(cascade="all, delete-orphan", lazy='selectin')
     bio_metadata: Mapped[Optional[str]] = mapped_column(sa.String(1024))    # 'metadata' will conflict with sqlAlchemy. Mapping is defined in serialize.py
     comment: Mapped[Optional[str]] = mapped_column(sa.String(1024))
     template: Mapped[Optional[bytes]] = mapped_column(sa.LargeBinary)
+    templateHash: Mapped[Optional[str]] = mapped_column(sa.String(64))
+    templateSize: Mapped[Optional[int]]
     templateRef: Mapped[Optional[str]] = mapped_column(sa.String(255))
     templateFormat: Mapped[Optional[str]] = mapped_column(sa.String(100))
     quality: Mapped[Optional[int]]
@@ -94,16 +120,19 @@ class BiometricData(Base):
     algorithm: Mapped[Optional[str]] = mapped_column(sa.String(100))
     vendor: Mapped[Optional[str]] = mapped_column(sa.String(100))
 
+    # buffers moved to the blob store: (buffer, hash, size)
+    __blobs__ = [('image', 'imageHash', 'imageSize'), ('template', 'templateHash', 'templateSize')]
+
 class IntList(TypeDecorator):
     impl = VARCHAR
     def process_bind_param(self, value, dialect):
         if value is not None:
-            value = json.dumps(value)
+            value = pr.codec.dumps(value).decode('utf-8')
         return value
 
     def process_result_value(self, value, dialect):
         if value is not None:
-            value = json.loads(value)
+            value = pr.codec.loads(value)
         return value
     
 class DocumentPart(Base):
@@ -114,6 +143,8 @@ class DocumentPart(Base):
     # pages: Mapped[Optional[str]] = mapped_column(sa.JSON())
     pages: Mapped[Optional[list[int]]] = mapped_column(MutableList.as_mutable(IntList))
     data: Mapped[Optional[bytes]] = mapped_column(sa.LargeBinary)
+    dataHash: Mapped[Optional[str]] = mapped_column(sa.String(64))
+    dataSize: Mapped[Optional[int]]
     dataRef: Mapped[Optional[str]] = mapped_column(sa.String(255))
     width: Mapped[Optional[int]]
     height: Mapped[Optional[int]]
@@ -121,6 +152,9 @@ class DocumentPart(Base):
     captureDate: Mapped[Optional[str]] = mapped_column(sa.DateTime(timezone=True))
     captureDevice: Mapped[Optional[str]] = mapped_column(sa.String(100))
 
+    # buffers moved to the blob store: (buffer, hash, size)
+    __blobs__ = [('data', 'dataHash', 'dataSize')]
+
 class DocumentData(Base):
     __tablename__ = 'DOCUMENT_DATA'
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
@@ -130,7 +164,7 @@ class DocumentData(Base):
     documentType: Mapped[str] = mapped_column(sa.Enum(*['ID_CARD', 'PASSPORT', 'INVOICE', 'BIRTH_CERTIFICATE', 'FORM', 'OTHER'], name='documentdata_document_type_enum'))
     documentTypeOther: Mapped[Optional[str]] = mapped_column(sa.String(100))
     instance: Mapped[Optional[str]] = mapped_column(sa.String(100))
-    parts: Mapped[list[DocumentPart]] = relationship(cascade="all, delete-orphan", lazy='immediate')
+    parts: Mapped[list[DocumentPart]] = relationship(cascade="all, delete-orphan", lazy='selectin')
 
 
 # See https://docs.sqlalchemy.org/en/20/orm/extensions/associationproxy.html#module-sqlalchemy.ext.associationproxy
@@ -157,23 +191,28 @@ class Gallery(Base):
         return list(res.scalars())
 
     @staticmethod
-    def get_identities(session, galleryId, offset=None, limit=None):
+    def select_identities(galleryId, offset=None, limit=None, after=None):
+        # identities are sorted by (personId, id). 'after' is the key of the last identity of
+        # the previous page and is used instead of the offset (keyset pagination)
         sel = select(Identity).where(Gallery.galleryId==galleryId, Gallery.identity_id==Identity.id)
+        sel = sel.order_by(Identity.personId, Identity.id)
+        if after:
+            sel = sel.where(sa.tuple_(Identity.personId, Identity.id) > tuple(after))
+        elif offset:
+            sel = sel.offset(offset)
         if limit:
             sel = sel.limit(limit)
-        if offset:
-            sel = sel.offset(offset)
+        return sel
 
+    @staticmethod
+    def get_identities(session, galleryId, offset=None, limit=None, after=None):
+        sel = Gallery.select_identities(galleryId, offset, limit, after).options(*IDENTITY_ONLY)
         res = session.scalars(sel)
         return list(res)
 
     @staticmethod
-    async def aget_identities(session, galleryId, offset=None, limit=None):
-        sel = select(Identity).where(Gallery.galleryId==galleryId, Gallery.identity_id==Identity.id)
-        if limit:
-            sel = sel.limit(limit)
-        if offset:
-            sel = sel.offset(offset)
+    async def aget_identities(session, galleryId, offset=None, limit=None, after=None):
+        sel = Gallery.select_identities(galleryId, offset, limit, after).options(*IDENTITY_ONLY)
         res = await session.execute(sel)
         return list(res.scalars())
 
@@ -181,26 +220,31 @@ class Identity(Base):
     __tablename__ = 'IDENTITY'
     __table_args__ = (
         sa.UniqueConstraint('personId','identityId'),
+        # used to sort and paginate the identities
+        sa.Index('ix_IDENTITY_personId_id', 'personId', 'id'),
     )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    version: Mapped[int] = mapped_column(sa.BigInteger, default=_initial_version)
     isReference: Mapped[bool] = mapped_column(sa.Boolean, default=False)
     position: Mapped[int]
     personId: Mapped[str] = mapped_column(sa.ForeignKey("PERSON.personId"))
-    person: Mapped["Person"] = relationship(back_populates="identities")
+    person: Mapped["Person"] = relationship(back_populates="identities", foreign_keys=[personId])
 
     identityId: Mapped[str] = mapped_column(sa.String(100))
     identityType: Mapped[str] = mapped_column(sa.String(100), default='')
     status: Mapped[str] = mapped_column(sa.Enum(*['CLAIMED', 'VALID', 'INVALID', 'REVOKED'], name='identity_status_enum'), default='CLAIMED')
-    _galleries: Mapped[list[Gallery]] = relationship(back_populates="identity", cascade="all, delete-orphan", lazy='immediate')
+    _galleries: Mapped[list[Gallery]] = relationship(back_populates="identity", cascade="all, delete-orphan", lazy='selectin')
     galleries: AssociationProxy[list[str]] = association_proxy(
         "_galleries", "galleryId"
     )
     clientData: Mapped[Optional[bytes]] = mapped_column(sa.LargeBinary)
     biometricData: Mapped[list["BiometricData"]] = relationship(
-            cascade="all, delete-orphan", lazy='immediate')
+            cascade="all, delete-orphan", lazy='selectin')
     documentData: Mapped[list["DocumentData"]] = relationship(
-            cascade="all, delete-orphan", lazy='immediate')
+            cascade="all, delete-orphan", lazy='selectin')
+
+    __mapper_args__ = {'version_id_col': version, 'version_id_generator': next_version}
 
 
     @staticmethod
@@ -208,10 +252,225 @@ class Identity(Base):
         res = session.scalars(select(Identity).where(Identity.identityId==identityId))
         return list(res)
 
+#______________________________________________________________________________
+# Blobs
+# When a blob store is configured, the buffers are moved to the store when the
+# rows are written, and only their hash and size are kept in the database.
+# Note: the buffers are not removed from the store when the rows are deleted
+# (a buffer can be shared by several rows)
+#______________________________________________________________________________
+def _store_blobs(mapper, connection, target):
+    if not pr.blob_store:
+        return
+    state = sa.inspect(target)
+    for name, hash_name, size_name in target.__blobs__:
+        if not state.attrs[name].history.has_changes():
+            continue
+        value = getattr(target, name)
+        if value is None:
+            setattr(target, hash_name, None)
+            setattr(target, size_name, None)
+        else:
+            setattr(target, hash_name, pr.blob_store.put(value))
+            setattr(target, size_name, len(value))
+            setattr(target, name, None)
+
+for cls in [BiometricData, DocumentPart]:
+    sa.event.listen(cls, 'before_insert', _store_blobs)
+    sa.event.listen(cls, 'before_update', _store_blobs)
+
+#______________________________________________________________________________
+# Reference identity
+# Person.referenceIdentityId points to the identity flagged with isReference,
+# so that the reference is read with one join on the primary keys. The pointer
+# is updated when the flag of an identity is changed with the ORM. The services
+# changing the flag with UPDATE statements must also update the pointer.
+#______________________________________________________________________________
+def _previous_person(session, identity):
+    # the person owning the identity before the flush
+    history = sa.inspect(identity).attrs.personId.history
+    person_id = history.deleted[0] if history.deleted else identity.personId
+    if person_id is None:
+        return identity.person
+    return session.get(Person, person_id)
+
+@sa.event.listens_for(sa.orm.Session, 'before_flush')
+def _sync_reference(session, flush_context, instances):
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, Identity):
+            continue
+        state = sa.inspect(obj)
+        if obj in session.new:
+            if obj.isReference:
+                person = obj.person or session.get(Person, obj.personId)
+                person.reference = obj
+            continue
+        history = state.attrs.isReference.history
+        moved = state.attrs.personId.history.has_changes()
+        if not history.has_changes() and not moved:
+            continue
+        if history.deleted and history.deleted[0] or moved:
+            person = _previous_person(session, obj)
+            if person is not None and person.reference is obj:
+                person.reference = None
+        if obj.isReference:
+            person = session.get(Person, obj.personId)
+            person.reference = obj
+    for obj in session.deleted:
+        if isinstance(obj, Identity) and obj.isReference:
+            person = _previous_person(session, obj)
+            if person is not None and person not in session.deleted and person.reference is obj:
+                person.reference = None
+
+#______________________________________________________________________________
+# Identity versions
+# The version of an identity is also incremented when its galleries, biometric
+# data or document data are changed, so that it identifies the whole content
+# of the identity.
+#______________________________________________________________________________
+_PARENTS = {
+    Gallery: (Identity, 'identity_id'),
+    BiometricData: (Identity, 'identity_id'),
+    DocumentData: (Identity, 'identity_id'),
+    Missing: (BiometricData, 'biometricData_id'),
+    DocumentPart: (DocumentData, 'documentData_id'),
+}
+
+def _owner_identity(session, obj):
+    # the identity containing obj, None if unknown
+    while not isinstance(obj, Identity):
+        if type(obj) not in _PARENTS:
+            return None
+        cls, key = _PARENTS[type(obj)]
+        history = sa.inspect(obj).attrs[key].history
+        parent_id = history.deleted[0] if history.deleted else getattr(obj, key)
+        obj = session.get(cls, parent_id) if parent_id is not None else None
+    return obj
+
+@sa.event.listens_for(sa.orm.Session, 'before_flush')
+def _increment_versions(session, flush_context, instances):
+    # the new children are in the modified collection of their parent
+    identities = set()
+    for obj in list(session.dirty) + list(session.deleted):
+        if obj in session.dirty and not session.is_modified(obj):
+            continue
+        ident = _owner_identity(session, obj)
+        if ident is not None and ident not in session.deleted and ident not in session.new:
+            identities.add(ident)
+    for ident in identities:
+        ident.version = next_version(ident.version)
+
+#______________________________________________________________________________
+# In-place update
+# A persistent object is updated with the content of a transient object of the
+# same class, so that only the changed columns and rows are written. Columns
+# not set in the transient object go back to their default value.
+# The children of a one-to-many relationship are matched by their natural
+# primary key if any (e.g. Gallery.galleryId), else by position.
+#______________________________________________________________________________
+def _default(column):
+    if column.default is not None and column.default.is_scalar:
+        return column.default.arg
+    return None
+
+def _natural_key(mapper):
+    return [c.key for c in mapper.primary_key if not c.foreign_keys and c.autoincrement is not True]
+
+def update_from(target, source, exclude=()):
+    state = sa.inspect(source)
+    mapper = state.mapper
+    blobs = {name: (hash_name, size_name) for name, hash_name, size_name in getattr(mapper.class_, '__blobs__', [])}
+    blob_columns = [x for names in blobs.values() for x in names]
+    for attr in mapper.column_attrs:
+        column = attr.columns[0]
+        if attr.key in exclude or attr.key in blob_columns or column.primary_key or column.foreign_keys or column.info.get('derived'):
+            continue
+        if column is mapper.version_id_col:
+            continue
+        value = state.dict[attr.key] if attr.key in state.dict else _default(column)
+        if attr.key in blobs:
+            hash_name, size_name = blobs[attr.key]
+            if value is None:
+                setattr(target, hash_name, None)
+                setattr(target, size_name, None)
+            elif getattr(target, hash_name) and getattr(target, hash_name) == pr.blob.BlobStore.key(value):
+                # same buffer, already in the blob store
+                continue
+        setattr(target, attr.key, value)
+
+    for rel in mapper.relationships:
+        if rel.key in exclude or rel.direction is not sa.orm.ONETOMANY:
+            continue
+        targets = getattr(target, rel.key)
+        # the children are moved from the source to the target
+        sources = list(getattr(source, rel.key))
+        key = _natural_key(rel.mapper)
+        if key:
+            existing = {tuple(getattr(x, k) for k in key): x for x in targets}
+            keys = set()
+            for s in sources:
+                k = tuple(getattr(s, k) for k in key)
+                keys.add(k)
+                if k in existing:
+                    update_from(existing[k], s)
+                else:
+                    targets.append(s)
+            for k, t in existing.items():
+                if k not in keys:
+                    targets.remove(t)
+        else:
+            for t, s in zip(list(targets), sources):
+                update_from(t, s)
+            for s in sources[len(targets):]:
+                targets.append(s)
+            del targets[len(sources):]
+
+#______________________________________________________________________________
+# Loader options
+# The relationships of the identity are loaded with one SELECT per relationship
+# for all the identities of a query (selectin). The services not needing all the
+# data of the identities use one of the following options.
+#______________________________________________________________________________
+# the identity and all its data, for a full dump
+IDENTITY_FULL = (
+    selectinload(Identity._galleries),
+    selectinload(Identity.biometricData).selectinload(BiometricData.missing),
+    selectinload(Identity.documentData).selectinload(DocumentData.parts),
+)
+# the identity with its galleries, without the biometric and document data
+IDENTITY_ATTRIBUTES = (
+    selectinload(Identity._galleries),
+    raiseload(Identity.biometricData),
+    raiseload(Identity.documentData),
+)
+# the identity columns only, accessing a relationship raises an exception
+IDENTITY_ONLY = (
+    raiseload(Identity._galleries),
+    raiseload(Identity.biometricData),
+    raiseload(Identity.documentData),
+)
+
+def person_options(identity_options):
+    # options to load a person and its identities
+    return (selectinload(Person.identities).options(*identity_options),)
+
 #______________________________________________________________________________
 # Load the custo
 # Custo definition is inspired by OpenAPI v3 (https://github.com/OAI/OpenAPI-Specification/blob/master/versions/3.0.0.md#dataTypes)
 # See also https://docs.sqlalchemy.org/en/20/core/type_basics.html
+# Indexes on the custo attributes are declared in a top-level 'Indexes' list:
+#   Indexes:
+#     - columns: [lastName, dateOfBirth]
+#     - columns: [lastName]
+#       reference: true     # partial index on the reference identities
+# The string attributes searched with the 'phonetic' operator are declared in a
+# top-level 'Phonetic' list. Their phonetic key is stored in an indexed column
+# (pho_<name>) computed when the identity is written:
+#   Phonetic: [firstName, lastName]
+# The string attributes searched with the 'startsWith' and 'contains' operators
+# are declared in a top-level 'Substring' list. They are indexed by trigrams
+# (see create_search_indexes):
+#   Substring: [lastName]
 #______________________________________________________________________________
 
 def _add_field(n, c, prefix, required):
@@ -266,8 +525,74 @@ def _add_field(n, c, prefix, required):
     # https://docs.sqlalchemy.org/en/14/orm/declarative_tables.html#appending-additional-columns-to-an-existing-declarative-mapped-class
     setattr(Identity, n, col)
 
+def _add_index(idx):
+    # support the following properties: columns (list of custo attributes), reference (index only
+    # the reference identities), name
+    cols = []
+    for n in idx.get('columns', []):
+        if n in CUSTO_BGD:
+            cols.append(getattr(Identity, 'bgd_'+n))
+        elif n in CUSTO_CTX:
+            cols.append(getattr(Identity, 'ctx_'+n))
+        else:
+            raise Exception("Unknown attribute [{}] in custo index definition".format(n))
+    if not cols:
+        raise Exception("No columns in custo index definition")
+    kw = {}
+    name = idx.get('name', 'ix_' + '_'.join(idx['columns']))
+    if idx.get('reference', False):
+        # partial index, only on the reference identities
+        kw['postgresql_where'] = Identity.isReference
+        kw['sqlite_where'] = Identity.isReference
+        name = idx.get('name', name + '_ref')
+    # the index is attached to the IDENTITY table and created with it
+    index = sa.Index(name, *cols, **kw)
+    CUSTO_INDEXES.append(index)
+
+def _string_source(n, definition):
+    # name of the column of a custo string attribute
+    if n in CUSTO_BGD:
+        c, source = CUSTO_BGD[n], 'bgd_'+n
+    elif n in CUSTO_CTX:
+        c, source = CUSTO_CTX[n], 'ctx_'+n
+    else:
+        raise Exception("Unknown attribute [{}] in custo {} definition".format(n, definition))
+    if c.get('type', 'string') != 'string' or c.get('format', '') != '' or 'enum' in c:
+        raise Exception("Attribute [{}] in custo {} definition is not a string".format(n, definition))
+    return source
+
+def _add_phonetic(n):
+    source = _string_source(n, 'phonetic')
+    # the key is derived from the attribute, it is not part of the identity data
+    col = mapped_column('pho_'+n, sa.String(pr.phonetic.KEY_LENGTH), nullable=True, info={'derived': True})
+    setattr(Identity, 'pho_'+n, col)
+    CUSTO_PHONETIC[n] = source
+    CUSTO_INDEXES.append(sa.Index('ix_pho_'+n, getattr(Identity, 'pho_'+n)))
+
+def _add_substring(n):
+    source = _string_source(n, 'substring')
+    CUSTO_SUBSTRING[n] = source
+    # PostgreSQL only, SQLite uses the search table (see Substring search)
+    index = sa.Index('ix_trgm_'+n, getattr(Identity, source), postgresql_using='gin', postgresql_ops={source: 'gin_trgm_ops'})
+    index.ddl_if(dialect='postgresql')
+    CUSTO_INDEXES.append(index)
+
+def _set_phonetic_keys(mapper, connection, target):
+    state = sa.inspect(target)
+    for n, source in CUSTO_PHONETIC.items():
+        if state.key is None or state.attrs[source].history.has_changes():
+            setattr(target, 'pho_'+n, pr.phonetic.soundex(getattr(target, source)))
+
+sa.event.listen(Identity, 'before_insert', _set_phonetic_keys)
+sa.event.listen(Identity, 'before_update', _set_phonetic_keys)
+
 CUSTO_BGD = {}
 CUSTO_CTX = {}
+CUSTO_INDEXES = []
+# phonetic attributes and the name of their source column
+CUSTO_PHONETIC = {}
+# substring attributes and the name of their column
+CUSTO_SUBSTRING = {}
 def load_custo(custo):
     global CUSTO_BGD
     global CUSTO_CTX
@@ -277,6 +602,12 @@ def load_custo(custo):
     for n,c in custo.get('ContextualData',{}).get('properties', {}).items():
         _add_field(n,c,'ctx_', custo.get('ContextualData',{}).get('required', []))
         CUSTO_CTX[n] = c
+    for idx in custo.get('Indexes', []):
+        _add_index(idx)
+    for n in custo.get('Phonetic', []):
+        _add_phonetic(n)
+    for n in custo.get('Substring', []):
+        _add_substring(n)
 
 custo = None
 def _load_custo():
@@ -289,18 +620,209 @@ def _load_custo():
             load_custo(custo)
             logging.info("Custo from file [%s] was loaded", pr.args.custo_filename)
 
+#______________________________________________________________________________
+# Connection pools
+# The time spent waiting for a connection is measured by the pools and
+# reported to on_pool_wait (when defined) in seconds.
+#______________________________________________________________________________
+on_pool_wait = None
+
+class _TimedPool:
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            if on_pool_wait:
+                on_pool_wait(time.perf_counter() - start)
+
+class TimedQueuePool(_TimedPool, sa.pool.QueuePool):
+    pass
+
+class TimedAsyncQueuePool(_TimedPool, sa.pool.AsyncAdaptedQueuePool):
+    pass
+
+def is_memory_database(url):
+    url = sa.engine.make_url(url)
+    return url.get_backend_name() == 'sqlite' and (url.database in [None, '', ':memory:'] or url.query.get('mode') == 'memory')
+
+def _pool_options(url, is_async):
+    kw = dict(pool_pre_ping=pr.args.db_pool_pre_ping, pool_recycle=pr.args.db_pool_recycle)
+    if is_memory_database(url):
+        # the in-memory databases use a specific pool: a connection is
+        # the whole database
+        kw.update(poolclass=sa.pool.StaticPool if is_async else sa.pool.SingletonThreadPool)
+        return kw
+    kw.update(poolclass=TimedAsyncQueuePool if is_async else TimedQueuePool,
+              pool_size=pr.args.db_pool_size,
+              max_overflow=pr.args.db_pool_max_overflow,
+              pool_timeout=pr.args.db_pool_timeout)
+    return kw
+
+def _create_async_engine(database_url):
+    async_url = database_url.replace('psycopg2', 'asyncpg').replace('sqlite', 'sqlite+aiosqlite')
+    return create_async_engine(async_url, echo=False, **_pool_options(async_url, True))
+
+def create_engines(database_url):
+    # See https://docs.sqlalchemy.org/en/20/core/engines.html#database-urls
+    # and https://docs.sqlalchemy.org/en/20/core/pooling.html
+    engine = create_engine(database_url, echo=False, **_pool_options(database_url, False))
+    return engine, _create_async_engine(database_url)
+
+def create_replica_engines(replica_urls):
+    # the read replicas are only accessed by the async services
+    return [_create_async_engine(url) for url in replica_urls]
+
+def _upgrade_schema(engine):
+    # add the columns created since the tables were created
+    columns = [x['name'] for x in sa.inspect(engine).get_columns('PERSON')]
+    if 'referenceIdentityId' not in columns:
+        logging.info("Adding column PERSON.referenceIdentityId")
+        with engine.begin() as conn:
+            conn.execute(sa.text('ALTER TABLE "PERSON" ADD COLUMN "referenceIdentityId" INTEGER'))
+            ref = select(Identity.id).where(Identity.personId==Person.personId, Identity.isReference).scalar_subquery()
+            conn.execute(sa.update(Person).values(referenceIdentityId=ref))
+            for index in Person.__table__.indexes:
+                index.create(conn, checkfirst=True)
+    for table in [Person.__table__, Identity.__table__]:
+        if 'version' not in [x['name'] for x in sa.inspect(engine).get_columns(table.name)]:
+            logging.info("Adding column %s.version", table.name)
+            with engine.begin() as conn:
+                conn.execute(sa.text('ALTER TABLE "{}" ADD COLUMN "version" BIGINT'.format(table.name)))
+                conn.execute(sa.update(table).values(version=_initial_version()))
+    columns = [x['name'] for x in sa.inspect(engine).get_columns('IDENTITY')]
+    for n, source in CUSTO_PHONETIC.items():
+        if 'pho_'+n in columns:
+            continue
+        logging.info("Adding column IDENTITY.pho_%s", n)
+        with engine.begin() as conn:
+            conn.execute(sa.text('ALTER TABLE "IDENTITY" ADD COLUMN "pho_{}" VARCHAR({})'.format(n, pr.phonetic.KEY_LENGTH)))
+            table = Identity.__table__
+            rows = conn.execute(select(table.c.id, table.c[source]).where(table.c[source].isnot(None))).all()
+            keys = [{'_id': id, 'key': pr.phonetic.soundex(value)} for id, value in rows]
+            if keys:
+                conn.execute(sa.update(table).where(table.c.id==sa.bindparam('_id')).values({table.c['pho_'+n]: sa.bindparam('key')}), keys)
+
+#______________________________________________________________________________
+# Substring search
+# The 'startsWith' and 'contains' operators are case insensitive LIKE
+# predicates on the columns of the custo 'Substring' attributes, resolved with
+# a trigram index:
+# - PostgreSQL: a GIN index using the pg_trgm operator class on each column
+#   (custo indexes, the extension is created with the IDENTITY table),
+# - SQLite: a FTS5 table with the trigram tokenizer, indexing the columns of the
+#   IDENTITY table (external content) and maintained by triggers. The rows
+#   matching the trigrams of the value are selected with the FTS5 table, then
+#   filtered with the LIKE predicate.
+# The values of less than 3 characters cannot use the trigrams.
+#______________________________________________________________________________
+SEARCH_TABLE_NAME = 'IDENTITY_SEARCH'
+# the FTS5 table, when available
+search_table = None
+
+def _search_table_ddl():
+    columns = list(CUSTO_SUBSTRING.values())
+    cols = ', '.join('"{}"'.format(c) for c in columns)
+    new = ', '.join('new."{}"'.format(c) for c in columns)
+    old = ', '.join('old."{}"'.format(c) for c in columns)
+    table = SEARCH_TABLE_NAME
+    delete = 'INSERT INTO "{t}"("{t}", rowid, {c}) VALUES (\'delete\', old.id, {o});'.format(t=table, c=cols, o=old)
+    insert = 'INSERT INTO "{t}"(rowid, {c}) VALUES (new.id, {n});'.format(t=table, c=cols, n=new)
+    return [
+        'CREATE VIRTUAL TABLE "{t}" USING fts5({c}, content=\'IDENTITY\', content_rowid=\'id\', tokenize=\'trigram\')'.format(t=table, c=cols),
+        'CREATE TRIGGER "{t}_ai" AFTER INSERT ON "IDENTITY" BEGIN {i} END'.format(t=table, i=insert),
+        'CREATE TRIGGER "{t}_ad" AFTER DELETE ON "IDENTITY" BEGIN {d} END'.format(t=table, d=delete),
+        'CREATE TRIGGER "{t}_au" AFTER UPDATE OF {c} ON "IDENTITY" BEGIN {d} {i} END'.format(t=table, c=cols, d=delete, i=insert),
+    ]
+
+def _drop_search_table(conn):
+    for suffix in ['_ai', '_ad', '_au']:
+        conn.execute(sa.text('DROP TRIGGER IF EXISTS "{}{}"'.format(SEARCH_TABLE_NAME, suffix)))
+    conn.execute(sa.text('DROP TABLE IF EXISTS "{}"'.format(SEARCH_TABLE_NAME)))
+
+def _create_search_table(conn):
+    # (re)create the FTS5 table and index the current rows
+    _drop_search_table(conn)
+    if not CUSTO_SUBSTRING:
+        return
+    logging.info("Creating the substring search table for %s", list(CUSTO_SUBSTRING))
+    for statement in _search_table_ddl():
+        conn.execute(sa.text(statement))
+    conn.execute(sa.text('INSERT INTO "{t}"("{t}") VALUES (\'rebuild\')'.format(t=SEARCH_TABLE_NAME)))
+
+@sa.event.listens_for(Identity.__table__, 'after_create')
+def _identity_created(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        _create_search_table(connection)
+
+PG_TRGM_DDL = sa.DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+sa.event.listen(Identity.__table__, 'before_create',
+                PG_TRGM_DDL.execute_if(dialect='postgresql', callable_=lambda *args, **kw: bool(CUSTO_SUBSTRING)))
+
+@sa.event.listens_for(Identity.__table__, 'before_drop')
+def _identity_dropped(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        _drop_search_table(connection)
+
+def create_search_indexes(engine):
+    # the extension and the SQLite table are created with the IDENTITY table.
+    # When it already exists, the extension is created here before the custo
+    # indexes, and the SQLite table is rebuilt if the attributes were changed.
+    if engine.dialect.name == 'postgresql':
+        if not CUSTO_SUBSTRING:
+            return
+        with engine.begin() as conn:
+            conn.execute(PG_TRGM_DDL)
+    elif engine.dialect.name == 'sqlite':
+        with engine.begin() as conn:
+            current = conn.execute(sa.text("SELECT sql FROM sqlite_master WHERE name=:name"), dict(name=SEARCH_TABLE_NAME)).scalar()
+            expected = _search_table_ddl()[0] if CUSTO_SUBSTRING else None
+            if current != expected:
+                _create_search_table(conn)
+
+def _setup_search(engine):
+    global search_table
+    search_table = None
+    if engine.dialect.name == 'sqlite' and CUSTO_SUBSTRING and sa.inspect(engine).has_table(SEARCH_TABLE_NAME):
+        search_table = sa.table(SEARCH_TABLE_NAME, sa.column('rowid'), *[sa.column(c) for c in CUSTO_SUBSTRING.values()])
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def substring_predicate(n, operator, value):
+    """Return the predicate of the 'startsWith' or 'contains' operator on the attribute n"""
+    column = getattr(Identity, CUSTO_SUBSTRING[n])
+    pattern = _escape_like(value) + '%'
+    if operator == 'contains':
+        pattern = '%' + pattern
+    predicate = column.ilike(pattern, escape='\\')
+    if search_table is not None and len(value) >= 3:
+        # FTS5 query: the value as a string, restricted to the column
+        query = '{} : "{}"'.format(CUSTO_SUBSTRING[n], value.replace('"', '""'))
+        match = select(search_table.c.rowid).where(sa.text('"{}" MATCH :query'.format(SEARCH_TABLE_NAME)).bindparams(query=query))
+        predicate = sa.and_(Identity.id.in_(match), predicate)
+    return predicate
+
 def setup():
     _load_custo()
     if pr.args and pr.args.database_url:
         # setup the database engine
-        # See https://docs.sqlalchemy.org/en/20/core/engines.html#database-urls
-        engine = create_engine(pr.args.database_url, echo=False)
-        aengine = create_async_engine(pr.args.database_url.replace('psycopg2', 'asyncpg').replace('sqlite', 'sqlite+aiosqlite'), echo=False)
+        engine, aengine = create_engines(pr.args.database_url)
         if not pr.args.dont_create_schema:
             Base.metadata.create_all(engine)
+            _upgrade_schema(engine)
+            create_search_indexes(engine)
+            # the table may already exist: create the custo indexes added since then
+            for index in CUSTO_INDEXES:
+                index.create(engine, checkfirst=True)
+        _setup_search(engine)
         logging.info("DB engine created URL [%s]", pr.args.database_url)
         pr.engine = engine
         pr.aengine = aengine
+        pr.areplicas = create_replica_engines(pr.args.database_replica_url)
+        for url in pr.args.database_replica_url:
+            logging.info("DB replica engine created URL [%s]", url)
 
 def dump_sql(sql, *multiparams, **params):
     print(sql.compile(dialect=pr.engine.dialect))
@@ -0,0 +1,42 @@
+import unicodedata
+
+#______________________________________________________________________________
+# Phonetic keys
+# American Soundex: the first letter of the name followed by 3 digits coding
+# the consonants, so that names pronounced alike (Robert/Rupert, Smith/Smyth)
+# have the same key. The accents are removed before the encoding.
+#______________________________________________________________________________
+SOUNDEX_CODES = {}
+for letters, code in [('BFPV', '1'), ('CGJKQSXZ', '2'), ('DT', '3'), ('L', '4'), ('MN', '5'), ('R', '6')]:
+    for letter in letters:
+        SOUNDEX_CODES[letter] = code
+
+# length of the keys
+KEY_LENGTH = 4
+
+def _letters(value):
+    value = unicodedata.normalize('NFKD', value)
+    return [c for c in value.upper() if 'A' <= c <= 'Z']
+
+def soundex(value):
+    """Return the Soundex key of value, or None if value has no letter"""
+    if not value:
+        return None
+    letters = _letters(value)
+    if not letters:
+        return None
+    key = letters[0]
+    previous = SOUNDEX_CODES.get(letters[0])
+    for c in letters[1:]:
+        code = SOUNDEX_CODES.get(c)
+        if code is None:
+            # H and W do not separate two consonants with the same code, the vowels do
+            if c not in 'HW':
+                previous = None
+            continue
+        if code != previous:
+            key += code
+            if len(key) == KEY_LENGTH:
+                break
+        previous = code
+    return key.ljust(KEY_LENGTH, '0')
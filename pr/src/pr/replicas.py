@@ -0,0 +1,108 @@
+import logging
+
+import sqlalchemy as sa
+
+#______________________________________________________________________________
+# Read replicas
+# The read-only services are load-balanced on the healthy replicas. A client
+# can require to read its own writes by providing the commit position returned
+# by the write services: only the replicas that have replayed this position
+# are then used, otherwise the primary database is used. A replica failing
+# between two health checks is not used until the next check.
+#______________________________________________________________________________
+
+# Queries returning the commit position of the primary and the position
+# replayed by a replica. The backends without positions cannot guarantee
+# read-your-writes: the primary is used when a position is required.
+POSITION_QUERIES = {
+    'postgresql': ('SELECT pg_current_wal_lsn()::text', 'SELECT pg_last_wal_replay_lsn()::text'),
+}
+
+def parse_position(value):
+    """Convert a PostgreSQL LSN ('16/B374D848') to an integer"""
+    high, low = value.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+def format_position(position):
+    return '%X/%X' % (position >> 32, position & 0xFFFFFFFF)
+
+
+def is_connection_error(exc):
+    """Return True if the exception is caused by the connection to the database"""
+    if isinstance(exc, sa.exc.DBAPIError) and exc.connection_invalidated:
+        return True
+    return isinstance(exc, (sa.exc.OperationalError, sa.exc.InterfaceError, OSError))
+
+
+class Replica:
+    def __init__(self, engine):
+        self.engine = engine
+        self.healthy = True
+        # last position replayed, None if unknown
+        self.position = None
+
+    async def check(self):
+        query = POSITION_QUERIES.get(self.engine.dialect.name, (None, 'SELECT 1'))[1]
+        try:
+            async with self.engine.connect() as conn:
+                value = (await conn.execute(sa.text(query))).scalar()
+        except Exception as exc:
+            if self.healthy:
+                logging.warning("Replica [%s] is not available: %s", self.engine.url, str(exc))
+            self.healthy = False
+            return
+        if not self.healthy:
+            logging.info("Replica [%s] is available", self.engine.url)
+        self.healthy = True
+        self.position = parse_position(value) if isinstance(value, str) else None
+
+
+class ReplicaSet:
+    """
+    The primary engine and the engines of the read replicas.
+    """
+    def __init__(self, primary=None, engines=()):
+        self.setup(primary, engines)
+
+    def setup(self, primary, engines):
+        self.primary = primary
+        self.replicas = [Replica(e) for e in engines]
+        self._next = 0
+
+    def __len__(self):
+        return len(self.replicas)
+
+    @property
+    def nb_healthy(self):
+        return len([r for r in self.replicas if r.healthy])
+
+    def choose(self, min_position=None):
+        """
+        Return the engine of the next healthy replica (round robin) that has
+        replayed min_position, or the primary engine.
+        """
+        candidates = [r for r in self.replicas
+                      if r.healthy and (min_position is None or (r.position is not None and r.position >= min_position))]
+        if not candidates:
+            return self.primary
+        self._next += 1
+        return candidates[self._next % len(candidates)].engine
+
+    def set_unavailable(self, engine, exc):
+        """Mark the replica of engine as unhealthy until the next check"""
+        for replica in self.replicas:
+            if replica.engine is engine and replica.healthy:
+                logging.warning("Replica [%s] is not available: %s", engine.url, str(exc))
+                replica.healthy = False
+
+    async def check(self):
+        for replica in self.replicas:
+            await replica.check()
+
+    async def primary_position(self):
+        """Return the current commit position of the primary, or None"""
+        query = POSITION_QUERIES.get(self.primary.dialect.name, (None, None))[0]
+        if not query:
+            return None
+        async with self.primary.connect() as conn:
+            return parse_position((await conn.execute(sa.text(query))).scalar())
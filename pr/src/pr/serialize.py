@@ -3,6 +3,7 @@
 
 import base64
 
+import pr
 from . import model
 
 # import marshmallow as ma
@@ -28,14 +29,29 @@ class LargeBinary(fields.Field):
         except ValueError as error:
             raise ValidationError("Buffer must be base64 encoded") from error
 
+# LargeBinary field whose value may have been moved to the blob store, the
+# buffer is then read from the store using the hash kept in the row.
+class Blob(LargeBinary):
+
+    def __init__(self, hash_attribute, **kwargs):
+        super().__init__(**kwargs)
+        self.hash_attribute = hash_attribute
+
+    def _serialize(self, value, attr, obj, **kwargs):
+        if value is None:
+            key = getattr(obj, self.hash_attribute, None)
+            if key:
+                value = pr.blob_store.get(key)
+        return super()._serialize(value, attr, obj, **kwargs)
+
 class DocumentPartSchema(SQLAlchemyAutoSchema):
     class Meta:
         model = model.DocumentPart
         load_instance = True
         include_fk = False
-        exclude = ['id']
+        exclude = ['id', 'dataHash', 'dataSize']
     pages = fields.List(fields.Int())
-    data = LargeBinary()
+    data = Blob('dataHash')
 
 class DocumentDataSchema(SQLAlchemyAutoSchema):
     class Meta:
@@ -57,9 +73,9 @@ class BiometricDataSchema(SQLAlchemyAutoSchema):
         model = model.BiometricData
         load_instance = True
         include_fk = False
-        exclude = ['id']
-    image = LargeBinary()
-    template = LargeBinary()
+        exclude = ['id', 'imageHash', 'imageSize', 'templateHash', 'templateSize']
+    image = Blob('imageHash')
+    template = Blob('templateHash')
     bio_metadata = auto_field(data_key='metadata')
     missing = Nested(MissingSchema, many=True)
 
@@ -79,7 +95,8 @@ class IdentitySchema(SQLAlchemyAutoSchema):
         load_instance = True
         include_fk = False
         dump_only = ['identityId']
-        exclude = ['id', 'isReference', 'position']
+        # the phonetic keys are derived from the attributes
+        exclude = ['id', 'version', 'isReference', 'position'] + ['pho_'+n for n in pr.model.CUSTO_PHONETIC]
     galleries = auto_field()
     clientData = LargeBinary()
     biometricData = Nested(BiometricDataSchema, many=True)
@@ -98,7 +115,7 @@ class PersonSchema(SQLAlchemyAutoSchema):
         model = model.Person
         load_instance = True
         dump_only = ['personId']
-        exclude = ['identities']
+        exclude = ['identities', 'version']
 
 
 # Utilities for embedded biographicData & contextualData
@@ -129,3 +146,155 @@ def ext2int(data):
 def int2ext(data):
     return _int2ext(_int2ext(data,key='contextualData',prefix='ctx_'))
 
+
+#______________________________________________________________________________
+# Compiled serializer
+# The fields of a schema (built from the mapper and the custo) are read once to
+# generate the conversions of each attribute. The objects are then dumped to
+# their external shape, and loaded from it, without the marshmallow machinery
+# (schema instances, hooks, intermediate dicts). The output and the validation
+# errors are the same as the ones of the schema.
+#______________________________________________________________________________
+def dump_function(field):
+    # function converting a (not None) value of the field to JSON, None if there is nothing to convert
+    if isinstance(field, (fields.Date, fields.DateTime)):
+        if field.format not in (None, 'iso'):
+            return lambda v: field._serialize(v, None, None)
+        return lambda v: v.isoformat()
+    if isinstance(field, fields.Integer):
+        return int
+    if isinstance(field, fields.Float):
+        return float
+    if isinstance(field, fields.Boolean):
+        return bool
+    if isinstance(field, fields.String):
+        return str
+    if isinstance(field, LargeBinary):
+        return lambda v: base64.b64encode(v).decode('ascii')
+    if isinstance(field, fields.List):
+        inner = dump_function(field.inner)
+        if inner is None:
+            return list
+        return lambda v: [inner(x) for x in v]
+    if type(field) in (fields.Raw, fields.Field, Related):
+        return None
+    return lambda v: field._serialize(v, None, None)
+
+class CompiledSchema:
+    """
+    Dumper and loader generated from a schema class.
+
+    embedded: {external key: attribute prefix}, the attributes whose name
+    starts with the prefix are grouped in a sub-object (biographicData...)
+    drop_none: do not dump the attributes without value
+    These options reproduce the post_dump & pre_load hooks of the schema.
+    """
+    def __init__(self, schema_class):
+        options = COMPILE_OPTIONS.get(schema_class, {})
+        schema = schema_class()
+        self.cls = schema.opts.model
+        self.embedded = options.get('embedded', {})
+        self.drop_none = options.get('drop_none', False)
+        self.fields = []
+        self.load_fields = {}
+        self.required = []
+        self._dumpers = {}
+        for name, field in schema.fields.items():
+            attribute = field.attribute or name
+            key = field.data_key or name
+            nested = None
+            if isinstance(field, Nested):
+                nested = CompiledSchema(type(field.schema))
+            group, short_key = None, key
+            for g, prefix in self.embedded.items():
+                if key.startswith(prefix):
+                    group, short_key = g, key[len(prefix):]
+            blob_hash = field.hash_attribute if isinstance(field, Blob) else None
+            self.fields.append((name, attribute, short_key, group, dump_function(field), blob_hash, nested))
+            if not field.dump_only:
+                self.load_fields[key] = (attribute, field, nested)
+                if field.required:
+                    self.required.append(key)
+
+    def _dump_fields(self, exclude):
+        exclude = frozenset(exclude)
+        if exclude not in self._dumpers:
+            self._dumpers[exclude] = [f[1:] for f in self.fields if f[0] not in exclude]
+        return self._dumpers[exclude]
+
+    def dump(self, obj, exclude=()):
+        ret = {}
+        groups = {g: {} for g in self.embedded}
+        # the loaded columns & relationships are read from the state of the
+        # instance, the other attributes (association proxy...) with getattr
+        state = obj.__dict__
+        for attribute, key, group, convert, blob_hash, nested in self._dump_fields(exclude):
+            value = state[attribute] if attribute in state else getattr(obj, attribute)
+            if nested is not None:
+                value = [nested.dump(x) for x in value]
+            else:
+                if value is None and blob_hash:
+                    h = state[blob_hash] if blob_hash in state else getattr(obj, blob_hash)
+                    if h:
+                        value = pr.blob_store.get(h)
+                if value is None:
+                    if self.drop_none or group:
+                        continue
+                elif convert is not None:
+                    value = convert(value)
+            if group:
+                groups[group][key] = value
+            else:
+                ret[key] = value
+        # same order as int2ext
+        for g in reversed(list(self.embedded)):
+            ret[g] = groups[g]
+        return ret
+
+    def load(self, data):
+        """Return a transient object, ValidationError is raised if the data is invalid"""
+        if not isinstance(data, dict):
+            raise ValidationError({'_schema': ['Invalid input type.']})
+        if self.embedded:
+            data = dict(data)
+            for g, prefix in self.embedded.items():
+                for k, v in data.pop(g, {}).items():
+                    data[prefix+k] = v
+        kw = {}
+        errors = {}
+        for key, value in data.items():
+            if key not in self.load_fields:
+                errors[key] = ['Unknown field.']
+                continue
+            attribute, field, nested = self.load_fields[key]
+            try:
+                if nested is not None and isinstance(value, list):
+                    items = []
+                    item_errors = {}
+                    for i, x in enumerate(value):
+                        try:
+                            items.append(nested.load(x))
+                        except ValidationError as exc:
+                            item_errors[i] = exc.messages
+                    if item_errors:
+                        raise ValidationError(item_errors)
+                    value = items
+                else:
+                    value = field.deserialize(value)
+            except ValidationError as exc:
+                errors[key] = exc.messages
+                continue
+            kw[attribute] = value
+        for key in self.required:
+            if key not in data:
+                errors[key] = ['Missing data for required field.']
+        if errors:
+            raise ValidationError(errors)
+        return self.cls(**kw)
+
+COMPILE_OPTIONS = {
+    IdentitySchema: dict(embedded={'biographicData': 'bgd_', 'contextualData': 'ctx_'}, drop_none=True),
+    BiometricDataSchema: dict(drop_none=True),
+}
+
+IDENTITY = CompiledSchema(IdentitySchema)
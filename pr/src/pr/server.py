@@ -1,26 +1,33 @@
 import ssl
 import logging
 import json
-import copy
 import uuid
 import base64
-import io
+import hashlib
 import asyncio
+import datetime
+import operator
+import os
+import time
+import contextvars
 
 import aiohttp
 from aiohttp import web
 
 import yaml
 import jsonschema
-import referencing
-import referencing.jsonschema
 
 import pr
 import pr.model
-
-from sqlalchemy.orm import Session, make_transient
+import pr.cache
+import pr.workers
+import pr.replicas
+import pr.phonetic
+from pr import codec
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
 from sqlalchemy import select
-from sqlalchemy import delete
 from sqlalchemy.ext.asyncio import AsyncSession
 
 import livemetrics
@@ -31,7 +38,11 @@ routes = web.RouteTableDef()
 def is_healthy():
     return True
 
-LM = livemetrics.LiveMetrics(json.dumps(dict(version=pr.__version__)), "pr", is_healthy)
+def is_ready():
+    # not ready until the warm-up is done (see start_warmup)
+    return STARTUP['ready']
+
+LM = livemetrics.LiveMetrics(json.dumps(dict(version=pr.__version__)), "pr", is_healthy, is_ready)
 
 def ok_status(ret):
     return str(ret.status)
@@ -51,15 +62,165 @@ async def error_middleware(request, handler):
         return response
     except KeyError as exc:
         if exc.args==('transactionId',):
-                return web.json_response({'code':1, 'message': 'Missing transactionId'}, status=400)
+                return codec.json_response({'code':1, 'message': 'Missing transactionId'}, status=400)
         raise
     except ResponseException as resp:
         return resp.response
+    except sa.orm.exc.StaleDataError:
+        # the row was changed since it was read (see the versions in pr.model)
+        if request.if_match:
+            return codec.json_response({'code':1, 'message': 'The resource was modified'}, status=412)
+        return codec.json_response({'code':1, 'message': 'The resource was modified concurrently'}, status=409)
     except aiohttp.web_exceptions.HTTPException:
         raise
     except Exception as exc:
         logging.exception("Exception caught in middleware: [%s]", str(exc))
-        return web.json_response(dict(code=0, message=str(exc)), status=500)
+        return codec.json_response(dict(code=0, message=str(exc)), status=500)
+
+# _____________________________________________________________________________
+# The name of the service being processed, used to report the time spent
+# waiting for a database connection per service.
+CURRENT_ENDPOINT = contextvars.ContextVar('current_endpoint', default=None)
+
+@web.middleware
+async def endpoint_middleware(request, handler):
+    route = request.match_info.route
+    token = CURRENT_ENDPOINT.set(getattr(route.handler, '__name__', None) if route else None)
+    try:
+        return await handler(request)
+    finally:
+        CURRENT_ENDPOINT.reset(token)
+
+# _____________________________________________________________________________
+# Startup of the server (see the warm-up at the end of this module)
+# ready: the warm-up is done, reported by /monitoring/v1/is_ready
+# first_fast_request: seconds between the creation of the application and the
+# end of the first business request served in less than --fast-request-time
+STARTUP = {'ready': False, 'start': time.perf_counter(), 'warmup_duration': 0., 'warmup_failures': 0, 'first_fast_request': 0.}
+
+@web.middleware
+async def startup_middleware(request, handler):
+    if STARTUP['first_fast_request'] or not request.path.startswith('/v1/'):
+        return await handler(request)
+    start = time.perf_counter()
+    response = await handler(request)
+    end = time.perf_counter()
+    if response.status < 400 and end - start <= pr.args.fast_request_time / 1000 and not STARTUP['first_fast_request']:
+        STARTUP['first_fast_request'] = end - STARTUP['start']
+        logging.info("First fast request served %.3f s after the startup", STARTUP['first_fast_request'])
+    return response
+
+# _____________________________________________________________________________
+# Read replicas
+# The write services return the commit position of the primary database in
+# the X-Commit-Position header. A client provides it to the read-only services
+# to read its own writes.
+COMMIT_POSITION_HEADER = 'X-Commit-Position'
+READ_ONLY_ENDPOINTS = {'readPerson', 'readIdentities', 'readIdentity', 'readReference', 'findPersons',
+                       'readGalleries', 'readGalleryContent', 'queryPersonList', 'readPersonAttributes',
+                       'matchPersonAttributes', 'verifyPersonAttributes', 'readDocument', 'getPersonWithId',
+                       'batchPersonAttributes'}
+REPLICAS = pr.replicas.ReplicaSet()
+# the position required by the request being processed
+MIN_POSITION = contextvars.ContextVar('min_position', default=None)
+# the position of the last write of this process: the reference cache is
+# populated only from the replicas that have replayed it
+LAST_WRITE_POSITION = None
+# the replica engines used by the request being processed, and whether its
+# response was sent
+REPLICA_USAGE = contextvars.ContextVar('replica_usage', default=None)
+
+def read_engine(min_position=None):
+    # engine used by the read-only services
+    position = MIN_POSITION.get()
+    if min_position is not None:
+        position = max(position or 0, min_position)
+    engine = REPLICAS.choose(position)
+    usage = REPLICA_USAGE.get()
+    if usage is not None and engine is not REPLICAS.primary:
+        usage['engines'].append(engine)
+    return engine
+
+async def _handle_on_replicas(request, handler):
+    # A replica failing between two checks is marked as unhealthy and the
+    # request is processed again on another replica or on the primary, unless
+    # its response was already sent.
+    for attempt in range(len(REPLICAS)):
+        usage = dict(engines=[], prepared=False)
+        token = REPLICA_USAGE.set(usage)
+        try:
+            return await handler(request)
+        except Exception as exc:
+            if not usage['engines'] or not pr.replicas.is_connection_error(exc):
+                raise
+            for engine in usage['engines']:
+                REPLICAS.set_unavailable(engine, exc)
+            if usage['prepared']:
+                raise
+        finally:
+            REPLICA_USAGE.reset(token)
+    return await handler(request)
+
+async def _on_prepare(request, response):
+    usage = REPLICA_USAGE.get()
+    if usage is not None:
+        usage['prepared'] = True
+
+@web.middleware
+async def replica_middleware(request, handler):
+    global LAST_WRITE_POSITION
+    if not REPLICAS:
+        return await handler(request)
+    position = None
+    if COMMIT_POSITION_HEADER in request.headers:
+        try:
+            position = pr.replicas.parse_position(request.headers[COMMIT_POSITION_HEADER])
+        except ValueError:
+            return codec.json_response({'code':1, 'message': 'Invalid commit position'}, status=400)
+    token = MIN_POSITION.set(position)
+    try:
+        if CURRENT_ENDPOINT.get() in READ_ONLY_ENDPOINTS:
+            response = await _handle_on_replicas(request, handler)
+        else:
+            response = await handler(request)
+    finally:
+        MIN_POSITION.reset(token)
+    if request.method != 'GET' and response.status < 300 and CURRENT_ENDPOINT.get() not in READ_ONLY_ENDPOINTS:
+        try:
+            position = await REPLICAS.primary_position()
+        except Exception as exc:
+            logging.warning("Commit position not available: %s", str(exc))
+            position = None
+        if position is not None:
+            LAST_WRITE_POSITION = max(LAST_WRITE_POSITION or 0, position)
+            response.headers[COMMIT_POSITION_HEADER] = pr.replicas.format_position(position)
+    return response
+
+async def _check_replicas():
+    while True:
+        await asyncio.sleep(pr.args.replica_check_interval)
+        await REPLICAS.check()
+
+REPLICAS_TASK = web.AppKey('replicas_task', asyncio.Task)
+
+async def start_replicas(app):
+    if REPLICAS:
+        await REPLICAS.check()
+        app[REPLICAS_TASK] = asyncio.create_task(_check_replicas())
+
+async def stop_replicas(app):
+    if REPLICAS_TASK in app:
+        app[REPLICAS_TASK].cancel()
+    for engine in pr.areplicas:
+        await engine.dispose()
+
+def _on_pool_wait(seconds):
+    LM.histogram('db_pool_wait', seconds)
+    endpoint = CURRENT_ENDPOINT.get()
+    if endpoint:
+        LM.histogram('db_pool_wait_'+endpoint, seconds)
+
+pr.model.on_pool_wait = _on_pool_wait
 
 
 # _____________________________________________________________________________
@@ -90,31 +251,55 @@ async def _strip_server(req, res):
 
 
 # _____________________________________________________________________________
+# In the pre-fork mode, the Unix socket where the worker exposes its metrics
+WORKER_MONITORING_PATH = None
+
 async def start_monitoring(app):
     app2 = web.Application(middlewares=[error_middleware])
     app2.add_routes(livemetrics.publishers.aiohttp.routes(LM))
-    runner = web.AppRunner(app2)
-    await runner.setup()
-    site = web.TCPSite(runner, host=pr.args.ip, port=pr.args.monitoring_port)
+    if WORKER_MONITORING_PATH:
+        # polled by the main process for each metrics request: no access log
+        runner = web.AppRunner(app2, access_log=None)
+        await runner.setup()
+        site = web.UnixSite(runner, WORKER_MONITORING_PATH)
+    else:
+        runner = web.AppRunner(app2)
+        await runner.setup()
+        site = web.TCPSite(runner, host=pr.args.ip, port=pr.args.monitoring_port)
     await site.start()
 
 # _____________________________________________________________________________
 def get_app():
+    setup_validators()
+    REFERENCE_CACHE.size = pr.args.reference_cache_size
+    REFERENCE_CACHE.clear()
+    REPLICAS.setup(pr.aengine, pr.areplicas)
+    STARTUP.update(ready=False, start=time.perf_counter(), warmup_duration=0., warmup_failures=0, first_fast_request=0.)
     app = web.Application(client_max_size=pr.args.input_max_size*1024*1024,
-                          middlewares=[error_middleware])
+                          middlewares=[startup_middleware, error_middleware, endpoint_middleware, replica_middleware])
     app.add_routes(routes)
     if pr.args.monitoring_port<=0 or pr.args.monitoring_port==pr.args.port:
         app.add_routes(livemetrics.publishers.aiohttp.routes(LM))
     else:
         app.on_startup.append(start_monitoring)
+    app.on_startup.append(start_counters)
+    app.on_cleanup.append(stop_counters)
+    app.on_startup.append(start_replicas)
+    app.on_cleanup.append(stop_replicas)
+    app.on_startup.append(start_warmup)
+    app.on_cleanup.append(stop_warmup)
     # Remove Server header for security reason
     app.on_response_prepare.append(_strip_server)
+    app.on_response_prepare.append(_on_prepare)
 
     return app
 
 
 # _____________________________________________________________________________
 def serve():
+    if pr.args.workers > 1:
+        pr.workers.serve()
+        return
     app = get_app()
     if pr.args.do_not_start:
         logging.warning('Not starting the application')
@@ -134,44 +319,87 @@ def to_bool(x):
     return False
 
 # Schema validation
-registry = None
-schemas = None
-api = None
-def validate_json(data, schema_name, with_required=True):
-    global schemas
-    global api
-    global registry
-    if not schemas or not api:
-        if pr.args and pr.args.api_file:
-            with open(pr.args.api_file, 'r') as f:
-                api = yaml.load(f, Loader=yaml.SafeLoader)
-            schemas = api['components']['schemas']
-
-            # patch schemas for readOnly attributes
-            schemas['Identity']['required'].remove('identityId')
-
-            # apply custo definition
-            if pr.model.custo and 'BiographicData' in pr.model.custo:
-                schemas['BiographicData'] = pr.model.custo['BiographicData']
-            if pr.model.custo and 'ContextualData' in pr.model.custo:
-                schemas['ContextualData'] = pr.model.custo['ContextualData']
-
-            registry = referencing.Registry().with_resource(
-                uri='',
-                resource=referencing.Resource.from_contents(api, default_specification=referencing.jsonschema.DRAFT7)
-            )
-            registry = registry.crawl()
+# Validators are built once per schema name and reused for all the requests.
+# The $ref are inlined when the validators are built, so that no reference
+# resolution is done while validating.
+# The partial variants (used for PATCH) are built from a copy of the schemas
+# where nothing is required and None is accepted for any typed value.
+VALIDATED_SCHEMAS = ['Person', 'Identity', 'Expressions', 'BiographicData', 'ContextualData', 'BulkRecord']
+VALIDATORS = {}
+PARTIAL_VALIDATORS = {}
+SCHEMA_REF_PREFIX = '#/components/schemas/'
+
+def _partial_schema(schema):
+    if not isinstance(schema, dict):
+        return schema
+    ret = {}
+    for k, v in schema.items():
+        if k == 'required' and isinstance(v, list):
+            continue
+        if k == 'type' and isinstance(v, str):
+            ret[k] = [v, 'null']
+        elif k == 'properties':
+            ret[k] = {n: _partial_schema(p) for n, p in v.items()}
+        elif k in ['items', 'additionalProperties', 'not']:
+            ret[k] = _partial_schema(v)
+        elif k in ['oneOf', 'anyOf', 'allOf']:
+            ret[k] = [_partial_schema(x) for x in v]
         else:
-            logging.debug('No validation of incoming JSON')
-            return None
+            ret[k] = v
+    return ret
+
+def _inline_refs(schema, schemas, stack=()):
+    if isinstance(schema, list):
+        return [_inline_refs(x, schemas, stack) for x in schema]
+    if not isinstance(schema, dict):
+        return schema
+    ref = schema.get('$ref')
+    if isinstance(ref, str) and ref.startswith(SCHEMA_REF_PREFIX):
+        name = ref[len(SCHEMA_REF_PREFIX):]
+        if name in schemas and name not in stack:
+            # siblings of $ref are ignored in draft 7
+            return _inline_refs(schemas[name], schemas, stack + (name,))
+        raise Exception("Cannot inline reference [{}] in JSON schema".format(ref))
+    return {k: _inline_refs(v, schemas, stack) for k, v in schema.items()}
+
+def _build_validators(schemas):
+    return {name: jsonschema.Draft7Validator(schema=_inline_refs(schemas[name], schemas, (name,)))
+            for name in VALIDATED_SCHEMAS}
+
+def load_api():
+    with open(pr.args.api_file, 'r') as f:
+        api = yaml.load(f, Loader=yaml.SafeLoader)
+    schemas = api['components']['schemas']
+
+    # patch schemas for readOnly attributes
+    schemas['Identity']['required'].remove('identityId')
+
+    # apply custo definition
+    if pr.model.custo and 'BiographicData' in pr.model.custo:
+        schemas['BiographicData'] = pr.model.custo['BiographicData']
+    if pr.model.custo and 'ContextualData' in pr.model.custo:
+        schemas['ContextualData'] = pr.model.custo['ContextualData']
+    return api
+
+def setup_validators():
+    if VALIDATORS:
+        return
+    if not pr.args or not pr.args.api_file:
+        logging.debug('No validation of incoming JSON')
+        return
+    schemas = load_api()['components']['schemas']
+    VALIDATORS.update(_build_validators(schemas))
+    PARTIAL_VALIDATORS.update(_build_validators({n: _partial_schema(s) for n, s in schemas.items()}))
+    logging.info("JSON validators built for schemas %s", VALIDATED_SCHEMAS)
+
+def validate_json(data, schema_name, with_required=True):
+    setup_validators()
+    if not VALIDATORS:
+        return None
     # validate the data against the schema
-    v = jsonschema.Draft7Validator(schema=schemas[schema_name], registry=registry, _resolver = registry.resolver())
-    if with_required:
-        msg = "\n".join([error.message for error in v.iter_errors(instance=data)])
-    else:
-        # do not check required field or None value
-        msg = "\n".join([error.message for error in v.iter_errors(instance=data) if error.message.find('is a required property')<0 and error.message.find('None is not of type')<0])
-    
+    # (in partial mode, do not check required field or None value)
+    v = VALIDATORS[schema_name] if with_required else PARTIAL_VALIDATORS[schema_name]
+    msg = "\n".join([error.message for error in v.iter_errors(instance=data)])
     if msg:
         logging.error(msg)
         return msg
@@ -181,13 +409,95 @@ def validate_json(data, schema_name, with_required=True):
 # _____________________________________________________________________________
 
 # _____________________________________________________________________________
-def _build_predicate(data, reference, gallery, group, limit, offset):
+# Streaming of large results as NDJSON (one JSON object per line)
+# Rows are read with a server-side cursor and written as they arrive, so the
+# memory used does not depend on the size of the result.
+# Note: no X-Next-Cursor is returned in this mode.
+# _____________________________________________________________________________
+NDJSON = 'application/x-ndjson'
+NDJSON_BATCH = 500
+
+def accept_ndjson(request):
+    return NDJSON in request.headers.get('Accept', '')
+
+async def ndjson_response(request, sel, to_json):
+    async with AsyncSession(read_engine()) as session, session.begin():
+        result = await session.stream(sel.execution_options(yield_per=NDJSON_BATCH))
+        resp = web.StreamResponse(status=200, headers={'Content-Type': NDJSON})
+        await resp.prepare(request)
+        async for rows in result.partitions():
+            await resp.write(b''.join([codec.dumps(to_json(row)) + b'\n' for row in rows]))
+        await resp.write_eof()
+        return resp
+
+# _____________________________________________________________________________
+# Keyset pagination
+# The cursor is an opaque (base64 encoded) list of the values of the sort key
+# for the last item of the previous page.
+# _____________________________________________________________________________
+def encode_cursor(values):
+    values = [x.isoformat() if isinstance(x, (datetime.date, datetime.datetime)) else x for x in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor, columns):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError(cursor)
+        ret = []
+        for col, v in zip(columns, values):
+            if v is not None and isinstance(col.type, sa.DateTime):
+                v = datetime.datetime.fromisoformat(v)
+            elif v is not None and isinstance(col.type, sa.Date):
+                v = datetime.date.fromisoformat(v)
+            elif v is not None and not isinstance(v, col.type.python_type):
+                raise ValueError(cursor)
+            ret.append(v)
+        return ret
+    except (ValueError, TypeError):
+        raise ResponseException(codec.json_response({'code':1, 'message': 'Invalid cursor [{}]'.format(cursor)}, status=400))
+
+def get_order_column(name):
+    # only the attributes indexed by the custo can be used to sort the results
+    for index in pr.model.CUSTO_INDEXES:
+        col = list(index.columns)[0]
+        if col.name in ['bgd_'+name, 'ctx_'+name]:
+            return getattr(pr.model.Identity, col.name)
+    raise ResponseException(codec.json_response({'code':1, 'message': 'Invalid orderBy [{}]. Only indexed attributes can be used'.format(name)}, status=400))
+
+def _keyset_predicate(order_column, values):
+    # the sort key is (order_column, personId, id), with NULL values of order_column last
+    key = sa.tuple_(pr.model.Identity.personId, pr.model.Identity.id)
+    if order_column is None:
+        return key > tuple(values)
+    v, values = values[0], values[1:]
+    if v is None:
+        return sa.and_(order_column.is_(None), key > tuple(values))
+    return sa.or_(order_column > v,
+                  sa.and_(order_column == v, key > tuple(values)),
+                  order_column.is_(None))
+
+# _____________________________________________________________________________
+def _build_predicate(data, reference, gallery, group, limit, offset, cursor=None, order_by=None):
     if group:
         sel = select(pr.model.Identity.personId)
     else:
         sel = select(pr.model.Identity)
     for pred in data:
         k = pred['attributeName']
+        if pred['operator'] == 'phonetic':
+            # compare the phonetic keys, using the index of the key column
+            if k not in pr.model.CUSTO_PHONETIC:
+                return codec.json_response({'code':1, 'message': 'Phonetic search not available for attribute [{}]'.format(k)}, status=400)
+            key = pr.phonetic.soundex(str(pred['value']))
+            sel = sel.where(getattr(pr.model.Identity, 'pho_'+k) == key if key else sa.false())
+            continue
+        if pred['operator'] in ('startsWith', 'contains'):
+            # LIKE predicate resolved with the trigram index
+            if k not in pr.model.CUSTO_SUBSTRING:
+                return codec.json_response({'code':1, 'message': 'Substring search not available for attribute [{}]'.format(k)}, status=400)
+            sel = sel.where(pr.model.substring_predicate(k, pred['operator'], str(pred['value'])))
+            continue
         found = False
         for pre, lis in [('',['personId']), ('bgd_', pr.model.CUSTO_BGD)]:
             if k in lis:
@@ -205,26 +515,53 @@ def _build_predicate(data, reference, gallery, group, limit, offset):
                 elif pred['operator']=='>=':
                     sel = sel.where( getattr(pr.model.Identity, pre+k) >= pred['value'])
                 else:
-                    return web.json_response({'code':1, 'message': 'Invalid operator [{}] in query expression'.format(pred['operator'])}, status=400)
+                    return codec.json_response({'code':1, 'message': 'Invalid operator [{}] in query expression'.format(pred['operator'])}, status=400)
                 break
         if not found:
-            return web.json_response({'code':1, 'message': 'Unknown attribute [{}] in query expression'.format(k)}, status=400)
+            return codec.json_response({'code':1, 'message': 'Unknown attribute [{}] in query expression'.format(k)}, status=400)
 
     if reference:
         sel = sel.where(pr.model.Identity.isReference)
 
-    if group:
-        sel = sel.group_by("personId")
-
     if gallery:
         sel = sel.join(pr.model.Gallery).where(pr.model.Gallery.galleryId == gallery)
 
+    # stable ordering, required for the pagination
+    if group:
+        if order_by:
+            return codec.json_response({'code':1, 'message': 'orderBy cannot be used with group'}, status=400)
+        sel = sel.group_by(pr.model.Identity.personId).order_by(pr.model.Identity.personId)
+        if cursor:
+            sel = sel.where(pr.model.Identity.personId > decode_cursor(cursor, [pr.model.Identity.personId])[0])
+    else:
+        columns = [pr.model.Identity.personId, pr.model.Identity.id]
+        order_column = None
+        if order_by:
+            order_column = get_order_column(order_by)
+            columns.insert(0, order_column)
+            sel = sel.order_by(order_column.nulls_last())
+        sel = sel.order_by(pr.model.Identity.personId, pr.model.Identity.id)
+        if cursor:
+            sel = sel.where(_keyset_predicate(order_column, decode_cursor(cursor, columns)))
+
     if limit:
         sel = sel.limit(limit)
-    if offset:
+    if offset and not cursor:
         sel = sel.offset(offset)
     return sel
 
+def _next_cursor(rows, limit, group, order_by):
+    # a cursor is returned only if the page is full
+    if not limit or len(rows) < limit:
+        return None
+    last = rows[-1]
+    if group:
+        return encode_cursor([last])
+    values = [last.personId, last.id]
+    if order_by:
+        values.insert(0, getattr(last, get_order_column(order_by).key))
+    return encode_cursor(values)
+
 # _____________________________________________________________________________
 @routes.post('/v1/persons')
 @LM.timer("findPersons", ok_status, "error")
@@ -235,32 +572,49 @@ async def findPersons(request):
     gallery = request.query.get('gallery', None)
     offset = int(request.query.get('offset', 0))
     limit = int(request.query.get('limit', 100))
+    cursor = request.query.get('cursor', None)
+    order_by = request.query.get('orderBy', None)
 
-    data = await request.json()
+    data = await codec.read_json(request)
     logging.info("[%s] - findPersons", transaction_id)
 
     msg = validate_json(data, 'Expressions')
     if msg:
-        return web.json_response(data={'code': 400, 'message': msg}, status=400)
+        return codec.json_response(data={'code': 400, 'message': msg}, status=400)
 
     # build predicate
-    async with AsyncSession(pr.aengine) as session, session.begin():
-        sel = _build_predicate(data, reference, gallery, group, limit, offset)
+    sel = _build_predicate(data, reference, gallery, group, limit, offset, cursor, order_by)
+    if type(sel) is web.Response:
+        return sel
+    if accept_ndjson(request):
+        if group:
+            return await ndjson_response(request, sel, lambda row: dict(personId=row.personId))
+        sel = sel.with_only_columns(pr.model.Identity.personId, pr.model.Identity.identityId)
+        return await ndjson_response(request, sel, lambda row: dict(personId=row.personId, identityId=row.identityId))
+
+    async with AsyncSession(read_engine()) as session, session.begin():
+        if not group:
+            sel = sel.options(*pr.model.IDENTITY_ONLY)
         res = await session.execute(sel)
         # Execute
+        rows = list(res.scalars())
         ret = []
-        for I in res.scalars():
+        for I in rows:
             if not group:
                 ret.append( dict(personId=I.personId, identityId=I.identityId) )
             else:
                 ret.append( dict(personId=I) )
-    
-        return web.json_response(ret, status=200)
+
+        headers = {}
+        next_cursor = _next_cursor(rows, limit, group, order_by)
+        if next_cursor:
+            headers['X-Next-Cursor'] = next_cursor
+        return codec.json_response(ret, status=200, headers=headers)
 
 
 # _____________________________________________________________________________
-def _get_person(session, person_id):
-    res = pr.model.Person.find_by_id(session, person_id)
+def _get_person(session, person_id, options=()):
+    res = pr.model.Person.find_by_id(session, person_id, options)
     if len(res) > 1:
         # not sure we can reach this code since personId is a PK
         raise ResponseException(web.Response(status=400))
@@ -269,8 +623,8 @@ def _get_person(session, person_id):
     return res[0]
 
 # _____________________________________________________________________________
-async def _aget_person(session, person_id):
-    res = await pr.model.Person.afind_by_id(session, person_id)
+async def _aget_person(session, person_id, options=()):
+    res = await pr.model.Person.afind_by_id(session, person_id, options)
     if len(res) > 1:
         # not sure we can reach this code since personId is a PK
         raise ResponseException(web.Response(status=400))
@@ -278,6 +632,199 @@ async def _aget_person(session, person_id):
         raise ResponseException(web.Response(status=404))
     return res[0]
 
+# _____________________________________________________________________________
+# ETags
+# The ETags are built with the versions of the rows (see pr.model), so that a
+# read with a matching If-None-Match is answered with 304 after reading the
+# versions only, and a write with If-Match is done only if the row was not
+# changed since the client read it, without locking the row.
+# _____________________________________________________________________________
+def person_etag(version):
+    return str(version)
+
+def identity_etag(id, version):
+    return '{}-{}'.format(id, version)
+
+def identities_etag(identities):
+    # identities: list of (id, version)
+    value = ','.join(identity_etag(id, version) for id, version in identities)
+    return hashlib.sha1(value.encode('ascii')).hexdigest()[:24]
+
+def _is_not_modified(request, etag):
+    # If-None-Match uses the weak comparison
+    return any(x.value in (etag, '*') for x in request.if_none_match or ())
+
+def _not_modified_response(etag):
+    resp = web.Response(status=304)
+    resp.etag = etag
+    return resp
+
+def _check_if_match(request, etag):
+    # If-Match uses the strong comparison
+    if request.if_match is None:
+        return
+    if not any(x.value == '*' or (x.value == etag and not x.is_weak) for x in request.if_match):
+        raise ResponseException(codec.json_response({'code':1, 'message': 'The resource was modified'}, status=412))
+
+def _with_etag(resp, etag):
+    resp.etag = etag
+    return resp
+
+# _____________________________________________________________________________
+# Cache of the reference identities, used by the Data Access services
+# The flattened attributes of the reference identity are cached by personId.
+# The persons modified by a transaction are collected when the session is
+# flushed and invalidated when the transaction is committed. With --workers,
+# the invalidations are shared by the workers (see pr.workers).
+# _____________________________________________________________________________
+REFERENCE_CACHE = pr.cache.LRUCache()
+# attributes too large to be kept in the cache
+UNCACHED_ATTRIBUTES = ['biometricData', 'documentData', 'clientData']
+
+def invalidate_reference(session, *person_ids):
+    # to be used by the services modifying the database without the ORM (bulk update/delete)
+    session.info.setdefault('modified_persons', set()).update(person_ids)
+
+@sa.event.listens_for(Session, 'after_flush')
+def _collect_modified_persons(session, flush_context):
+    person_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, pr.model.Person):
+            person_ids.add(obj.personId)
+        elif isinstance(obj, pr.model.Identity):
+            person_ids.add(obj.personId)
+            # the identity may have been moved from another person
+            person_ids.update(sa.inspect(obj).attrs.personId.history.deleted)
+    person_ids.discard(None)
+    if person_ids:
+        invalidate_reference(session, *person_ids)
+
+@sa.event.listens_for(Session, 'after_commit')
+def _invalidate_modified_persons(session):
+    person_ids = session.info.pop('modified_persons', None)
+    if person_ids:
+        REFERENCE_CACHE.invalidate(*person_ids)
+
+@sa.event.listens_for(Session, 'after_rollback')
+def _forget_modified_persons(session):
+    session.info.pop('modified_persons', None)
+
+def _flatten_identity(ident_data, names=None):
+    # biographic data has precedence over contextual data, then over identity attributes
+    ret = {k: v for k, v in ident_data.items() if k not in ['biographicData', 'contextualData'] and k not in UNCACHED_ATTRIBUTES}
+    ret.update(ident_data.get('contextualData', {}))
+    ret.update(ident_data.get('biographicData', {}))
+    for k in names or []:
+        if k in UNCACHED_ATTRIBUTES and k in ident_data:
+            ret[k] = ident_data[k]
+    return ret
+
+_ATTRIBUTE_COLUMNS = None
+
+def _attribute_columns():
+    # {attribute name: (column, field, convert)} of the flattened identity,
+    # None for the attributes that are not columns (galleries, biometric data...)
+    global _ATTRIBUTE_COLUMNS
+    if _ATTRIBUTE_COLUMNS is None:
+        import pr.serialize
+        columns = sa.inspect(pr.model.Identity).columns
+        fields = pr.serialize.IdentitySchema().fields
+        ret = {}
+        # same precedence as _flatten_identity
+        for prefix, custo in [('', None), ('ctx_', pr.model.CUSTO_CTX), ('bgd_', pr.model.CUSTO_BGD)]:
+            for key, field in fields.items():
+                name = field.data_key or key
+                if custo is None and key[:4] in ('ctx_', 'bgd_'):
+                    continue
+                if custo is not None:
+                    if not key.startswith(prefix) or key[len(prefix):] not in custo:
+                        continue
+                    name = key[len(prefix):]
+                if key in columns and key not in UNCACHED_ATTRIBUTES:
+                    ret[name] = (columns[key], field, pr.serialize.dump_function(field))
+                else:
+                    ret[name] = None
+        _ATTRIBUTE_COLUMNS = ret
+    return _ATTRIBUTE_COLUMNS
+
+def _is_column_attribute(name):
+    # unknown names are accepted, they have no value
+    return _attribute_columns().get(name, True) is not None
+
+async def _select_references(uins, names):
+    # Return {uin: attributes of the reference identity read from the columns,
+    # or None if the person has no reference}, without the unknown persons
+    columns = _attribute_columns()
+    selected = [(k, columns[k]) for k in names if columns.get(k)]
+    Identity = pr.model.Identity
+    sel = select(pr.model.Person.personId, Identity.id, *[c for k, (c, f, convert) in selected])
+    sel = sel.outerjoin(Identity, Identity.id==pr.model.Person.referenceIdentityId)
+    sel = sel.where(pr.model.Person.personId.in_(uins))
+    async with AsyncSession(read_engine(LAST_WRITE_POSITION)) as session, session.begin():
+        rows = (await session.execute(sel)).all()
+    ret = {}
+    for row in rows:
+        if row.id is None:
+            ret[row.personId] = None
+            continue
+        attributes = {}
+        for i, (k, (c, f, convert)) in enumerate(selected):
+            value = row[i+2]
+            if value is not None:
+                attributes[k] = convert(value) if convert else value
+        ret[row.personId] = attributes
+    return ret
+
+async def _read_references(uins, names=None):
+    # Return {uin: flattened attributes of the reference identity, or None if
+    # the person has no reference}, without the unknown persons
+    # The cached attributes are the columns of the identity, read without the
+    # ORM. The other attributes are read from the dump of the identity.
+    ret = {}
+    use_cache = all(_is_column_attribute(k) for k in names or [])
+    if use_cache:
+        missing = []
+        for uin in uins:
+            attributes = REFERENCE_CACHE.get(uin)
+            if attributes is None:
+                missing.append(uin)
+            else:
+                ret[uin] = attributes
+        if not missing:
+            return ret
+        generation = REFERENCE_CACHE.generation
+        if REFERENCE_CACHE.size <= 0 and names:
+            # only the requested columns
+            ret.update(await _select_references(missing, names))
+            return ret
+        selected = await _select_references(missing, list(_attribute_columns()))
+        for uin, attributes in selected.items():
+            if attributes is not None:
+                REFERENCE_CACHE.put(uin, attributes, generation)
+        ret.update(selected)
+        return ret
+
+    import pr.serialize
+
+    Identity = pr.model.Identity
+    sel = select(pr.model.Person.personId, Identity).outerjoin(Identity, Identity.id==pr.model.Person.referenceIdentityId)
+    sel = sel.where(pr.model.Person.personId.in_(uins)).options(*pr.model.IDENTITY_FULL)
+    async with AsyncSession(read_engine()) as session, session.begin():
+        for row in (await session.execute(sel)).all():
+            if row.Identity is None:
+                ret[row.personId] = None
+            else:
+                ret[row.personId] = _flatten_identity(pr.serialize.IDENTITY.dump(row.Identity), names)
+    return ret
+
+async def _read_reference(uin, names=None):
+    # Return the flattened attributes of the reference identity, or None if the person has no reference
+    # ResponseException(404) is raised if the person does not exist
+    ret = await _read_references([uin], names)
+    if uin not in ret:
+        raise ResponseException(web.Response(status=404))
+    return ret[uin]
+
 # _____________________________________________________________________________
 @routes.post('/v1/persons/{personId}')
 @LM.timer("createPerson", ok_status, "error")
@@ -285,12 +832,12 @@ async def createPerson(request):
     transaction_id = request.query['transactionId']
     person_id = request.match_info['personId']
 
-    data = await request.json()
+    data = await codec.read_json(request)
     logging.info("[%s] - createPerson for personId [%s]", transaction_id, person_id)
 
     msg = validate_json(data, 'Person')
     if msg:
-        return web.json_response(data={'code': 400, 'message': msg}, status=400)
+        return codec.json_response(data={'code': 400, 'message': msg}, status=400)
 
     import pr.serialize
     async with AsyncSession(pr.aengine) as session, session.begin():
@@ -306,19 +853,167 @@ async def createPerson(request):
 
     return web.Response(status=201)
 
+# _____________________________________________________________________________
+# Bulk creation of persons
+# _____________________________________________________________________________
+async def _iter_lines(content, max_size):
+    # split the body in lines without the size limit of StreamReader.readline
+    buf = bytearray()
+    async for chunk in content.iter_any():
+        buf.extend(chunk)
+        start = 0
+        end = buf.find(b'\n', start)
+        while end >= 0:
+            yield bytes(buf[start:end])
+            start = end + 1
+            end = buf.find(b'\n', start)
+        del buf[:start]
+        if len(buf) > max_size:
+            raise ValueError('Record too large')
+    if buf:
+        yield bytes(buf)
+
+def _check_bulk_record(record):
+    # structure of a record, required when the JSON validation is disabled
+    if not isinstance(record, dict):
+        return 'A JSON object is expected'
+    if not isinstance(record.get('personId'), str):
+        return 'Missing personId'
+    if not isinstance(record.get('person'), dict):
+        return 'Missing person'
+    identities = record.get('identities', [])
+    if not isinstance(identities, list) or not all(isinstance(x, dict) for x in identities):
+        return 'Invalid identities'
+    return None
+
+def _bulk_load(record, person_schema, identity_schema):
+    # Build the person and its identities, or return the status of the error
+    import marshmallow
+    person_id = record['personId']
+    try:
+        np = person_schema.load(record['person'], transient=True)
+    except marshmallow.ValidationError as exc:
+        return None, 400, str(exc)
+    np.personId = person_id
+    reference = record.get('reference', None)
+    found = False
+    for data in record.get('identities', []):
+        data = dict(data)
+        identity_id = data.pop('identityId', None) or uuid.uuid4().hex
+        if identity_id in [x.identityId for x in np.identities]:
+            return None, 409, 'identityId [{}] already present in person [{}]'.format(identity_id, person_id)
+        try:
+            ni = identity_schema.load(data)
+        except marshmallow.ValidationError as exc:
+            return None, 400, str(exc)
+        ni.identityId = identity_id
+        if identity_id == reference:
+            # Check status, only in VALID state an identity can be the reference
+            if ni.status!='VALID':
+                return None, 403, 'Illegal status of the identity - defineReference is forbidden'
+            ni.isReference = True
+            found = True
+        np.identities.append(ni)
+    if reference and not found:
+        return None, 400, 'Unknown reference identity [{}]'.format(reference)
+    return np, 201, None
+
+async def _bulk_insert(records):
+    # Insert a batch of records (status, record) in one transaction.
+    # If the transaction fails, each record is retried in its own transaction
+    import pr.serialize
+    person_schema = pr.serialize.PersonSchema()
+    identity_schema = pr.serialize.IDENTITY
+    try:
+        async with AsyncSession(pr.aengine) as session, session.begin():
+            res = await session.execute(select(pr.model.Person.personId).where(
+                pr.model.Person.personId.in_([r['personId'] for st, r in records])))
+            existing = set(res.scalars())
+            persons = []
+            for st, r in records:
+                if r['personId'] in existing:
+                    st.update(status=409, message='personId [{}] already exists'.format(r['personId']))
+                    continue
+                existing.add(r['personId'])
+                p, st['status'], msg = _bulk_load(r, person_schema, identity_schema)
+                if p is None:
+                    st['message'] = msg
+                    continue
+                persons.append(p)
+            session.add_all(persons)
+    except Exception as exc:
+        if len(records) == 1:
+            logging.exception("Bulk insert failed for person [%s]", records[0][1]['personId'])
+            records[0][0].update(status=500, message=str(exc))
+            return
+        logging.warning("Bulk insert of %d records failed, retrying one by one: [%s]", len(records), str(exc))
+        for st, r in records:
+            st.pop('message', None)
+            await _bulk_insert([(st, r)])
+
+@routes.post('/v1/persons:bulk')
+@LM.timer("bulkCreatePersons", ok_status, "error")
+async def bulkCreatePersons(request):
+    transaction_id = request.query['transactionId']
+    logging.info("[%s] - bulkCreatePersons", transaction_id)
+
+    resp = web.StreamResponse(status=200, headers={'Content-Type': NDJSON})
+    await resp.prepare(request)
+
+    async def flush(batch):
+        await _bulk_insert([(st, r) for st, r in batch if r is not None])
+        await resp.write(b''.join([codec.dumps(st) + b'\n' for st, r in batch]))
+        batch.clear()
+
+    batch = []
+    line_number = 0
+    try:
+        async for line in _iter_lines(request.content, pr.args.input_max_size*1024*1024):
+            line_number += 1
+            if not line.strip():
+                continue
+            st = dict(line=line_number)
+            try:
+                record = codec.loads(line)
+            except ValueError as exc:
+                st.update(status=400, message='Invalid JSON: {}'.format(exc))
+                batch.append((st, None))
+                continue
+            if isinstance(record, dict) and isinstance(record.get('personId'), str):
+                st['personId'] = record['personId']
+            msg = validate_json(record, 'BulkRecord') or _check_bulk_record(record)
+            if msg:
+                st.update(status=400, message=msg)
+                record = None
+            batch.append((st, record))
+            if len(batch) >= pr.args.bulk_batch_size:
+                await flush(batch)
+    except ValueError as exc:
+        # the remaining of the input is ignored
+        batch.append((dict(line=line_number+1, status=413, message=str(exc)), None))
+    await flush(batch)
+    await resp.write_eof()
+    return resp
+
 # _____________________________________________________________________________
 @LM.timer("readPerson", ok_status, "error")
-async def readPerson(transaction_id, person_id):
+async def readPerson(request, transaction_id, person_id):
     logging.info("[%s] - readPerson for personId [%s]", transaction_id, person_id)
 
     import pr.serialize
-    async with AsyncSession(pr.aengine) as session, session.begin():
+    async with AsyncSession(read_engine()) as session, session.begin():
+        if request.if_none_match:
+            version = await session.scalar(select(pr.model.Person.version).where(pr.model.Person.personId==person_id))
+            if version is None:
+                return web.Response(status=404)
+            if _is_not_modified(request, person_etag(version)):
+                return _not_modified_response(person_etag(version))
         p = await _aget_person(session, person_id)
         person_schema = pr.serialize.PersonSchema()
         data = person_schema.dump(p)
         # del data['identities']
         # data['personId'] = person_id
-        return web.json_response(data, status=200)
+        return _with_etag(codec.json_response(data, status=200), person_etag(p.version))
 
 
 # _____________________________________________________________________________
@@ -328,21 +1023,22 @@ async def updatePerson(request):
     transaction_id = request.query['transactionId']
     person_id = request.match_info['personId']
 
-    data = await request.json()
+    data = await codec.read_json(request)
     logging.info("[%s] - updatePerson for personId [%s]", transaction_id, person_id)
 
     msg = validate_json(data, 'Person')
     if msg:
-        return web.json_response(data={'code': 400, 'message': msg}, status=400)
+        return codec.json_response(data={'code': 400, 'message': msg}, status=400)
 
     import pr.serialize
     async with AsyncSession(pr.aengine) as session, session.begin():
         np = await _aget_person(session, person_id)
+        _check_if_match(request, person_etag(np.version))
         person_schema = pr.serialize.PersonSchema()
         person_schema.load(data, instance=np, session=session)
         session.add(np)
-
-    return web.Response(status=204)
+        await session.flush()
+        return _with_etag(web.Response(status=204), person_etag(np.version))
 
 # _____________________________________________________________________________
 @routes.delete('/v1/persons/{personId}')
@@ -354,11 +1050,35 @@ async def deletePerson(request):
     logging.info("[%s] - deletePerson for personId [%s]", transaction_id, person_id)
 
     async with AsyncSession(pr.aengine) as session, session.begin():
-        p = await _aget_person(session, person_id)
+        p = await _aget_person(session, person_id, pr.model.person_options(pr.model.IDENTITY_FULL))
         await session.delete(p)
 
     return web.Response(status=204)
 
+# _____________________________________________________________________________
+# mergePerson and moveIdentity update the identities with UPDATE statements,
+# without loading the persons and their identities.
+# _____________________________________________________________________________
+async def _lock_persons(session, *person_ids):
+    # lock the persons until the end of the transaction
+    # ResponseException(404) is raised if a person does not exist
+    sel = select(pr.model.Person.personId).where(pr.model.Person.personId.in_(person_ids)).with_for_update()
+    found = set((await session.execute(sel)).scalars())
+    if any(x not in found for x in person_ids):
+        raise ResponseException(web.Response(status=404))
+
+async def _conflicting_identity(session, person_id, moved):
+    # True if an identity selected by the 'moved' criteria has the identityId of an identity of the person
+    Identity = pr.model.Identity
+    other = sa.orm.aliased(Identity)
+    sel = select(other.id).where(other.personId==person_id, other.identityId==Identity.identityId, moved).limit(1)
+    return await session.scalar(sel) is not None
+
+async def _next_position(session, person_id):
+    # position after the last identity of the person
+    Identity = pr.model.Identity
+    return await session.scalar(select(sa.func.coalesce(sa.func.max(Identity.position)+1, 0)).where(Identity.personId==person_id))
+
 # _____________________________________________________________________________
 @routes.post('/v1/persons/{personIdTarget}/merge/{personIdSource}')
 @LM.timer("mergePerson", ok_status, "error")
@@ -369,25 +1089,26 @@ async def mergePerson(request):
 
     logging.info("[%s] - mergePerson with personId [%s] in personId [%s]", transaction_id, person_id_source, person_id_target)
 
+    Identity = pr.model.Identity
     async with AsyncSession(pr.aengine) as session, session.begin():
-        p_source = await _aget_person(session, person_id_source)
-        p_target = await _aget_person(session, person_id_target)
+        await _lock_persons(session, person_id_source, person_id_target)
 
         # Check the ID
-        target_ids = set()
-        for ident in await p_target.awaitable_attrs.identities:
-            target_ids.add(ident.identityId)
-        for ident in await p_source.awaitable_attrs.identities:
-            if ident.identityId in target_ids:
-                return web.Response(status=409)
-        
-        # all good, do the merge and delete the source
-        for ident in p_source.identities:
-            ident.isReference = False
-            ident.personId = person_id_target
-        await session.flush()
-        await session.refresh(p_source)
-        await session.delete(p_source)
+        if await _conflicting_identity(session, person_id_target, Identity.personId==person_id_source):
+            return web.Response(status=409)
+
+        # all good, move the identities after the ones of the target and delete the source
+        position = await _next_position(session, person_id_target)
+        await session.execute(sa.update(Identity)
+                              .where(Identity.personId==person_id_source)
+                              .values(personId=person_id_target, isReference=False, position=Identity.position+position,
+                                      version=Identity.version+1)
+                              .execution_options(synchronize_session=False))
+        await session.execute(sa.delete(pr.model.Person)
+                              .where(pr.model.Person.personId==person_id_source)
+                              .execution_options(synchronize_session=False))
+        invalidate_reference(session, person_id_source, person_id_target)
+        count_objects(session, pr.model.Person, -1)
 
     return web.Response(status=204)
 
@@ -396,20 +1117,19 @@ async def mergePerson(request):
 async def _create_identity(transaction_id, person_id, identity_id, data, ok_code=200):
     msg = validate_json(data, 'Identity')
     if msg:
-        return web.json_response(data={'code': 400, 'message': msg}, status=400)
+        return codec.json_response(data={'code': 400, 'message': msg}, status=400)
 
     import pr.serialize
 
     async with AsyncSession(pr.aengine) as session, session.begin():
-        p = await _aget_person(session, person_id)
+        p = await _aget_person(session, person_id, pr.model.person_options(pr.model.IDENTITY_ONLY))
 
         # check the identity does not exist in this person
         for ident in await p.awaitable_attrs.identities:
             if ident.identityId == identity_id:
-                return web.json_response(data={'code': 1, 'message': 'identityId [{}] already present in person [{}]'.format(identity_id, person_id)}, status=409)
+                return codec.json_response(data={'code': 1, 'message': 'identityId [{}] already present in person [{}]'.format(identity_id, person_id)}, status=409)
 
-        identity_schema = pr.serialize.IdentitySchema()
-        ni = identity_schema.load(data, session=session)
+        ni = pr.serialize.IDENTITY.load(data)
         ni.identityId = identity_id
         session.add(ni)
         p.identities.append(ni)
@@ -417,7 +1137,7 @@ async def _create_identity(transaction_id, person_id, identity_id, data, ok_code
 
         if ok_code==201:
             return web.Response(status=201)
-        return web.json_response(data={'identityId': identity_id}, status=ok_code)
+        return codec.json_response(data={'identityId': identity_id}, status=ok_code)
 
 # _____________________________________________________________________________
 @routes.post('/v1/persons/{personId}/identities')
@@ -425,7 +1145,7 @@ async def _create_identity(transaction_id, person_id, identity_id, data, ok_code
 async def createIdentity(request):
     transaction_id = request.query['transactionId']
     person_id = request.match_info['personId']
-    data = await request.json()
+    data = await codec.read_json(request)
     logging.info("[%s] - createIdentity for personId [%s]", transaction_id, person_id)
     identity_id = uuid.uuid4().hex
     return await _create_identity(transaction_id, person_id, identity_id, data)
@@ -439,7 +1159,7 @@ async def createIdentityWithId(request):
     person_id = request.match_info['personId']
     identity_id = request.match_info['identityId']
 
-    data = await request.json()
+    data = await codec.read_json(request)
     logging.info("[%s] - createIdentityWithId for personId [%s]/[%s]", transaction_id, person_id, identity_id)
     return await _create_identity(transaction_id, person_id, identity_id, data, 201)
 
@@ -456,16 +1176,23 @@ async def readIdentity(request):
 
     import pr.serialize
 
-    async with AsyncSession(pr.aengine) as session, session.begin():
-        p = await _aget_person(session, person_id)
+    Identity = pr.model.Identity
+    async with AsyncSession(read_engine()) as session, session.begin():
+        if request.if_none_match:
+            row = (await session.execute(select(Identity.id, Identity.version).where(
+                Identity.personId==person_id, Identity.identityId==identity_id))).first()
+            if row is None:
+                return web.Response(status=404)
+            if _is_not_modified(request, identity_etag(row.id, row.version)):
+                return _not_modified_response(identity_etag(row.id, row.version))
+        p = await _aget_person(session, person_id, pr.model.person_options(pr.model.IDENTITY_FULL))
 
         # get the identity from this person
         for ident in await p.awaitable_attrs.identities:
             if ident.identityId == identity_id:
 
-                identity_schema = pr.serialize.IdentitySchema()
-                data = identity_schema.dump(ident)
-                return web.json_response(data, status=200)
+                data = pr.serialize.IDENTITY.dump(ident)
+                return _with_etag(codec.json_response(data, status=200), identity_etag(ident.id, ident.version))
         return web.Response(status=404)
 
 
@@ -480,14 +1207,26 @@ async def readIdentities(request):
 
     import pr.serialize
 
-    async with AsyncSession(pr.aengine) as session, session.begin():
-        p = await _aget_person(session, person_id)
+    Identity = pr.model.Identity
+    async with AsyncSession(read_engine()) as session, session.begin():
+        if request.if_none_match:
+            sel = select(pr.model.Person.personId, Identity.id, Identity.version)
+            sel = sel.outerjoin(Identity, Identity.personId==pr.model.Person.personId)
+            sel = sel.where(pr.model.Person.personId==person_id).order_by(Identity.position)
+            rows = (await session.execute(sel)).all()
+            if not rows:
+                return web.Response(status=404)
+            etag = identities_etag([(row.id, row.version) for row in rows if row.id is not None])
+            if _is_not_modified(request, etag):
+                return _not_modified_response(etag)
+        p = await _aget_person(session, person_id, pr.model.person_options(pr.model.IDENTITY_FULL))
         ret = []
-        identity_schema = pr.serialize.IdentitySchema()
-        for ident in await p.awaitable_attrs.identities:
-            data = identity_schema.dump(ident)
+        identities = await p.awaitable_attrs.identities
+        for ident in identities:
+            data = pr.serialize.IDENTITY.dump(ident)
             ret.append(data)
-        return web.json_response(ret, status=200)
+        etag = identities_etag([(ident.id, ident.version) for ident in identities])
+        return _with_etag(codec.json_response(ret, status=200), etag)
 
 
 # _____________________________________________________________________________
@@ -498,36 +1237,32 @@ async def updateIdentity(request):
     person_id = request.match_info['personId']
     identity_id = request.match_info['identityId']
 
-    data = await request.json()
+    data = await codec.read_json(request)
     logging.info("[%s] - updateIdentity for personId [%s]/[%s]", transaction_id, person_id, identity_id)
 
     msg = validate_json(data, 'Identity')
     if msg:
-        return web.json_response(data={'code': 400, 'message': msg}, status=400)
+        return codec.json_response(data={'code': 400, 'message': msg}, status=400)
 
     import pr.serialize
 
     async with AsyncSession(pr.aengine) as session, session.begin():
-        p = await _aget_person(session, person_id)
+        p = await _aget_person(session, person_id, pr.model.person_options(pr.model.IDENTITY_FULL))
         # get the identity from this person
-        pos = -1
         for ident in await p.awaitable_attrs.identities:
-            pos += 1
             if ident.identityId == identity_id:
                 # Check status, only in CLAIMED an update is allowed
                 if ident.status!='CLAIMED':
-                    return web.json_response(data={'code': 1, 'message': 'Illegal status of the identity - update is forbidden'}, status=403)
-                    
-                # we need to replace the identity (this is not a partial update) to make sure
-                # optional field not present in input are also updated to their default value
-                # XXX probably not as efficient as it could be. Investigate if we can do better
-                await session.delete(ident)
+                    return codec.json_response(data={'code': 1, 'message': 'Illegal status of the identity - update is forbidden'}, status=403)
+
+                # this is not a partial update: the identity is replaced by the input, optional
+                # fields not present in input are updated to their default value. Only the
+                # changed rows & columns are written.
+                _check_if_match(request, identity_etag(ident.id, ident.version))
+                ni = pr.serialize.IDENTITY.load(data)
+                pr.model.update_from(ident, ni, exclude=['identityId', 'isReference', 'position'])
                 await session.flush()
-                identity_schema = pr.serialize.IdentitySchema()
-                ni = identity_schema.load(data, session=session)
-                ni.identityId = identity_id
-                p.identities[pos] = ni
-                return web.Response(status=204)
+                return _with_etag(web.Response(status=204), identity_etag(ident.id, ident.version))
         return web.Response(status=404)
 
 # _____________________________________________________________________________
@@ -538,29 +1273,31 @@ async def partialUpdateIdentity(request):
     person_id = request.match_info['personId']
     identity_id = request.match_info['identityId']
 
-    data = await request.json()
+    data = await codec.read_json(request)
     logging.info("[%s] - updateIdentity for personId [%s]/[%s]", transaction_id, person_id, identity_id)
 
     # nothing is mandatory for a patch
     msg = validate_json(data, 'Identity', with_required=False)
     if msg:
-        return web.json_response(data={'code': 400, 'message': msg}, status=400)
+        return codec.json_response(data={'code': 400, 'message': msg}, status=400)
 
     import pr.serialize
 
     async with AsyncSession(pr.aengine) as session, session.begin():
-        p = await _aget_person(session, person_id)
+        p = await _aget_person(session, person_id, pr.model.person_options(pr.model.IDENTITY_FULL))
         # get the identity from this person
         for ident in await p.awaitable_attrs.identities:
             if ident.identityId == identity_id:
                 # Check status, only in CLAIMED an update is allowed
                 if ident.status!='CLAIMED':
-                    return web.json_response(data={'code': 1, 'message': 'Illegal status of the identity - update is forbidden'}, status=403)
+                    return codec.json_response(data={'code': 1, 'message': 'Illegal status of the identity - update is forbidden'}, status=403)
+                _check_if_match(request, identity_etag(ident.id, ident.version))
                 # update the object with whatever was defined in the input
                 identity_schema = pr.serialize.IdentitySchema()
                 identity_schema.load(data, instance=ident, session=session, partial=True)
                 session.add(ident)
-                return web.Response(status=204)
+                await session.flush()
+                return _with_etag(web.Response(status=204), identity_etag(ident.id, ident.version))
         return web.Response(status=404)
 
 # _____________________________________________________________________________
@@ -574,7 +1311,7 @@ async def deleteIdentity(request):
     logging.info("[%s] - deleteIdentity for personId [%s]/[%s]", transaction_id, person_id, identity_id)
 
     async with AsyncSession(pr.aengine) as session, session.begin():
-        p = await _aget_person(session, person_id)
+        p = await _aget_person(session, person_id, pr.model.person_options(pr.model.IDENTITY_FULL))
         # get the identity from this person
         for ident in await p.awaitable_attrs.identities:
             if ident.identityId == identity_id:
@@ -594,25 +1331,31 @@ async def moveIdentity(request):
 
     logging.info("[%s] - moveIdentity [%s] from person [%s] into person [%s]", transaction_id, identity_id_source, person_id_source, person_id_target)
 
+    Identity = pr.model.Identity
     async with AsyncSession(pr.aengine) as session, session.begin():
-        p_source = await _aget_person(session, person_id_source)
-        p_target = await _aget_person(session, person_id_target)
+        await _lock_persons(session, person_id_source, person_id_target)
 
+        ident_id = await session.scalar(select(Identity.id).where(
+            Identity.personId==person_id_source, Identity.identityId==identity_id_source))
+        if ident_id is None:
+            return web.Response(status=404)
         # Check the ID
-        target_ids = set()
-        for ident in await p_target.awaitable_attrs.identities:
-            target_ids.add(ident.identityId)
-        for ident in await p_source.awaitable_attrs.identities:
-            if ident.identityId == identity_id_source:
-                if identity_id_source in target_ids:
-                    return web.Response(status=409)
-        
-                # do the move
-                ident.isReference = False
-                ident.personId = person_id_target
-                return web.Response(status=204)
+        if await _conflicting_identity(session, person_id_target, Identity.id==ident_id):
+            return web.Response(status=409)
 
-    return web.Response(status=404)
+        # do the move, the identity is added after the ones of the target
+        position = await _next_position(session, person_id_target)
+        await session.execute(sa.update(Identity)
+                              .where(Identity.id==ident_id)
+                              .values(personId=person_id_target, isReference=False, position=position,
+                                      version=Identity.version+1)
+                              .execution_options(synchronize_session=False))
+        await session.execute(sa.update(pr.model.Person)
+                              .where(pr.model.Person.personId==person_id_source, pr.model.Person.referenceIdentityId==ident_id)
+                              .values(referenceIdentityId=None, version=pr.model.Person.version+1)
+                              .execution_options(synchronize_session=False))
+        invalidate_reference(session, person_id_source, person_id_target)
+        return web.Response(status=204)
 
 
 # _____________________________________________________________________________
@@ -627,13 +1370,15 @@ async def setIdentityStatus(request):
     logging.info("[%s] - setIdentityStatus for personId [%s]/[%s]", transaction_id, person_id, identity_id)
 
     async with AsyncSession(pr.aengine) as session, session.begin():
-        p = await _aget_person(session, person_id)
+        p = await _aget_person(session, person_id, pr.model.person_options(pr.model.IDENTITY_ONLY))
         # get the identity from this person
         for ident in await p.awaitable_attrs.identities:
             if ident.identityId == identity_id:
+                _check_if_match(request, identity_etag(ident.id, ident.version))
                 ident.status = status
                 session.add(ident)
-                return web.Response(status=204)
+                await session.flush()
+                return _with_etag(web.Response(status=204), identity_etag(ident.id, ident.version))
         return web.Response(status=404)
 
 # _____________________________________________________________________________
@@ -646,27 +1391,26 @@ async def defineReference(request):
 
     logging.info("[%s] - defineReference for personId [%s]/[%s]", transaction_id, person_id, identity_id)
 
-    import pr.serialize
-
+    Identity = pr.model.Identity
     async with AsyncSession(pr.aengine) as session, session.begin():
-        p = await _aget_person(session, person_id)
-        # get the identity from this person
-        found = False
-        for ident in await p.awaitable_attrs.identities:
-            if ident.identityId == identity_id:
-                # Check status, only in VALID state an identity can be the reference
-                if ident.status!='VALID':
-                    return web.json_response(data={'code': 1, 'message': 'Illegal status of the identity - defineReference is forbidden'}, status=403)
-                found = True
-                ident.isReference = True
-                session.add(ident)
-                break
-        if not found:
+        res = await session.execute(select(Identity.id, Identity.status).where(
+            Identity.personId==person_id, Identity.identityId==identity_id))
+        ident = res.first()
+        if ident is None:
             return web.Response(status=404)
-        for ident in await p.awaitable_attrs.identities:
-            if ident.identityId != identity_id and ident.isReference:
-                ident.isReference = False
-                session.add(ident)
+        # Check status, only in VALID state an identity can be the reference
+        if ident.status!='VALID':
+            return codec.json_response(data={'code': 1, 'message': 'Illegal status of the identity - defineReference is forbidden'}, status=403)
+        # flag the new reference and unflag the previous one, then update the pointer of the person
+        await session.execute(sa.update(Identity)
+                              .where(Identity.personId==person_id, sa.or_(Identity.isReference, Identity.id==ident.id))
+                              .values(isReference=(Identity.id==ident.id), version=Identity.version+1)
+                              .execution_options(synchronize_session=False))
+        await session.execute(sa.update(pr.model.Person)
+                              .where(pr.model.Person.personId==person_id)
+                              .values(referenceIdentityId=ident.id, version=pr.model.Person.version+1)
+                              .execution_options(synchronize_session=False))
+        invalidate_reference(session, person_id)
 
     return web.Response(status=204)
 
@@ -681,15 +1425,22 @@ async def readReference(request):
 
     import pr.serialize
 
-    async with AsyncSession(pr.aengine) as session, session.begin():
-        p = await _aget_person(session, person_id)
-        # get the reference identity from this person
-        for ident in await p.awaitable_attrs.identities:
-            if ident.isReference:
-                identity_schema = pr.serialize.IdentitySchema()
-                data = identity_schema.dump(ident)
-                return web.json_response(data, status=200)
-        return web.Response(status=404)
+    Identity = pr.model.Identity
+    sel = select(Identity).join(pr.model.Person, pr.model.Person.referenceIdentityId==Identity.id)
+    sel = sel.where(pr.model.Person.personId==person_id)
+    async with AsyncSession(read_engine()) as session, session.begin():
+        if request.if_none_match:
+            row = (await session.execute(sel.with_only_columns(Identity.id, Identity.version))).first()
+            if row is None:
+                return web.Response(status=404)
+            if _is_not_modified(request, identity_etag(row.id, row.version)):
+                return _not_modified_response(identity_etag(row.id, row.version))
+        ident = (await session.execute(sel.options(*pr.model.IDENTITY_FULL))).scalars().first()
+        if ident is None:
+            # unknown person or no reference identity
+            return web.Response(status=404)
+        data = pr.serialize.IDENTITY.dump(ident)
+        return _with_etag(codec.json_response(data, status=200), identity_etag(ident.id, ident.version))
 
 # _____________________________________________________________________________
 @routes.get('/v1/galleries')
@@ -699,9 +1450,9 @@ async def readGalleries(request):
 
     logging.info("[%s] - readGalleries", transaction_id)
 
-    async with AsyncSession(pr.aengine) as session, session.begin():
+    async with AsyncSession(read_engine()) as session, session.begin():
         ret = await pr.model.Gallery.avalues(session)
-        return web.json_response(ret, status=200)
+        return codec.json_response(ret, status=200)
 
 # _____________________________________________________________________________
 @routes.get('/v1/galleries/{galleryId}')
@@ -711,12 +1462,25 @@ async def readGalleryContent(request):
     gallery_id = request.match_info['galleryId']
     offset = int(request.query.get('offset', 0))
     limit = int(request.query.get('limit', 1000))
+    cursor = request.query.get('cursor', None)
 
     logging.info("[%s] - readGalleryContent for gallery [%s]", transaction_id, gallery_id)
 
-    async with AsyncSession(pr.aengine) as session, session.begin():
-        ret = await pr.model.Gallery.aget_identities(session, gallery_id, offset, limit)
-        return web.json_response([{'personId': x.personId, 'identityId': x.identityId} for x in ret], status=200)
+    after = None
+    if cursor:
+        after = decode_cursor(cursor, [pr.model.Identity.personId, pr.model.Identity.id])
+    if accept_ndjson(request):
+        sel = pr.model.Gallery.select_identities(gallery_id, offset, limit, after)
+        sel = sel.with_only_columns(pr.model.Identity.personId, pr.model.Identity.identityId)
+        return await ndjson_response(request, sel, lambda row: dict(personId=row.personId, identityId=row.identityId))
+
+    async with AsyncSession(read_engine()) as session, session.begin():
+        ret = await pr.model.Gallery.aget_identities(session, gallery_id, offset, limit, after)
+        headers = {}
+        next_cursor = _next_cursor(ret, limit, False, None)
+        if next_cursor:
+            headers['X-Next-Cursor'] = next_cursor
+        return codec.json_response([{'personId': x.personId, 'identityId': x.identityId} for x in ret], status=200, headers=headers)
 
 # _____________________________________________________________________________
 # Services with the same URL in PR and DataAccess
@@ -729,7 +1493,7 @@ async def getPersonWithId(request):
     if names or 'transactionId' not in request.query:
         return await readPersonAttributes(id, names)
     transaction_id = request.query['transactionId']
-    return await readPerson(transaction_id, id)
+    return await readPerson(request, transaction_id, id)
 
 
 # _____________________________________________________________________________
@@ -737,91 +1501,209 @@ async def getPersonWithId(request):
 # Note: when there is no reference identity, the latest one is used
 # _____________________________________________________________________________
 
+# _____________________________________________________________________________
+# The attributes are compared with the reference identity in the database: one
+# SELECT of the requested columns, returning for each attribute NULL if it is
+# equal, 0 if the identity has no value and 1 if it is different. The values
+# are converted to the type of their column (dates...) before the comparison.
+# The attributes that are not columns (galleries, biometric data...) are
+# compared with the dump of the identity.
+# _____________________________________________________________________________
+async def _match_reference(uin, data):
+    # Return {attribute name: error code or None}, or None if there is no reference identity
+    import marshmallow
+    columns = _attribute_columns()
+    errors = {}
+    selected = []
+    for k, v in data.items():
+        if k not in columns:
+            errors[k] = 0
+            continue
+        column, field, convert = columns[k]
+        try:
+            value = field.deserialize(v)
+        except marshmallow.ValidationError:
+            value = None
+        if isinstance(column.type, sa.JSON):
+            # compared after the SELECT
+            selected.append((k, column))
+        elif value is None:
+            selected.append((k, sa.case((column.is_(None), 0), else_=1)))
+        else:
+            selected.append((k, sa.case((column.is_(None), 0), (column != value, 1))))
+    sel = select(pr.model.Identity.id, *[c.label('m%d' % i) for i, (k, c) in enumerate(selected)])
+    sel = sel.join(pr.model.Person, pr.model.Person.referenceIdentityId==pr.model.Identity.id)
+    sel = sel.where(pr.model.Person.personId==uin)
+
+    async with AsyncSession(read_engine()) as session, session.begin():
+        row = (await session.execute(sel)).first()
+    if row is None:
+        return None
+    for i, (k, c) in enumerate(selected):
+        value = row[i+1]
+        if isinstance(c, sa.Column):
+            value = 0 if value is None else (1 if value != data[k] else None)
+        errors[k] = value
+    # same order as the input
+    return {k: errors[k] for k in data}
+
+def _typed_values(name, value, expected):
+    # the value read and the expected value converted to the type of the column
+    # (e.g. 12 and "12"), as compared in SQL. marshmallow.ValidationError is
+    # raised if a value cannot be converted.
+    column = _attribute_columns().get(name)
+    if not column or isinstance(column[0].type, sa.JSON):
+        return value, expected
+    column, field, convert = column
+    value = field.deserialize(value)
+    expected = field.deserialize(expected)
+    if isinstance(value, datetime.datetime) and isinstance(expected, datetime.datetime) and \
+            (value.tzinfo is None) != (expected.tzinfo is None):
+        # SQLite keeps the date & time without the offset
+        value, expected = value.replace(tzinfo=None), expected.replace(tzinfo=None)
+    return value, expected
+
+def _is_same_value(name, value, expected):
+    # compare like _match_reference: with the type of the column
+    import marshmallow
+    try:
+        value, expected = _typed_values(name, value, expected)
+    except marshmallow.ValidationError:
+        return False
+    return value == expected
+
+def _match_attributes(attributes, data):
+    # the differences between the attributes read and the expected ones
+    ret = []
+    for k, v in data.items():
+        if k not in attributes:
+            ret.append(dict(attributeName=k, errorCode=0))
+        elif not _is_same_value(k, attributes[k], v):
+            ret.append(dict(attributeName=k, errorCode=1))
+    return ret
+
 # _____________________________________________________________________________
 @routes.post('/v1/persons/{uin}/match')
 @LM.timer("matchPersonAttributes", ok_status, "error")
 async def matchPersonAttributes(request):
     uin = request.match_info['uin']
 
-    data = await request.json()
+    data = await codec.read_json(request)
     logging.info("matchPersonAttributes for UIN [%s]", uin)
 
-    import pr.serialize
-
-    async with AsyncSession(pr.aengine) as session, session.begin():
-        p = await _aget_person(session, uin)
-        # get the reference identity from this person
-        for ident in await p.awaitable_attrs.identities:
-            if ident.isReference:
-                identity_schema = pr.serialize.IdentitySchema()
-                ident_data = identity_schema.dump(ident)
-                ret = []
-                for k, v in data.items():
-                    if k not in ident_data['biographicData'] and \
-                       k not in ident_data['contextualData'] and \
-                       k not in ident_data:
-                        ret.append(dict(attributeName=k, errorCode=0))
-                    elif k in ident_data['biographicData'] and ident_data['biographicData'][k] != v:
-                        ret.append(dict(attributeName=k, errorCode=1))
-                    elif k in ident_data['contextualData'] and ident_data['contextualData'][k] != v:
-                        ret.append(dict(attributeName=k, errorCode=1))
-                    elif k in ident_data and ident_data[k] != v:
-                        ret.append(dict(attributeName=k, errorCode=1))
-                return web.json_response(ret, status=200)
+    attributes = None
+    if all(_is_column_attribute(k) for k in data):
+        attributes = REFERENCE_CACHE.get(uin)
+        if attributes is None:
+            errors = await _match_reference(uin, data)
+            if errors is None:
+                return web.Response(status=404)
+            return codec.json_response([dict(attributeName=k, errorCode=c) for k, c in errors.items() if c is not None], status=200)
+    else:
+        attributes = await _read_reference(uin, data.keys())
+    if attributes is None:
         return web.Response(status=404)
+    return codec.json_response(_match_attributes(attributes, data), status=200)
 
 
+def _query_expressions(attributes):
+    # the query parameters are 'name=value' or 'name:operator=value' (e.g. lastName:startsWith=Do)
+    data = []
+    for k,v in attributes.items():
+        name, _, operator = k.partition(':')
+        data.append(dict(
+            attributeName=name,
+            operator=operator or '=',
+            value=v
+        ))
+    return data
+
 # _____________________________________________________________________________
 @routes.get('/v1/persons')
 @LM.timer("queryPersonList", ok_status, "error")
 async def queryPersonList(request):
     offset = int(request.query.get('offset', 0))
     limit = int(request.query.get('limit', 100))
+    cursor = request.query.get('cursor', None)
+    order_by = request.query.get('orderBy', None)
     names = request.query.getall('names', [])
     attributes = {}
     for k, v in request.query.items():
-        if k in ['names', 'offset', 'limit']:
+        if k in ['names', 'offset', 'limit', 'cursor', 'orderBy']:
             continue
         attributes[k] = v
     logging.info("queryPersonList for attributes [%s]", attributes)
 
+    columns = _attribute_columns()
+    for k in names:
+        if k not in columns:
+            return codec.json_response(dict(code=2, message="Unknown name [{}]".format(k)), status=400)
+    if not all(columns[k] for k in names):
+        # galleries, biometric data...
+        return await _query_person_list_objects(attributes, names, limit, offset, cursor, order_by)
+
+    data = _query_expressions(attributes)
+    sel = _build_predicate(data, reference=True, gallery=None, group=False, limit=limit, offset=offset, cursor=cursor, order_by=order_by)
+    if type(sel) is web.Response:
+        return sel
+
+    # only the columns of the requested attributes are read
+    selected = [pr.model.Identity.personId, pr.model.Identity.id]
+    if order_by:
+        selected.append(get_order_column(order_by))
+    for k in names:
+        if columns[k][0] not in selected:
+            selected.append(columns[k][0])
+    sel = sel.with_only_columns(*selected)
+
+    async with AsyncSession(read_engine()) as session, session.begin():
+        rows = (await session.execute(sel)).all()
+    headers = {}
+    next_cursor = _next_cursor(rows, limit, False, order_by)
+    if next_cursor:
+        headers['X-Next-Cursor'] = next_cursor
+    ret = []
+    for row in rows:
+        if not names:
+            ret.append(row.personId)
+            continue
+        obj = {}
+        for k in names:
+            column, field, convert = columns[k]
+            value = row._mapping[column]
+            if value is not None:
+                obj[k] = convert(value) if convert else value
+        ret.append(obj)
+    return codec.json_response(ret, status=200, headers=headers)
+
+async def _query_person_list_objects(attributes, names, limit, offset, cursor, order_by):
+    # queryPersonList for attributes that are not columns, read from the dump of the identities
     import pr.serialize
 
-    async with AsyncSession(pr.aengine) as session, session.begin():
-        data = []
-        for k,v in attributes.items():
-            data.append(dict(
-                attributeName=k,
-                operator='=',
-                value=v
-            ))
-        sel = _build_predicate(data, reference=True, gallery=None, group=False, limit=limit, offset=offset)
+    async with AsyncSession(read_engine()) as session, session.begin():
+        data = _query_expressions(attributes)
+        sel = _build_predicate(data, reference=True, gallery=None, group=False, limit=limit, offset=offset, cursor=cursor, order_by=order_by)
         if type(sel) is web.Response:
             return sel
 
+        if any(k in UNCACHED_ATTRIBUTES for k in names):
+            sel = sel.options(*pr.model.IDENTITY_FULL)
+        else:
+            sel = sel.options(*pr.model.IDENTITY_ATTRIBUTES)
+
         # Execute
         ret = []
-        identity_schema = pr.serialize.IdentitySchema()
+        exclude = () if any(k in UNCACHED_ATTRIBUTES for k in names) else UNCACHED_ATTRIBUTES
         result = await session.execute(sel)
-        for ident in result.scalars():
-            if not names:
-                ret.append(ident.personId)
-                continue
-            ident_data = identity_schema.dump(ident)
-            obj = {}
-            for k in names:
-                if k not in ident_data['biographicData'] and \
-                    k not in ident_data['contextualData'] and \
-                    k not in ident_data:
-                    return web.json_response(dict(code=2, message="Unknown name [{}]".format(k)), status=400)
-                if k in ident_data['biographicData']:
-                    obj[k] = ident_data['biographicData'][k]
-                elif k in ident_data['contextualData']:
-                    obj[k] = ident_data['contextualData'][k]
-                elif k in ident_data:
-                    obj[k] = ident_data[k]
-            ret.append(obj)
-        return web.json_response(ret, status=200)
+        rows = list(result.scalars())
+        headers = {}
+        next_cursor = _next_cursor(rows, limit, False, order_by)
+        if next_cursor:
+            headers['X-Next-Cursor'] = next_cursor
+        for ident in rows:
+            ident_data = _flatten_identity(pr.serialize.IDENTITY.dump(ident, exclude=exclude), names)
+            ret.append({k: ident_data[k] for k in names if k in ident_data})
+        return codec.json_response(ret, status=200, headers=headers)
 
 
 # _____________________________________________________________________________
@@ -830,59 +1712,226 @@ async def readPersonAttributes(uin, names):
     logging.info("readPersonAttributes for UIN [%s]", uin)
 
     if not names:
-        return web.json_response(dict(code=2, message="No names specified"), status=400)
-
-    import pr.serialize
+        return codec.json_response(dict(code=2, message="No names specified"), status=400)
 
-    async with AsyncSession(pr.aengine) as session, session.begin():
-        identity_schema = pr.serialize.IdentitySchema()
-        p = await _aget_person(session, uin)
-        # get the reference identity from this person
-        for ident in await p.awaitable_attrs.identities:
-            if ident.isReference:
-                ident_data = identity_schema.dump(ident)
-                obj = {}
-                for k in names:
-                    if k not in ident_data['biographicData'] and \
-                        k not in ident_data['contextualData'] and \
-                        k not in ident_data:
-                        obj[k] = dict(code=2, message="Unknown attribute name [{}]".format(k))
-                    elif k in ident_data['biographicData']:
-                        obj[k] = ident_data['biographicData'][k]
-                    elif k in ident_data['contextualData']:
-                        obj[k] = ident_data['contextualData'][k]
-                    elif k in ident_data:
-                        obj[k] = ident_data[k]
-                return web.json_response(obj, status=200)
+    attributes = await _read_reference(uin, names)
+    if attributes is None:
         return web.Response(status=404)
+    return codec.json_response(_select_attributes(attributes, names), status=200)
+
+def _select_attributes(attributes, names):
+    obj = {}
+    for k in names:
+        if k not in attributes:
+            obj[k] = dict(code=2, message="Unknown attribute name [{}]".format(k))
+        else:
+            obj[k] = attributes[k]
+    return obj
 
 # _____________________________________________________________________________
+VERIFY_OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+}
+
 @routes.post('/v1/persons/{uin}/verify')
 @LM.timer("verifyPersonAttributes", ok_status, "error")
 async def verifyPersonAttributes(request):
     uin = request.match_info['uin']
 
-    data = await request.json()
+    data = await codec.read_json(request)
     logging.info("verifyPersonAttributes for UIN [%s]", uin)
 
-    import pr.serialize
+    # the expressions are evaluated on the cached reference identity
+    msg = _check_expressions(data)
+    if msg:
+        return codec.json_response({'code':1, 'message': msg}, status=400)
 
-    async with AsyncSession(pr.aengine) as session, session.begin():
-        p = await _aget_person(session, uin)
-        
-        data.append(dict(
-            attributeName='personId',
-            operator='=',
-            value=uin
-        ))
-        sel = _build_predicate(data, reference=True, gallery=None, group=True, limit=100, offset=0)
-        if type(sel) is web.Response:
-            return sel
-        result = await session.execute(sel)
-        for ident in result.scalars():
-            # we found one
-            return web.json_response(True, status=200)
-        return web.json_response(False, status=200)
+    attributes = await _read_reference(uin)
+    return codec.json_response(_verify_attributes(uin, attributes, data), status=200)
+
+def _check_expressions(data):
+    # Return the error message of the invalid expressions of verifyPersonAttributes, or None
+    for pred in data:
+        if pred['attributeName'] != 'personId' and pred['attributeName'] not in pr.model.CUSTO_BGD:
+            return 'Unknown attribute [{}] in query expression'.format(pred['attributeName'])
+        if pred['operator'] not in VERIFY_OPERATORS:
+            return 'Invalid operator [{}] in query expression'.format(pred['operator'])
+    return None
+
+def _verify_attributes(uin, attributes, data):
+    import marshmallow
+    if attributes is None:
+        return False
+    for pred in data:
+        if pred['attributeName'] == 'personId':
+            value, expected = uin, pred['value']
+        else:
+            value = attributes.get(pred['attributeName'])
+            if value is None:
+                return False
+            try:
+                # compared with the type of the attribute (dates, numbers...)
+                value, expected = _typed_values(pred['attributeName'], value, pred['value'])
+            except marshmallow.ValidationError:
+                return False
+        try:
+            if value is None or expected is None or not VERIFY_OPERATORS[pred['operator']](value, expected):
+                return False
+        except TypeError:
+            # not comparable
+            return False
+    return True
+
+# _____________________________________________________________________________
+# Batch of Data Access requests
+# The items {uin, op, attributes} are answered with the reference identities
+# of all the persons, read with one query for the attributes that are columns
+# (or from the cache) and one query for the other attributes:
+# - read: attributes is the list of the names, as for readPersonAttributes,
+# - match: attributes is the object of the expected values, as for matchPersonAttributes,
+# - verify: attributes is the list of the expressions, as for verifyPersonAttributes.
+# The result of each item has the status of the single request.
+# _____________________________________________________________________________
+BATCH_OPERATIONS = {
+    'read': list,
+    'match': dict,
+    'verify': list,
+}
+
+def _batch_names(item):
+    # names of the attributes used by an item
+    if item['op'] == 'read':
+        return item['attributes']
+    if item['op'] == 'match':
+        return list(item['attributes'])
+    return [pred['attributeName'] for pred in item['attributes'] if pred['attributeName'] != 'personId']
+
+def _check_batch_item(item):
+    # Return the error message of an invalid item, or None
+    if not isinstance(item, dict) or not isinstance(item.get('uin'), str):
+        return 'Invalid item, uin is missing'
+    if item.get('op') not in BATCH_OPERATIONS:
+        return 'Invalid operation [{}]'.format(item.get('op'))
+    if not isinstance(item.get('attributes'), BATCH_OPERATIONS[item['op']]):
+        return 'Invalid attributes for operation [{}]'.format(item['op'])
+    if item['op'] == 'read':
+        if not item['attributes']:
+            return 'No names specified'
+        if not all(isinstance(k, str) for k in item['attributes']):
+            return 'Invalid attribute names'
+    if item['op'] == 'verify':
+        for pred in item['attributes']:
+            if not isinstance(pred, dict) or not {'attributeName', 'operator', 'value'} <= set(pred):
+                return 'Invalid expression'
+        return _check_expressions(item['attributes'])
+    return None
+
+def _batch_result(item, attributes, found):
+    uin, op = item['uin'], item['op']
+    if not found:
+        return dict(uin=uin, op=op, status=404)
+    if op == 'verify':
+        return dict(uin=uin, op=op, status=200, result=_verify_attributes(uin, attributes, item['attributes']))
+    if attributes is None:
+        return dict(uin=uin, op=op, status=404)
+    if op == 'read':
+        return dict(uin=uin, op=op, status=200, result=_select_attributes(attributes, item['attributes']))
+    return dict(uin=uin, op=op, status=200, result=_match_attributes(attributes, item['attributes']))
+
+@routes.post('/v1/persons:batch')
+@LM.timer("batchPersonAttributes", ok_status, "error")
+async def batchPersonAttributes(request):
+    data = await codec.read_json(request)
+    if not isinstance(data, list):
+        return codec.json_response({'code':1, 'message': 'A list of items is expected'}, status=400)
+    if len(data) > pr.args.batch_max_size:
+        return codec.json_response({'code':1, 'message': 'Too many items, the maximum is {}'.format(pr.args.batch_max_size)}, status=400)
+    logging.info("batchPersonAttributes for %d items", len(data))
+
+    ret = [None] * len(data)
+    # the items are grouped by the kind of attributes they use: the columns
+    # only (cached) or not
+    groups = {True: ([], set(), set()), False: ([], set(), set())}
+    for i, item in enumerate(data):
+        msg = _check_batch_item(item)
+        if msg:
+            ret[i] = dict(status=400, message=msg)
+            continue
+        names = _batch_names(item)
+        indexes, uins, group_names = groups[all(_is_column_attribute(k) for k in names)]
+        indexes.append(i)
+        uins.add(item['uin'])
+        group_names.update(names)
+
+    for indexes, uins, names in groups.values():
+        if not indexes:
+            continue
+        references = await _read_references(list(uins), list(names))
+        for i in indexes:
+            item = data[i]
+            ret[i] = _batch_result(item, references.get(item['uin']), item['uin'] in references)
+    return codec.json_response(ret, status=200)
+
+# _____________________________________________________________________________
+# The documents are streamed from the database by chunks, so that the memory
+# used by a request is bounded by the chunk size and not by the document size.
+STREAM_CHUNK_SIZE = 256*1024
+MULTIPART_BOUNDARY = '**xx**BOUNDARY**xx**'
+
+async def _read_part(engine, part_id, start, stop):
+    # read the bytes [start, stop[ of the data of a document part
+    # Each chunk is read with its own connection, returned to the pool while
+    # the chunk is written: a slow client does not hold a connection.
+    while start < stop:
+        sel = select(sa.func.substr(pr.model.DocumentPart.data, start+1, min(STREAM_CHUNK_SIZE, stop-start)))
+        async with AsyncSession(engine) as session, session.begin():
+            chunk = await session.scalar(sel.where(pr.model.DocumentPart.id==part_id))
+        if not chunk:
+            break
+        yield chunk
+        start += len(chunk)
+
+async def _read_file(path):
+    # read a file from the blob store by chunks
+    loop = asyncio.get_running_loop()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = await loop.run_in_executor(None, f.read, STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+async def _read_buffer(data):
+    yield data
+
+def _is_range_ignored(request):
+    # multiple ranges, other unit...: the header is ignored (RFC 9110 14.2)
+    if 'Range' not in request.headers:
+        return False
+    try:
+        request.http_range
+    except ValueError:
+        return True
+    return False
+
+def _get_range(request, size):
+    # return the range [start, stop[ requested, None if it cannot be satisfied
+    if _is_range_ignored(request):
+        return 0, size
+    rng = request.http_range
+    start = rng.start or 0
+    if start < 0:
+        # suffix range (bytes=-N)
+        start = max(size+start, 0)
+    stop = size if rng.stop is None else min(rng.stop, size)
+    if start >= stop:
+        return None
+    return start, stop
 
 # _____________________________________________________________________________
 @routes.get('/v1/persons/{uin}/document')
@@ -894,58 +1943,104 @@ async def readDocument(request):
 
     sec_uin = request.query.get('secondaryUin', None)
     if sec_uin:
-        return web.json_response(dict(code=3, message="readDocument: secondaryUin is not supported"), status=400)
+        return codec.json_response(dict(code=3, message="readDocument: secondaryUin is not supported"), status=400)
 
     doctype = request.query.get('doctype', None)
     format = request.query.get('format', None)
     if not doctype or not format or not format in ['pdf', 'jpeg', 'png']:
-        return web.json_response(dict(code=4, message="readDocument: incorrect parameters for doctype or format"), status=400)
+        return codec.json_response(dict(code=4, message="readDocument: incorrect parameters for doctype or format"), status=400)
 
     mtype_map = {
         'pdf': 'application/pdf',
         'jpeg': 'image/jpeg',
         'png': 'image/png',
     }
-    import pr.serialize
 
-    mime_parts = []
-    async with AsyncSession(pr.aengine) as session, session.begin():
-        p = await _aget_person(session, uin)
-        # get the reference identity from this person
-        for ident in await p.awaitable_attrs.identities:
-            if ident.isReference:
-                # loop therough the documents
-                for doc in ident.documentData:
-                    if doc.documentType==doctype or \
-                    (doc.documentType=='OTHER' and doc.documentTypeOther==doctype):
-                        # we found the doc
-                        for part in doc.parts:
-                            if part.data and part.mimeType==mtype_map[format]:
-                                mime_parts.append( (part.data, part.mimeType, None))
-                            elif part.dataRef and part.mimeType==mtype_map[format]:
-                                mime_parts.append( (None, part.mimeType, part.dataRef))
+    DocumentPart = pr.model.DocumentPart
+    DocumentData = pr.model.DocumentData
+    # the parts of the documents of the reference identity, without their data
+    sel = select(DocumentPart.id, DocumentPart.mimeType, DocumentPart.dataRef, DocumentPart.dataHash,
+                 sa.func.length(DocumentPart.data).label('size'))
+    sel = sel.join(DocumentData).join(pr.model.Person, pr.model.Person.referenceIdentityId==DocumentData.identity_id)
+    sel = sel.where(pr.model.Person.personId==uin,
+                    DocumentPart.mimeType==mtype_map[format],
+                    sa.or_(DocumentData.documentType==doctype,
+                           sa.and_(DocumentData.documentType=='OTHER', DocumentData.documentTypeOther==doctype)))
+    sel = sel.order_by(DocumentData.id, DocumentPart.id)
+
+    # the connection is released before the data is streamed (see _read_part)
+    engine = read_engine()
+    async with AsyncSession(engine) as session, session.begin():
+        mime_parts = [row for row in (await session.execute(sel)).all() if row.size or row.dataHash or row.dataRef]
 
     if len(mime_parts)==1:
         # not exactly in the specs but more convenient to use like that
-        if mime_parts[0][0]:
-            return web.Response(status=200, body=mime_parts[0][0], content_type=mime_parts[0][1])
-        else:
-            # redirect
-            raise web.HTTPFound(mime_parts[0][2])
+        part = mime_parts[0]
+        if part.size:
+            rng = _get_range(request, part.size)
+            if rng is None:
+                return web.Response(status=416, headers={'Content-Range': 'bytes */{}'.format(part.size)})
+            start, stop = rng
+            resp = web.StreamResponse(status=200, headers={'Content-Type': part.mimeType, 'Accept-Ranges': 'bytes'})
+            if stop-start < part.size:
+                resp.set_status(206)
+                resp.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop-1, part.size)
+            resp.content_length = stop-start
+            await resp.prepare(request)
+            async for chunk in _read_part(engine, part.id, start, stop):
+                await resp.write(chunk)
+            await resp.write_eof()
+            return resp
+        if part.dataHash:
+            path = pr.blob_store.path(part.dataHash)
+            if path and _is_range_ignored(request):
+                # sent without sendfile: aiohttp would answer 416
+                resp = web.StreamResponse(status=200, headers={'Content-Type': part.mimeType, 'Accept-Ranges': 'bytes'})
+                resp.content_length = os.path.getsize(path)
+                await resp.prepare(request)
+                async for chunk in _read_file(path):
+                    await resp.write(chunk)
+                await resp.write_eof()
+                return resp
+            if path:
+                # sent with sendfile, with the support of Range
+                return web.FileResponse(path, headers={'Content-Type': part.mimeType})
+            return web.Response(status=200, body=pr.blob_store.get(part.dataHash), content_type=part.mimeType)
+        # redirect
+        raise web.HTTPFound(part.dataRef)
+
     if len(mime_parts)>1:
         resp = web.StreamResponse(status=200,
             headers={
-                'Content-Type': 'multipart/mixed; boundary=**xx**BOUNDARY**xx**'
+                'Content-Type': 'multipart/mixed; boundary=' + MULTIPART_BOUNDARY
             })
         await resp.prepare(request)
 
-        mpwriter = aiohttp.MultipartWriter('mixed', boundary='**xx**BOUNDARY**xx**')
-        for p in mime_parts:
-            if p[0]:
-                mpwriter.append(p[0], {'Content-Type': p[1]})
+        # the parts are written one after the other, by chunks
+        for part in mime_parts:
+            if part.size:
+                headers = {'Content-Type': part.mimeType, 'Content-Length': part.size}
+                chunks = _read_part(engine, part.id, 0, part.size)
+            elif part.dataHash and pr.blob_store.path(part.dataHash):
+                path = pr.blob_store.path(part.dataHash)
+                headers = {'Content-Type': part.mimeType, 'Content-Length': os.path.getsize(path)}
+                chunks = _read_file(path)
+            elif part.dataHash:
+                data = pr.blob_store.get(part.dataHash)
+                headers = {'Content-Type': part.mimeType, 'Content-Length': len(data)}
+                chunks = _read_buffer(data)
             else:
-                mpwriter.append(p[2], {"Content-Type":"text/uri-list", "location": p[2]})
-        await mpwriter.write(resp)
+                data = part.dataRef.encode('utf-8')
+                headers = {'Content-Type': 'text/uri-list', 'Location': part.dataRef, 'Content-Length': len(data)}
+                chunks = _read_buffer(data)
+            head = '--' + MULTIPART_BOUNDARY + '\r\n'
+            head += ''.join('{}: {}\r\n'.format(k, v) for k, v in headers.items())
+            await resp.write((head + '\r\n').encode('utf-8'))
+            async for chunk in chunks:
+                await resp.write(chunk)
+            await resp.write(b'\r\n')
+        await resp.write(('--' + MULTIPART_BOUNDARY + '--\r\n').encode('utf-8'))
+        await resp.write_eof()
         return resp
 
     return web.Response(status=404)
@@ -956,26 +2051,218 @@ async def readDocument(request):
 #
 
 # _____________________________________________________________________________
-def gauge_nb_persons():
-    if not pr.engine:
-        return 0
-    with Session(pr.engine) as session, session.begin():
-        return session.query(pr.model.Person).count()
-LM.gauge('nb_persons', gauge_nb_persons)
+# Counters of the persons, identities and biometric data
+# They are kept up to date by the write paths: the objects inserted and deleted
+# are counted when the session is flushed and the counters are updated when the
+# transaction is committed. They are reconciled with the database by a
+# background task (--counters-refresh), so that a scrape never queries the
+# database. On PostgreSQL, the reconciliation uses the estimates of the
+# statistics instead of counting the rows.
+COUNTED = {
+    pr.model.Person: 'nb_persons',
+    pr.model.Identity: 'nb_identities',
+    pr.model.BiometricData: 'nb_biometricdata',
+}
+COUNTERS = {name: 0 for name in COUNTED.values()}
+# the objects inserted less the objects deleted by this process since it started
+COUNTER_DELTAS = {name: 0 for name in COUNTED.values()}
+
+def count_objects(session, cls, delta):
+    # to be used by the services inserting or deleting without the ORM (bulk insert/delete)
+    deltas = session.info.setdefault('counters', {})
+    deltas[COUNTED[cls]] = deltas.get(COUNTED[cls], 0) + delta
+
+@sa.event.listens_for(Session, 'after_flush')
+def _count_flushed_objects(session, flush_context):
+    for obj in session.new:
+        if type(obj) in COUNTED:
+            count_objects(session, type(obj), 1)
+    # the deleted objects include the orphans, not listed in session.deleted
+    for state, (isdelete, listonly) in flush_context.states.items():
+        if isdelete and not listonly and state.class_ in COUNTED:
+            count_objects(session, state.class_, -1)
+
+@sa.event.listens_for(Session, 'after_commit')
+def _update_counters(session):
+    for name, delta in session.info.pop('counters', {}).items():
+        COUNTERS[name] += delta
+        COUNTER_DELTAS[name] += delta
+
+@sa.event.listens_for(Session, 'after_rollback')
+def _forget_counters(session):
+    session.info.pop('counters', None)
+
+def _count_statement(session, cls):
+    if session.bind.dialect.name == 'postgresql':
+        # the estimate of the planner statistics: no scan of the table (-1 if
+        # the table was never analyzed). The counters are then approximate.
+        return sa.text("SELECT CASE WHEN reltuples >= 0 THEN reltuples::bigint END FROM pg_class "
+                       "WHERE oid = to_regclass(:name)").bindparams(name='"{}"'.format(cls.__tablename__))
+    return None
+
+async def count_rows(read_deltas):
+    """
+    Return ({counter name: number of rows}, {counter name: delta}) where the
+    deltas (returned by read_deltas) are the same before and after the rows are
+    counted, or None if objects were committed meanwhile (to be retried).
+    """
+    before = await read_deltas()
+    counts = {}
+    async with AsyncSession(pr.aengine) as session, session.begin():
+        for cls, name in COUNTED.items():
+            estimate = _count_statement(session, cls)
+            count = await session.scalar(estimate) if estimate is not None else None
+            if count is None:
+                count = await session.scalar(select(sa.func.count()).select_from(cls))
+            counts[name] = count
+    after = await read_deltas()
+    if before is None or before != after:
+        return None
+    return counts, before
+
+async def _read_deltas():
+    return dict(COUNTER_DELTAS)
+
+async def reconcile_counters():
+    """Return False if the counters could not be reconciled, to be retried"""
+    if not pr.aengine:
+        return True
+    ret = await count_rows(_read_deltas)
+    if ret is None:
+        return False
+    COUNTERS.update(ret[0])
+    return True
+
+async def refresh_counters(reconcile, done=True):
+    # reconcile the counters every --counters-refresh seconds, or after 1
+    # second when they could not be reconciled
+    while done is False or pr.args.counters_refresh > 0:
+        await asyncio.sleep(pr.args.counters_refresh if done else 1)
+        try:
+            done = await reconcile()
+        except Exception as exc:
+            logging.warning("Cannot reconcile the counters: [%s]", str(exc))
+            done = True
+
+COUNTERS_TASK = web.AppKey('counters_task', asyncio.Task)
+
+async def start_counters(app):
+    if WORKER_MONITORING_PATH:
+        # the counters are owned by the main process, adding the deltas of
+        # the workers (see pr.workers)
+        for name in COUNTER_DELTAS:
+            LM.gauge(name+'_delta', lambda name=name: COUNTER_DELTAS[name])
+        return
+    app[COUNTERS_TASK] = asyncio.create_task(refresh_counters(reconcile_counters, await reconcile_counters()))
+
+async def stop_counters(app):
+    if COUNTERS_TASK in app:
+        app[COUNTERS_TASK].cancel()
+
+LM.gauge('nb_persons', lambda: COUNTERS['nb_persons'])
+LM.gauge('nb_identities', lambda: COUNTERS['nb_identities'])
+LM.gauge('nb_biometricdata', lambda: COUNTERS['nb_biometricdata'])
 
 # _____________________________________________________________________________
-def gauge_nb_identities():
-    if not pr.engine:
-        return 0
-    with Session(pr.engine) as session, session.begin():
-        return session.query(pr.model.Identity).count()
-LM.gauge('nb_identities', gauge_nb_identities)
+LM.gauge('reference_cache_hit_rate', lambda: REFERENCE_CACHE.hit_rate)
+LM.gauge('reference_cache_evictions', lambda: REFERENCE_CACHE.evictions)
+LM.gauge('reference_cache_size', lambda: len(REFERENCE_CACHE))
 
 # _____________________________________________________________________________
-def gauge_nb_biometricdata():
-    if not pr.engine:
-        return 0
-    with Session(pr.engine) as session, session.begin():
-        return session.query(pr.model.BiometricData).count()
-LM.gauge('nb_biometricdata', gauge_nb_biometricdata)
+def _pool_stat(name):
+    # the in-memory databases use pools without these statistics
+    pool = pr.aengine.pool if pr.aengine else None
+    return getattr(pool, name, lambda: 0)()
+
+LM.gauge('db_pool_size', lambda: _pool_stat('size'))
+LM.gauge('db_pool_checkedout', lambda: _pool_stat('checkedout'))
+LM.gauge('db_pool_overflow', lambda: _pool_stat('overflow'))
+LM.gauge('db_replicas_healthy', lambda: REPLICAS.nb_healthy)
+
+# _____________________________________________________________________________
+# Warm-up
+# The work otherwise done by the first requests (import of the serializers,
+# configuration of the mappers, validators, compilation of the statements,
+# connections of the pools) is done when the server starts. The server is
+# not ready until then.
+# _____________________________________________________________________________
+WARMUP_TASK = web.AppKey('warmup_task', asyncio.Task)
+# a personId that does not exist, used to run the statements of the services
+WARMUP_PERSON_ID = '__warmup__'
 
+async def _open_connections(engine, n):
+    # open n connections at the same time: they are kept in the pool
+    connections = []
+    try:
+        for i in range(n):
+            conn = await engine.connect()
+            connections.append(conn)
+            await conn.execute(sa.text('SELECT 1'))
+    finally:
+        for conn in connections:
+            await conn.close()
+
+async def _prime_reference_cache(n):
+    Person = pr.model.Person
+    sel = select(Person.personId).where(Person.referenceIdentityId.is_not(None)).limit(n)
+    async with AsyncSession(read_engine()) as session, session.begin():
+        uins = list(await session.scalars(sel))
+    for i in range(0, len(uins), pr.args.batch_max_size):
+        await _read_references(uins[i:i+pr.args.batch_max_size])
+    logging.info("%d reference identities loaded in the cache", len(uins))
+
+async def warm_up():
+    import pr.serialize
+
+    sa.orm.configure_mappers()
+    _attribute_columns()
+    setup_validators()
+    for v in list(VALIDATORS.values()) + list(PARTIAL_VALIDATORS.values()):
+        v.is_valid({})
+
+    # the connections are opened for the pool size only: the overflow
+    # connections are closed when they are returned to the pool
+    n = min(pr.args.warmup_connections, pr.args.db_pool_size)
+    if n > 0 and pr.aengine:
+        await asyncio.gather(*[_open_connections(engine, n) for engine in [pr.aengine] + pr.areplicas])
+
+    if pr.aengine:
+        # compile and cache the statements of the reads
+        await _read_references([WARMUP_PERSON_ID])
+        await _read_references([WARMUP_PERSON_ID], ['biometricData'])
+        async with AsyncSession(read_engine()) as session, session.begin():
+            await pr.model.Person.afind_by_id(session, WARMUP_PERSON_ID, pr.model.person_options(pr.model.IDENTITY_FULL))
+
+        n = min(pr.args.warmup_reference_cache, REFERENCE_CACHE.size)
+        if n > 0:
+            await _prime_reference_cache(n)
+
+# Delay (in seconds) before a failed warm-up is retried
+WARMUP_RETRY_DELAY = 1.
+
+async def _warm_up():
+    # the server is not ready until the warm-up succeeds (e.g. the database
+    # may not be available yet)
+    start = time.perf_counter()
+    while True:
+        try:
+            await warm_up()
+            break
+        except Exception as exc:
+            STARTUP['warmup_failures'] += 1
+            logging.warning("Warm-up failed, retried in %.1f s: [%s]", WARMUP_RETRY_DELAY, str(exc))
+        await asyncio.sleep(WARMUP_RETRY_DELAY)
+    STARTUP['warmup_duration'] = time.perf_counter() - start
+    STARTUP['ready'] = True
+    logging.info("Warm-up done in %.3f s", STARTUP['warmup_duration'])
+
+async def start_warmup(app):
+    app[WARMUP_TASK] = asyncio.create_task(_warm_up())
+
+async def stop_warmup(app):
+    if WARMUP_TASK in app:
+        app[WARMUP_TASK].cancel()
+
+LM.gauge('warmup_duration', lambda: STARTUP['warmup_duration'])
+LM.gauge('warmup_failures', lambda: STARTUP['warmup_failures'])
+LM.gauge('time_to_first_fast_request', lambda: STARTUP['first_fast_request'])
@@ -0,0 +1,352 @@
+import os
+import sys
+import json
+import math
+import signal
+import shutil
+import time
+import logging
+import asyncio
+import tempfile
+
+import aiohttp
+from aiohttp import web
+
+import livemetrics.publishers.aiohttp
+
+import pr
+import pr.model
+import pr.cache
+
+#______________________________________________________________________________
+# Pre-fork serving mode
+# N worker processes run the aiohttp application and share the listening port
+# (SO_REUSEPORT). When a monitoring port is defined, each worker exposes its
+# metrics on a Unix socket and a monitoring process publishes the aggregation
+# of the metrics of all the workers on the monitoring port.
+# The main process restarts the processes which exit, and shares the
+# invalidations of the reference caches of the workers (pr.cache.SharedVersions).
+#______________________________________________________________________________
+
+# How the gauges of the workers are aggregated. Default is the sum.
+GAUGE_AGGREGATES = {
+    'reference_cache_hit_rate': lambda values: sum(values) / len(values),
+    # the slowest worker
+    'warmup_duration': max,
+    'time_to_first_fast_request': max,
+}
+
+def merge_meters(meters):
+    """Merge the meters of the workers: counts and rates are summed"""
+    ret = {}
+    for m in meters:
+        for event, results in m.items():
+            for result, values in results.items():
+                r = ret.setdefault(event, {}).setdefault(result, {})
+                for k, v in values.items():
+                    r[k] = r.get(k, 0) + v
+    return ret
+
+def merge_gauges(gauges):
+    """Merge the gauges of the workers, using GAUGE_AGGREGATES"""
+    ret = {}
+    names = {name for g in gauges for name in g}
+    for name in names:
+        aggregate = GAUGE_AGGREGATES.get(name, sum)
+        values = [g[name] for g in gauges if name in g]
+        ret[name] = {k: aggregate([v[k] for v in values]) for k in values[0]}
+    return ret
+
+def _merge_histogram(values):
+    values = [v for v in values if v['count'] > 0]
+    if not values:
+        return dict(count=0, min=0, max=0, mean=0, stddev=0, quantiles={}, distribution=[])
+    count = sum(v['count'] for v in values)
+    mean = sum(v['count'] * v['mean'] for v in values) / count
+    # pooled standard deviation
+    stddev = math.sqrt(sum(v['count'] * (v['stddev']**2 + (v['mean']-mean)**2) for v in values) / count)
+    low = min(v['min'] for v in values)
+    high = max(v['max'] for v in values)
+    # the quantiles of the workers are weighted by their number of values (approximation)
+    quantiles = {p: sum(v['count'] * v['quantiles'][p] for v in values) / count for p in values[0]['quantiles']}
+    # the buckets of the workers are moved to the buckets of the global range
+    size = max(len(v['distribution']) for v in values)
+    distribution = [0] * size
+    for v in values:
+        step = (v['max'] - v['min']) / len(v['distribution'])
+        for i, n in enumerate(v['distribution']):
+            x = v['min'] + (i+0.5) * step
+            j = int((x - low) / (high - low) * size) if high > low else 0
+            distribution[min(j, size-1)] += n
+    return dict(count=count, min=low, max=high, mean=mean, stddev=stddev, quantiles=quantiles, distribution=distribution)
+
+def merge_histograms(histograms):
+    """Merge the histograms of the workers"""
+    names = {name for h in histograms for name in h}
+    return {name: _merge_histogram([h[name] for h in histograms if name in h]) for name in names}
+
+
+class AggregatedMetrics:
+    """
+    Expose the aggregated metrics of the workers with the interface of
+    livemetrics.LiveMetrics used by the livemetrics publishers.
+    The metrics must be fetched from the workers (refresh) before being read.
+    """
+    def __init__(self, LM, paths):
+        self.version = LM.version
+        self.about = LM.about
+        self.paths = paths
+        self.meters = {}
+        self.gauges = {}
+        self.histograms = {}
+        # {counter name: number of rows not counted in the deltas of the workers}
+        self.counter_bases = {}
+        # number of workers answering the last refresh
+        self.nb_available = 0
+
+    async def _get(self, path, url, params=None):
+        try:
+            async with aiohttp.ClientSession(connector=aiohttp.UnixConnector(path=path),
+                                             timeout=aiohttp.ClientTimeout(total=5)) as session:
+                async with session.get('http://worker'+url, params=params) as r:
+                    if r.status != 200:
+                        return None
+                    if r.content_type == 'application/json':
+                        return await r.json()
+                    return await r.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            logging.warning("Worker [%s] not available: %s", path, str(exc))
+            return None
+
+    async def _get_all(self, url, params=None):
+        return await asyncio.gather(*[self._get(path, url, params) for path in self.paths])
+
+    async def refresh(self, params=None):
+        # the query parameters of the histograms are forwarded to the workers
+        meters, gauges, histograms = await asyncio.gather(
+            self._get_all('/monitoring/v1/metrics/meters'),
+            self._get_all('/monitoring/v1/metrics/gauges'),
+            self._get_all('/monitoring/v1/metrics/histograms', params))
+        self.meters = merge_meters([m for m in meters if m is not None])
+        self.gauges = merge_gauges([g for g in gauges if g is not None])
+        self.nb_available = sum(g is not None for g in gauges)
+        self.histograms = merge_histograms([h for h in histograms if h is not None])
+        for name, base in self.counter_bases.items():
+            value = base + self._counter_delta(name)
+            self.gauges[name] = dict(min=value, max=value, count=value)
+
+    # The counters of the database (nb_persons...) are owned by the monitoring
+    # process: each worker publishes the number of objects it inserted less
+    # the number of objects it deleted since it started (nb_persons_delta...),
+    # the counter is the sum of these deltas and of a base reconciled with the
+    # database (--counters-refresh).
+    def _counter_delta(self, name):
+        return self.gauges.get(name+'_delta', {}).get('count', 0)
+
+    async def _read_deltas(self):
+        import pr.server
+        await self.refresh()
+        if self.nb_available < len(self.paths):
+            return None
+        return {name: self._counter_delta(name) for name in pr.server.COUNTERS}
+
+    async def reconcile_counters(self):
+        """Return False if the counters could not be reconciled, to be retried"""
+        import pr.server
+        ret = await pr.server.count_rows(self._read_deltas)
+        if ret is None:
+            return False
+        counts, deltas = ret
+        self.counter_bases = {name: counts[name] - deltas[name] for name in counts}
+        return True
+
+    async def is_healthy(self):
+        return all(r is not None for r in await self._get_all('/monitoring/v1/is_healthy'))
+
+    async def is_ready(self):
+        return all(r is not None for r in await self._get_all('/monitoring/v1/is_ready'))
+
+    def get_metrics(self, event=None, result=None, metric=None):
+        if event:
+            meters = self.meters.get(event, {})
+            if result:
+                meter = meters.get(result, dict(mean=0, count=0, rate1=0, rate5=0, rate15=0))
+                return meter[metric] if metric else meter
+            if metric:
+                raise SyntaxError('if metric is specified, result must also be specified')
+            return meters
+        if metric or result:
+            raise SyntaxError('if metric/result is specified, event must also be specified')
+        return self.meters
+
+    def get_gauges(self, name=None, metric=None):
+        if name:
+            gauge = self.gauges.get(name, dict(min=0, max=0, count=0))
+            return gauge[metric] if metric else gauge
+        return self.gauges
+
+    def get_histograms(self, event=None, metric=None, percentiles=None, scale=None):
+        if event:
+            histogram = self.histograms.get(event) or _merge_histogram([])
+            return histogram[metric] if metric else histogram
+        return self.histograms
+
+    def get_openmetrics(self, is_ready, is_healthy):
+        info = {'name': self.about}
+        info.update(json.loads(self.version))
+        s = ["# TYPE about gauge",
+             "about 0",
+             "about_info{"+",".join("%s=\"%s\"" % (k, str(v)) for k, v in info.items())+"} 1",
+             "# TYPE is_ready gauge",
+             "is_ready " + ('1' if is_ready else '0'),
+             "# TYPE is_healthy gauge",
+             "is_healthy " + ('1' if is_healthy else '0')]
+        for name, g in self.gauges.items():
+            s.append(f"# TYPE {name} gauge")
+            s.append(f"{name} {g['count']}")
+        for event, d in self.meters.items():
+            for result, m in d.items():
+                s.append(f"# TYPE {event}_{result}_total counter")
+                s.append(f"{event}_{result}_total {m['count']}")
+        for event, h in self.histograms.items():
+            s.append(f"# TYPE {event} histogram")
+            for p, val in sorted(h['quantiles'].items(), key=lambda x: float(x[0])):
+                s.append(f'{event}_bucket{{le="{p}"}} {val:.3e}')
+            s.append(f'{event}_bucket{{le="+Inf"}} {h["max"]:.3e}')
+            s.append(f"{event}_count {h['count']}")
+        return '\n'.join(s)
+
+
+COUNTERS_TASK = web.AppKey('counters_task', asyncio.Task)
+
+def get_monitoring_app(LM, paths):
+    import pr.server
+    metrics = AggregatedMetrics(LM, paths)
+
+    @web.middleware
+    async def refresh_middleware(request, handler):
+        if request.path == '/metrics':
+            await metrics.refresh()
+        elif request.path.startswith('/monitoring/v1/metrics/'):
+            await metrics.refresh(request.query)
+        return await handler(request)
+
+    def reconcile(*args):
+        # the workers are starting
+        if COUNTERS_TASK in app:
+            app[COUNTERS_TASK].cancel()
+        app[COUNTERS_TASK] = asyncio.create_task(pr.server.refresh_counters(metrics.reconcile_counters, False))
+
+    async def start_counters(app):
+        reconcile()
+        # the deltas of a restarted worker are lost (see serve)
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, reconcile)
+
+    async def stop_counters(app):
+        app[COUNTERS_TASK].cancel()
+        await pr.aengine.dispose()
+
+    app = web.Application(middlewares=[refresh_middleware])
+    app.add_routes(livemetrics.publishers.aiohttp.routes(metrics))
+    app.on_startup.append(start_counters)
+    app.on_cleanup.append(stop_counters)
+    return app
+
+# _____________________________________________________________________________
+def _create_engines():
+    # the connections of the main process must not be used by its children
+    if pr.engine:
+        pr.engine.dispose(close=False)
+    pr.engine, pr.aengine = pr.model.create_engines(pr.args.database_url)
+    pr.areplicas = pr.model.create_replica_engines(pr.args.database_replica_url)
+
+def _run_worker(monitoring_path):
+    import pr.server
+    pr.server.WORKER_MONITORING_PATH = monitoring_path
+    _create_engines()
+    app = pr.server.get_app()
+    logging.info('Starting worker %d...', os.getpid())
+    web.run_app(app, host=pr.args.ip, port=pr.args.port, access_log=None, print=None,
+                ssl_context=pr.server.get_ssl_context(), reuse_port=True)
+    logging.info('Closing worker %d...', os.getpid())
+    asyncio.run(pr.aengine.dispose())
+
+def _run_monitoring(paths):
+    import pr.server
+    _create_engines()
+    logging.info('Starting monitoring %d...', os.getpid())
+    web.run_app(get_monitoring_app(pr.server.LM, paths), host=pr.args.ip, port=pr.args.monitoring_port,
+                access_log=None, print=None)
+
+def _fork(target, *args):
+    pid = os.fork()
+    if pid:
+        return pid
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # until the monitoring process handles it
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    code = 0
+    try:
+        target(*args)
+    except BaseException:
+        logging.exception("Process %d failed", os.getpid())
+        code = 1
+    finally:
+        os._exit(code)
+
+# Delay before a process which exited is restarted
+RESTART_DELAY = 1.
+
+def serve():
+    import pr.server
+    if pr.model.is_memory_database(pr.args.database_url):
+        raise Exception("The workers must share the database: in-memory databases cannot be used with --workers")
+    if pr.args.do_not_start:
+        logging.warning('Not starting the application')
+        return
+    aggregated = pr.args.monitoring_port > 0 and pr.args.monitoring_port != pr.args.port
+    if not aggregated:
+        logging.warning('No monitoring port: the metrics are published by each worker')
+    pr.server.REFERENCE_CACHE.shared = pr.cache.SharedVersions()
+
+    directory = tempfile.mkdtemp(prefix='pr-')
+    paths = [os.path.join(directory, 'worker-%d.sock' % i) for i in range(pr.args.workers)]
+    # {pid: (function, arguments)} of the processes
+    processes = {}
+    def start(target, *args):
+        processes[_fork(target, *args)] = (target, args)
+
+    logging.info('Starting %d workers...', pr.args.workers)
+    for path in paths:
+        start(_run_worker, path if aggregated else None)
+    monitoring = None
+    if aggregated:
+        start(_run_monitoring, paths)
+        monitoring = next(reversed(processes))
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        while True:
+            pid, status = os.wait()
+            target, args = processes.pop(pid)
+            logging.error('Process %d exited with code %d, restarting it...', pid, os.waitstatus_to_exitcode(status))
+            time.sleep(RESTART_DELAY)
+            start(target, *args)
+            if pid == monitoring:
+                monitoring = next(reversed(processes))
+            elif monitoring:
+                os.kill(monitoring, signal.SIGUSR1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logging.info('Closing workers...')
+        for pid in processes:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in processes:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        shutil.rmtree(directory, ignore_errors=True)
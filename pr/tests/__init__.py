@@ -63,7 +63,11 @@ class TestPR(unittest.TestCase):
         if LOOP: return
         cls.t = threading.Thread(target=run_server, args=(runner(),), daemon=True)
         cls.t.start()
-        time.sleep(0.2)
+        # the server is ready when its warm-up is done
+        for i in range(100):
+            time.sleep(0.1)
+            if LOOP and pr.server.STARTUP['ready']:
+                break
 
     @classmethod
     def tearDownClass(cls):
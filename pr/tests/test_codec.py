@@ -0,0 +1,35 @@
+import unittest
+
+import requests
+
+import pr.codec
+
+from . import TestPR
+
+#_______________________________________________________________________________
+class TestCodec(TestPR):
+    def test_codecs(self):
+        data = {'firstName': 'Jöhn', 'pages': [1, 2], 'height': 1.82, 'valid': True, 'ref': None}
+        for name, (dumps, loads) in pr.codec.CODECS.items():
+            assert isinstance(dumps(data), bytes), name
+            assert data == loads(dumps(data)), name
+            assert data == loads(dumps(data).decode('utf-8')), name
+
+    def test_select(self):
+        current = pr.codec.dumps, pr.codec.loads
+        try:
+            # the services work with all the codecs
+            for name in pr.codec.CODECS:
+                pr.codec.setup(name)
+                with requests.post(self.url+'v1/persons', json=[{'attributeName': 'lastName', 'operator': '=', 'value': 'Nobody'}], params={'transactionId': 'TCODEC'}) as r:
+                    assert 200 == r.status_code
+                    assert [] == r.json()
+            # unknown codec: json is used
+            pr.codec.setup('unknown')
+            assert pr.codec.CODECS['json'][0] == pr.codec.dumps
+        finally:
+            pr.codec.dumps, pr.codec.loads = current
+
+
+if __name__ == '__main__':
+    unittest.main(argv=['-v'])
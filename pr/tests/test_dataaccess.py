@@ -114,6 +114,45 @@ class TestDataAccess(TestPR):
                 {'attributeName':'missing', 'errorCode': 0},
             ]
 
+    def test_matchPersonAttributes_types(self):
+        data = {
+            "status":"VALID",
+            "identityType": "TEST",
+            "galleries":["TESTA"],
+            "biographicData": {
+                "firstName": "JohnA",
+                "lastName": "Doo",
+                "dateOfBirth": "1985-01-31",
+                "fInteger32": 12,
+                "fBoolean": True,
+            },
+            "contextualData": {
+                "operationDateTime": "2020-03-01T12:30:45+00:00",
+                "device": {"name": "D1"},
+            }
+        }
+        with requests.post(self.url+'v1/persons/DA001-1/identities/002', json=data, params={'transactionId': 'T000DA1'},**get_ssl_context()) as r:
+            assert 201 == r.status_code
+        with requests.put(self.url+'v1/persons/DA001-1/identities/002/reference', params={'transactionId': 'T000DA1'},**get_ssl_context()) as r:
+            assert 204 == r.status_code
+
+        for data, expected in [
+            (dict(firstName="JohnA", dateOfBirth="1985-01-31", fInteger32=12, fBoolean=True, status="VALID",
+                  identityId="002", operationDateTime="2020-03-01T12:30:45+00:00", device={"name": "D1"}), []),
+            (dict(dateOfBirth="1985-01-30", fInteger32=13, fBoolean=False, status="INVALID", device={"name": "D2"}),
+                [{'attributeName': k, 'errorCode': 1} for k in ['dateOfBirth', 'fInteger32', 'fBoolean', 'status', 'device']]),
+            # values that cannot be converted to the type of the column
+            (dict(dateOfBirth="31/01/1985", fInteger32="twelve", status="UNKNOWN"),
+                [{'attributeName': k, 'errorCode': 1} for k in ['dateOfBirth', 'fInteger32', 'status']]),
+            (dict(fByte="Qnl0ZQ==", unknown=None, fNumberFloat=1.),
+                [{'attributeName': k, 'errorCode': 0} for k in ['fByte', 'unknown', 'fNumberFloat']]),
+            # not a column
+            (dict(galleries=["TESTA"], lastName="Doe"), [{'attributeName': 'lastName', 'errorCode': 1}]),
+        ]:
+            with requests.post(self.url+'v1/persons/DA001-1/match', json=data, **get_ssl_context()) as r:
+                assert 200 == r.status_code
+                assert expected == r.json(), data
+
     def test_queryPersonList(self):
         # good query, but no candidate
         with requests.get(self.url+'v1/persons', params={'firstName': 'John', 'names': ['firstName', 'lastName']},**get_ssl_context()) as r:
@@ -138,6 +177,16 @@ class TestDataAccess(TestPR):
             assert len(res)==1
             assert res == ['DA001-2']
 
+        # limit & cursor
+        with requests.get(self.url+'v1/persons', params={'lastName': 'Doo', 'limit': 1},**get_ssl_context()) as r:
+            assert 200 == r.status_code
+            assert r.json() == ['DA001-2']
+            cursor = r.headers['X-Next-Cursor']
+        with requests.get(self.url+'v1/persons', params={'lastName': 'Doo', 'limit': 1, 'cursor': cursor},**get_ssl_context()) as r:
+            assert 200 == r.status_code
+            assert r.json() == []
+            assert 'X-Next-Cursor' not in r.headers
+
         # bad query
         with requests.get(self.url+'v1/persons', params={'undefined': 'JohnBA', },**get_ssl_context()) as r:
             assert 400 == r.status_code
@@ -195,6 +244,157 @@ class TestDataAccess(TestPR):
         with requests.post(self.url+'v1/persons/DA001-2/verify', json=data, **get_ssl_context()) as r:
             assert 200 == r.status_code
             assert r.json() is False
+        data = [dict(
+            attributeName="firstName",
+            operator=">",
+            value="John"
+        ), dict(
+            attributeName="lastName",
+            operator="!=",
+            value="Smith"
+        )]
+        with requests.post(self.url+'v1/persons/DA001-2/verify', json=data, **get_ssl_context()) as r:
+            assert 200 == r.status_code
+            assert r.json() is True
+        # bad attribute
+        data = [dict(
+            attributeName="undefined",
+            operator="=",
+            value="John"
+        )]
+        with requests.post(self.url+'v1/persons/DA001-2/verify', json=data, **get_ssl_context()) as r:
+            assert 400 == r.status_code
+
+    def test_reference_cache(self):
+        params = {'attributeNames': ['firstName', 'lastName']}
+        # fill the cache
+        for i in range(2):
+            with requests.get(self.url+'v1/persons/DA001-2', params=params, **get_ssl_context()) as r:
+                assert 200 == r.status_code
+                assert r.json() == {'firstName': 'JohnBA', 'lastName': 'Doo'}
+
+        # change the reference identity
+        with requests.put(self.url+'v1/persons/DA001-2/identities/002/reference', params={'transactionId': 'T000DA1'},**get_ssl_context()) as r:
+            assert 204 == r.status_code
+        with requests.get(self.url+'v1/persons/DA001-2', params=params, **get_ssl_context()) as r:
+            assert 200 == r.status_code
+            assert r.json() == {'firstName': 'JohnBB', 'lastName': 'Doo'}
+        with requests.post(self.url+'v1/persons/DA001-2/match', json={'firstName': 'JohnBB'}, **get_ssl_context()) as r:
+            assert 200 == r.status_code
+            assert r.json() == []
+
+        # move the reference identity to the other person
+        with requests.post(self.url+'v1/persons/DA001-1/move/DA001-2/identities/002', params={'transactionId': 'T000DA1'},**get_ssl_context()) as r:
+            assert 204 == r.status_code
+        with requests.get(self.url+'v1/persons/DA001-2', params=params, **get_ssl_context()) as r:
+            assert 404 == r.status_code
+
+        with requests.get(self.url+'monitoring/v1/metrics/gauges/reference_cache_hit_rate/count') as r:
+            assert 200 == r.status_code
+            assert 0 < r.json() < 1
+
+    def test_batch(self):
+        data = [
+            dict(uin='DA001-2', op='read', attributes=['firstName', 'lastName', 'missing']),
+            dict(uin='DA001-2', op='match', attributes={'firstName': 'John', 'lastName': 'Doo', 'missing': 'Missing'}),
+            dict(uin='DA001-2', op='verify', attributes=[dict(attributeName='firstName', operator='=', value='JohnBA')]),
+            dict(uin='DA001-2', op='read', attributes=['firstName', 'galleries']),
+            dict(uin='DA001-1', op='read', attributes=['firstName']),
+            dict(uin='DA001-1', op='verify', attributes=[dict(attributeName='firstName', operator='=', value='JohnA')]),
+            dict(uin='DA001-UNKNOWN', op='match', attributes={'firstName': 'John'}),
+            dict(uin='DA001-UNKNOWN', op='verify', attributes=[dict(attributeName='firstName', operator='=', value='John')]),
+            dict(uin='DA001-2', op='verify', attributes=[dict(attributeName='undefined', operator='=', value='John')]),
+            dict(uin='DA001-2', op='delete', attributes=[]),
+            dict(uin='DA001-2', op='read', attributes=[]),
+        ]
+        with requests.post(self.url+'v1/persons:batch', json=data, **get_ssl_context()) as r:
+            assert 200 == r.status_code
+            res = r.json()
+        assert res == [
+            {'uin': 'DA001-2', 'op': 'read', 'status': 200, 'result': {
+                'firstName': 'JohnBA', 'lastName': 'Doo', 'missing': {'code': 2, 'message': "Unknown attribute name [missing]"}}},
+            {'uin': 'DA001-2', 'op': 'match', 'status': 200, 'result': [
+                {'attributeName': 'firstName', 'errorCode': 1},
+                {'attributeName': 'missing', 'errorCode': 0}]},
+            {'uin': 'DA001-2', 'op': 'verify', 'status': 200, 'result': True},
+            {'uin': 'DA001-2', 'op': 'read', 'status': 200, 'result': {'firstName': 'JohnBA', 'galleries': ['TESTA']}},
+            # no reference identity
+            {'uin': 'DA001-1', 'op': 'read', 'status': 404},
+            {'uin': 'DA001-1', 'op': 'verify', 'status': 200, 'result': False},
+            {'uin': 'DA001-UNKNOWN', 'op': 'match', 'status': 404},
+            {'uin': 'DA001-UNKNOWN', 'op': 'verify', 'status': 404},
+            {'status': 400, 'message': 'Unknown attribute [undefined] in query expression'},
+            {'status': 400, 'message': 'Invalid operation [delete]'},
+            {'status': 400, 'message': 'No names specified'},
+        ]
+
+        # bad input
+        with requests.post(self.url+'v1/persons:batch', json={'uin': 'DA001-2'}, **get_ssl_context()) as r:
+            assert 400 == r.status_code
+        with requests.post(self.url+'v1/persons:batch', json=[dict(uin='DA001-2', op='read', attributes=['firstName'])]*1001, **get_ssl_context()) as r:
+            assert 400 == r.status_code
+
+    def create_typed_person(self):
+        # person DA001-3, with attributes of several types
+        with requests.post(self.url+'v1/persons/DA001-3', json={"status": "ACTIVE", "physicalStatus": "ALIVE"}, params={'transactionId': 'T000DA1'}, **get_ssl_context()) as r:
+            assert 201 == r.status_code
+        data = {
+            "status": "VALID",
+            "identityType": "TEST",
+            "biographicData": {"firstName": "John", "lastName": "Doo", "fInteger32": 12, "dateOfBirth": "1985-11-30"},
+            "contextualData": {"operationDateTime": "2020-03-01T12:30:45+00:00"},
+        }
+        with requests.post(self.url+'v1/persons/DA001-3/identities/001', json=data, params={'transactionId': 'T000DA1'}, **get_ssl_context()) as r:
+            assert 201 == r.status_code
+        with requests.put(self.url+'v1/persons/DA001-3/identities/001/reference', params={'transactionId': 'T000DA1'}, **get_ssl_context()) as r:
+            assert 204 == r.status_code
+
+    def test_typed_verify(self):
+        # the values are compared with the type of the attribute
+        self.create_typed_person()
+        try:
+            for expressions, expected in [
+                ([('fInteger32', '=', '12')], True),
+                ([('fInteger32', '=', 12)], True),
+                ([('fInteger32', '>', '9')], True),
+                ([('fInteger32', '<', 9)], False),
+                ([('fInteger32', '=', 'abc')], False),
+                ([('dateOfBirth', '=', '1985-11-30')], True),
+                ([('dateOfBirth', '<', '1986-01-01'), ('dateOfBirth', '>=', '1985-11-30')], True),
+                ([('dateOfBirth', '>', '1985-12-01')], False),
+                ([('dateOfBirth', '=', '30/11/1985')], False),
+            ]:
+                data = [dict(attributeName=k, operator=o, value=v) for k, o, v in expressions]
+                # read from the database, then from the cache
+                for i in range(2):
+                    with requests.post(self.url+'v1/persons/DA001-3/verify', json=data, **get_ssl_context()) as r:
+                        assert 200 == r.status_code
+                        assert expected is r.json(), expressions
+                with requests.post(self.url+'v1/persons:batch', json=[dict(uin='DA001-3', op='verify', attributes=data)], **get_ssl_context()) as r:
+                    assert 200 == r.status_code
+                    assert expected is r.json()[0]['result'], expressions
+        finally:
+            with requests.delete(self.url+'v1/persons/DA001-3', params={'transactionId': 'T000DA1'}, **get_ssl_context()) as r:
+                assert 204 == r.status_code
+
+    def test_batch_typed_match(self):
+        # the values are compared with the type of the attribute, as by matchPersonAttributes
+        self.create_typed_person()
+        try:
+            expected = {'fInteger32': '12', 'operationDateTime': '2020-03-01T12:30:45Z', 'lastName': 'Doo'}
+            different = {'fInteger32': '13', 'operationDateTime': '2020-03-01T12:30:46Z', 'lastName': 'Doe'}
+            for attributes, errors in [(expected, []), (different, [dict(attributeName=k, errorCode=1) for k in different])]:
+                # read from the database, then from the cache
+                for i in range(2):
+                    with requests.post(self.url+'v1/persons/DA001-3/match', json=attributes, **get_ssl_context()) as r:
+                        assert 200 == r.status_code
+                        assert errors == r.json()
+                with requests.post(self.url+'v1/persons:batch', json=[dict(uin='DA001-3', op='match', attributes=attributes)], **get_ssl_context()) as r:
+                    assert 200 == r.status_code
+                    assert errors == r.json()[0]['result']
+        finally:
+            with requests.delete(self.url+'v1/persons/DA001-3', params={'transactionId': 'T000DA1'}, **get_ssl_context()) as r:
+                assert 204 == r.status_code
 
 #_______________________________________________________________________________
 class TestDataAccessDocument(TestPR):
@@ -303,6 +503,33 @@ class TestDataAccessDocument(TestPR):
             assert b'https://picsum.photos/200' == mp.parts[2].content
             assert b"https://picsum.photos/200" == mp.parts[2].headers[b'Location']
 
+        # test OK, read by chunks
+        import pr.server
+        chunk_size = pr.server.STREAM_CHUNK_SIZE
+        pr.server.STREAM_CHUNK_SIZE = 1000
+        try:
+            with requests.get(self.url+'v1/persons/DA002-1/document', params={'doctype': 'FORM', 'format': 'pdf'},**get_ssl_context()) as r:
+                assert 200 == r.status_code
+                assert self.document == r.content
+        finally:
+            pr.server.STREAM_CHUNK_SIZE = chunk_size
+
+        # test Range
+        with requests.get(self.url+'v1/persons/DA002-1/document', params={'doctype': 'FORM', 'format': 'pdf'}, headers={'Range': 'bytes=10-19'}, **get_ssl_context()) as r:
+            assert 206 == r.status_code
+            assert self.document[10:20] == r.content
+            assert 'bytes 10-19/{}'.format(len(self.document)) == r.headers['Content-Range']
+        with requests.get(self.url+'v1/persons/DA002-1/document', params={'doctype': 'FORM', 'format': 'pdf'}, headers={'Range': 'bytes=-100'}, **get_ssl_context()) as r:
+            assert 206 == r.status_code
+            assert self.document[-100:] == r.content
+        with requests.get(self.url+'v1/persons/DA002-1/document', params={'doctype': 'FORM', 'format': 'pdf'}, headers={'Range': 'bytes=1000000-'}, **get_ssl_context()) as r:
+            assert 416 == r.status_code
+        # multiple ranges and other units are ignored
+        for rng in ['bytes=0-1,5-6', 'items=0-1']:
+            with requests.get(self.url+'v1/persons/DA002-1/document', params={'doctype': 'FORM', 'format': 'pdf'}, headers={'Range': rng}, **get_ssl_context()) as r:
+                assert 200 == r.status_code
+                assert self.document == r.content
+
         # test OK, dataRef as a redirect
         with requests.get(self.url+'v1/persons/DA002-1/document', params={'doctype': 'INVOICE', 'format': 'jpeg'},allow_redirects=False, **get_ssl_context()) as r:
             assert 302 == r.status_code
@@ -328,6 +555,76 @@ class TestDataAccessDocument(TestPR):
         with requests.get(self.url+'v1/persons/DA002-1/document', params={'doctype': 'ID_CARD', 'format': 'pdf'},**get_ssl_context()) as r:
             assert 404 == r.status_code
 
+#_______________________________________________________________________________
+class TestDataAccessBlobStore(TestDataAccessDocument):
+    """Same tests as TestDataAccessDocument, with the buffers in a blob store"""
+
+    def setUp(self):
+        import tempfile
+        import pr.blob
+        self.blob_dir = tempfile.TemporaryDirectory()
+        pr.blob_store = pr.blob.get_store('file://' + self.blob_dir.name)
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        import pr
+        pr.blob_store = None
+        self.blob_dir.cleanup()
+
+    def test_blobs(self):
+        import sqlalchemy as sa
+        import pr.model
+        # the buffers are not in the database
+        with pr.engine.connect() as conn:
+            rows = conn.execute(sa.select(pr.model.DocumentPart.data, pr.model.DocumentPart.dataHash, pr.model.DocumentPart.dataSize)
+                                .where(pr.model.DocumentPart.dataHash.is_not(None))).all()
+        assert len(rows) == 3
+        for row in rows:
+            assert row.data is None
+            assert os.path.getsize(pr.blob_store.path(row.dataHash)) == row.dataSize
+        assert pr.blob_store.get(pr.blob_store.key(self.document)) == self.document
+
+        # an identical buffer is stored once
+        data = {
+            "status":"CLAIMED",
+            "identityType": "TEST",
+            "galleries":["TESTA"],
+            "biographicData": {
+                "firstName": "JohnA",
+                "lastName": "Doe"
+            },
+            "biometricData": [
+                {
+                    "biometricType": "FACE",
+                    "image": base64.b64encode(b'DOCUMENT1').decode('ascii'),
+                    "mimeType": "image/png",
+                }
+            ]
+        }
+        with requests.post(self.url+'v1/persons/DA002-1/identities/002', json=data, params={'transactionId': 'T000DA2'},**get_ssl_context()) as r:
+            assert 201 == r.status_code
+        nb_files = sum(len(files) for _, _, files in os.walk(self.blob_dir.name))
+        assert nb_files == 3
+
+        # and read transparently
+        with requests.get(self.url+'v1/persons/DA002-1/identities/002', params={'transactionId': 'T000DA2'},**get_ssl_context()) as r:
+            assert 200 == r.status_code
+            res = r.json()
+            assert base64.b64decode(res['biometricData'][0]['image']) == b'DOCUMENT1'
+            assert 'imageHash' not in res['biometricData'][0]
+
+        # update, the buffer is still in the store only
+        data['biographicData']['firstName'] = 'Jack'
+        with requests.put(self.url+'v1/persons/DA002-1/identities/002', json=data, params={'transactionId': 'T000DA2'},**get_ssl_context()) as r:
+            assert 204 == r.status_code
+        with pr.engine.connect() as conn:
+            rows = conn.execute(sa.select(pr.model.BiometricData.image, pr.model.BiometricData.imageHash)).all()
+        assert len(rows) == 1
+        assert rows[0].image is None
+        assert rows[0].imageHash == pr.blob_store.key(b'DOCUMENT1')
+
+
 if __name__ == '__main__':
     unittest.main(argv=['-v'])
 
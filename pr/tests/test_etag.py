@@ -0,0 +1,144 @@
+import unittest
+import asyncio
+
+import sqlalchemy as sa
+import requests
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import pr
+import pr.model
+
+from . import TestPR
+from .test_queries import StatementCounter
+
+def run(coro):
+    # run in the loop of the server
+    from . import LOOP
+    return asyncio.run_coroutine_threadsafe(coro, LOOP).result()
+
+def get_ssl_context():
+    kw = {}
+    kw['verify'] = False
+    return kw
+
+PARAMS = {'transactionId': 'TETAG'}
+
+def identity(first_name):
+    return {
+        "status": "CLAIMED",
+        "identityType": "TEST",
+        "biographicData": {"firstName": first_name, "lastName": "Etag"},
+        "biometricData": [{"biometricType": "FACE", "image": "SU1BR0U=", "mimeType": "image/png"}],
+    }
+
+#_______________________________________________________________________________
+class TestETag(TestPR):
+    """
+    The reads return the version of the person or identity as an ETag.
+    """
+    def setUp(self):
+        with requests.post(self.url+'v1/persons/ETAG-1', json={"status": "ACTIVE", "physicalStatus": "ALIVE"}, params=PARAMS, **get_ssl_context()) as r:
+            assert 201 == r.status_code
+        for identity_id in ['001', '002']:
+            with requests.post(self.url+'v1/persons/ETAG-1/identities/'+identity_id, json=identity('John'), params=PARAMS, **get_ssl_context()) as r:
+                assert 201 == r.status_code
+
+    def tearDown(self):
+        with requests.delete(self.url+'v1/persons/ETAG-1', params=PARAMS, **get_ssl_context()) as r:
+            assert 204 == r.status_code
+
+    def read(self, path, etag=None):
+        headers = {'If-None-Match': etag} if etag else {}
+        with StatementCounter() as counter:
+            with requests.get(self.url+path, params=PARAMS, headers=headers, **get_ssl_context()) as r:
+                assert r.status_code in (200, 304)
+                if r.status_code == 304:
+                    assert not r.content
+        return r.status_code, r.headers.get('ETag'), counter.count
+
+    def test_not_modified(self):
+        for path in ['v1/persons/ETAG-1', 'v1/persons/ETAG-1/identities/001', 'v1/persons/ETAG-1/identities']:
+            status, etag, count = self.read(path)
+            assert 200 == status and etag
+            # only the versions are read
+            assert (304, etag, 1) == self.read(path, etag)
+            assert (304, etag, 1) == self.read(path, 'W/"x", ' + etag)
+            assert (200, etag) == self.read(path, '"x"')[:2]
+
+        with requests.get(self.url+'v1/persons/ETAG-UNKNOWN', params=PARAMS, headers={'If-None-Match': '*'}, **get_ssl_context()) as r:
+            assert 404 == r.status_code
+
+        # the reference has the ETag of the identity
+        for identity_id in ['001', '002']:
+            with requests.put(self.url+'v1/persons/ETAG-1/identities/%s/status' % identity_id, params=dict(PARAMS, status='VALID'), **get_ssl_context()) as r:
+                assert 204 == r.status_code
+        with requests.put(self.url+'v1/persons/ETAG-1/identities/001/reference', params=PARAMS, **get_ssl_context()) as r:
+            assert 204 == r.status_code
+        status, etag, count = self.read('v1/persons/ETAG-1/reference')
+        assert etag == self.read('v1/persons/ETAG-1/identities/001')[1]
+        assert (304, etag, 1) == self.read('v1/persons/ETAG-1/reference', etag)
+        with requests.put(self.url+'v1/persons/ETAG-1/identities/002/reference', params=PARAMS, **get_ssl_context()) as r:
+            assert 204 == r.status_code
+        assert 200 == self.read('v1/persons/ETAG-1/reference', etag)[0]
+
+    def test_versions(self):
+        etag = self.read('v1/persons/ETAG-1/identities/001')[1]
+        list_etag = self.read('v1/persons/ETAG-1/identities')[1]
+
+        # a change of the biometric data only changes the version of the identity
+        data = identity('John')
+        data['biometricData'][0]['mimeType'] = 'image/jpeg'
+        with requests.put(self.url+'v1/persons/ETAG-1/identities/001', json=data, params=PARAMS, **get_ssl_context()) as r:
+            assert 204 == r.status_code
+            new_etag = r.headers['ETag']
+        assert new_etag != etag
+        assert (200, new_etag) == self.read('v1/persons/ETAG-1/identities/001', etag)[:2]
+        assert 200 == self.read('v1/persons/ETAG-1/identities', list_etag)[0]
+
+        # the other identity is not changed
+        etag = self.read('v1/persons/ETAG-1/identities/002')[1]
+        with requests.patch(self.url+'v1/persons/ETAG-1/identities/001', json={"biographicData": {"firstName": "Jack", "lastName": "Etag"}}, params=PARAMS, **get_ssl_context()) as r:
+            assert 204 == r.status_code
+        assert 304 == self.read('v1/persons/ETAG-1/identities/002', etag)[0]
+
+    def test_if_match(self):
+        status, etag, count = self.read('v1/persons/ETAG-1/identities/001')
+        with requests.patch(self.url+'v1/persons/ETAG-1/identities/001', json={"biographicData": {"firstName": "Jack", "lastName": "Etag"}}, params=PARAMS, headers={'If-Match': etag}, **get_ssl_context()) as r:
+            assert 204 == r.status_code
+            new_etag = r.headers['ETag']
+        # the identity was modified since it was read
+        with requests.put(self.url+'v1/persons/ETAG-1/identities/001', json=identity('Joe'), params=PARAMS, headers={'If-Match': etag}, **get_ssl_context()) as r:
+            assert 412 == r.status_code
+        with requests.put(self.url+'v1/persons/ETAG-1/identities/001', json=identity('Joe'), params=PARAMS, headers={'If-Match': 'W/' + new_etag}, **get_ssl_context()) as r:
+            assert 412 == r.status_code
+        with requests.put(self.url+'v1/persons/ETAG-1/identities/001', json=identity('Joe'), params=PARAMS, headers={'If-Match': new_etag}, **get_ssl_context()) as r:
+            assert 204 == r.status_code
+        with requests.get(self.url+'v1/persons/ETAG-1/identities/001', params=PARAMS, **get_ssl_context()) as r:
+            assert 'Joe' == r.json()['biographicData']['firstName']
+
+        status, etag, count = self.read('v1/persons/ETAG-1')
+        with requests.put(self.url+'v1/persons/ETAG-1', json={"status": "INACTIVE", "physicalStatus": "ALIVE"}, params=PARAMS, headers={'If-Match': etag}, **get_ssl_context()) as r:
+            assert 204 == r.status_code
+        with requests.put(self.url+'v1/persons/ETAG-1', json={"status": "ACTIVE", "physicalStatus": "ALIVE"}, params=PARAMS, headers={'If-Match': etag}, **get_ssl_context()) as r:
+            assert 412 == r.status_code
+
+    def test_concurrent_update(self):
+        # the row is changed between the read and the write of another transaction
+        async def update():
+            Identity = pr.model.Identity
+            sel = sa.select(Identity).where(Identity.personId=='ETAG-1', Identity.identityId=='001')
+            async with AsyncSession(pr.aengine) as session, session.begin():
+                ident = (await session.execute(sel)).scalars().one()
+                async with AsyncSession(pr.aengine) as other, other.begin():
+                    (await other.execute(sel)).scalars().one().identityType = 'OTHER'
+                ident.identityType = 'MINE'
+                try:
+                    await session.flush()
+                except sa.orm.exc.StaleDataError:
+                    return True
+                return False
+        assert run(update())
+
+
+if __name__ == '__main__':
+    unittest.main(argv=['-v'])
@@ -6,7 +6,9 @@ import marshmallow.exceptions
 import pytest
 
 import pr.model
+import pr.server
 
+import sqlalchemy as sa
 from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 from sqlalchemy import select
@@ -22,6 +24,9 @@ class TestNominal(unittest.TestCase):
         self.engine = pr.engine
         pr.model.Base.metadata.drop_all(self.engine)
         pr.model.Base.metadata.create_all(self.engine)
+        # the tables were emptied without the ORM, reset the counters published as gauges
+        for name in pr.server.COUNTERS:
+            pr.server.COUNTERS[name] = 0
 
     def test_person(self):
         with Session(self.engine) as session:
@@ -90,6 +95,67 @@ class TestNominal(unittest.TestCase):
             ids = pr.model.Gallery.get_identities(session, 'B')
             assert len(ids) == 2
 
+    def test_reference(self):
+        # the pointer to the reference identity follows the isReference flags
+        with Session(self.engine) as session:
+            bob = pr.model.Person(
+                personId='0004',
+                identities=[
+                    pr.model.Identity(identityId='001', status='VALID', isReference=True, bgd_firstName="John", bgd_lastName="Doo"),
+                    pr.model.Identity(identityId='002', status='VALID', bgd_firstName="John", bgd_lastName="Doo"),
+                ]
+            )
+            alice = pr.model.Person(personId='0005')
+            session.add_all([bob, alice])
+            session.commit()
+            assert bob.referenceIdentityId == bob.identities[0].id
+            assert bob.reference.identityId == '001'
+
+            # change the reference
+            bob.identities[0].isReference = False
+            bob.identities[1].isReference = True
+            session.commit()
+            assert bob.reference.identityId == '002'
+
+            # move the reference to another person
+            ident = bob.identities[1]
+            ident.isReference = False
+            ident.personId = '0005'
+            session.commit()
+            assert bob.referenceIdentityId is None
+            ident.isReference = True
+            session.commit()
+            session.refresh(alice)
+            assert alice.reference.identityId == '002'
+
+            # delete the reference
+            session.delete(ident)
+            session.commit()
+            assert alice.referenceIdentityId is None
+
+    def test_custo_indexes(self):
+        # indexes declared in the custo are created with the IDENTITY table
+        indexes = {x['name']: x['column_names'] for x in sa.inspect(self.engine).get_indexes('IDENTITY')}
+        assert indexes['ix_lastName_dateOfBirth'] == ['bgd_lastName', 'bgd_dateOfBirth']
+        assert indexes['ix_firstName_ref'] == ['bgd_firstName']
+
+        if self.engine.dialect.name == 'sqlite':
+            # and they are used for equality lookups
+            with Session(self.engine) as session:
+                sel = select(pr.model.Identity.personId).where(pr.model.Identity.bgd_lastName=='Doo', pr.model.Identity.bgd_dateOfBirth=='1985-11-30')
+                plan = session.execute(sa.text('EXPLAIN QUERY PLAN ' + str(sel.compile(self.engine, compile_kwargs={'literal_binds': True})))).all()
+                assert 'ix_lastName_dateOfBirth' in plan[0][-1]
+
+        # the trigram indexes of the substring attributes are for PostgreSQL only
+        if self.engine.dialect.name == 'sqlite':
+            assert not [x for x in indexes if x.startswith('ix_trgm_')]
+        statements = []
+        mock = sa.create_mock_engine('postgresql://', lambda sql, *args, **kw: statements.append(str(sql.compile(dialect=mock.dialect))))
+        pr.model.Base.metadata.create_all(mock)
+        assert 'CREATE EXTENSION IF NOT EXISTS pg_trgm' in statements
+        assert any('"ix_trgm_lastName" ON "IDENTITY" USING gin ("bgd_lastName" gin_trgm_ops)' in x for x in statements)
+        assert statements.index('CREATE EXTENSION IF NOT EXISTS pg_trgm') < min(i for i, x in enumerate(statements) if 'ix_trgm_' in x)
+
     def test_serialize_person(self):
         import pr.serialize
         with Session(self.engine) as session:
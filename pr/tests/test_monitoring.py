@@ -1,5 +1,6 @@
 import unittest
 import sys
+import time
 
 import requests
 
@@ -27,6 +28,54 @@ class TestNominal(TestPR):
         with requests.get(self.mon_url+'monitoring/v1/is_healthy', verify=False) as r:
             assert 200 == r.status_code
 
+    def test_warmup(self):
+        # ready when the warm-up is done
+        for i in range(50):
+            with requests.get(self.mon_url+'monitoring/v1/is_ready', verify=False) as r:
+                if r.status_code == 200:
+                    break
+            time.sleep(0.1)
+        assert 200 == r.status_code
+        with requests.get(self.mon_url+'monitoring/v1/metrics/gauges', verify=False) as r:
+            assert 200 == r.status_code
+            assert r.json()['warmup_duration']['count'] > 0
+
+        with requests.get(self.url+'v1/persons/UNKNOWN-WARMUP/reference', params={'transactionId': 'TWARMUP'}, verify=False) as r:
+            assert 404 == r.status_code
+        with requests.get(self.url+'v1/galleries', params={'transactionId': 'TWARMUP'}, verify=False) as r:
+            assert 200 == r.status_code
+        with requests.get(self.mon_url+'monitoring/v1/metrics/gauges', verify=False) as r:
+            assert r.json()['time_to_first_fast_request']['count'] > 0
+
+    def test_warmup_failure(self):
+        # not ready until the warm-up succeeds
+        import asyncio
+        import pr.server
+        from . import LOOP
+        warm_up, delay = pr.server.warm_up, pr.server.WARMUP_RETRY_DELAY
+        failing = [True]
+        async def warm_up_database():
+            if failing[0]:
+                raise Exception('Database not available')
+            await warm_up()
+        pr.server.warm_up = warm_up_database
+        pr.server.WARMUP_RETRY_DELAY = 0.1
+        pr.server.STARTUP['ready'] = False
+        try:
+            future = asyncio.run_coroutine_threadsafe(pr.server._warm_up(), LOOP)
+            time.sleep(0.3)
+            with requests.get(self.mon_url+'monitoring/v1/is_ready', verify=False) as r:
+                assert 200 != r.status_code
+            with requests.get(self.mon_url+'monitoring/v1/metrics/gauges/warmup_failures/count', verify=False) as r:
+                assert r.json() >= 2
+            failing[0] = False
+            future.result(5)
+            with requests.get(self.mon_url+'monitoring/v1/is_ready', verify=False) as r:
+                assert 200 == r.status_code
+        finally:
+            pr.server.warm_up, pr.server.WARMUP_RETRY_DELAY = warm_up, delay
+            pr.server.STARTUP['ready'] = True
+
 
 
 if __name__ == '__main__':
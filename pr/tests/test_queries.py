@@ -0,0 +1,411 @@
+import unittest
+import threading
+
+import sqlalchemy as sa
+import requests
+
+import pr
+import pr.model
+import pr.server
+
+from . import TestPR
+
+def get_ssl_context():
+    kw = {}
+    kw['verify'] = False
+    return kw
+
+def identity(i):
+    return {
+        "status": "VALID",
+        "identityType": "TEST",
+        "galleries": ["SQLCOUNT", "SQLCOUNT-%d" % i],
+        "biographicData": {
+            "firstName": "John%d" % i,
+            "lastName": "SqlCount",
+            "nationality": "FRA",
+            "dateOfBirth": "1985-11-30"
+        },
+        "documentData": [
+            {
+                "documentType": "FORM",
+                "parts": [
+                    {"pages": [1], "data": "SU1BR0U=", "mimeType": "image/png"},
+                    {"pages": [2], "data": "SU1BR0U=", "mimeType": "image/png"}
+                ]
+            }
+        ],
+        "biometricData": [
+            {
+                "biometricType": "FINGER",
+                "biometricSubType": finger,
+                "image": "SU1BR0U=",
+                "mimeType": "image/png",
+                "missing": [
+                    {
+                        "biometricSubType": finger,
+                        "presence": "BANDAGED"
+                    }
+                ]
+            } for finger in ['RIGHT_INDEX', 'RIGHT_THUMB']
+        ],
+        "contextualData": {
+            "operator": "OPE"
+        }
+    }
+
+#_______________________________________________________________________________
+class StatementCounter:
+    # count the SQL statements executed by all the engines (the server runs in
+    # another thread of the same process)
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+        self.lock = threading.Lock()
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        with self.lock:
+            self.count += 1
+            self.statements.append(statement)
+
+    def __enter__(self):
+        self.count = 0
+        self.statements = []
+        sa.event.listen(sa.engine.Engine, 'before_cursor_execute', self)
+        return self
+
+    def __exit__(self, *args):
+        sa.event.remove(sa.engine.Engine, 'before_cursor_execute', self)
+
+#_______________________________________________________________________________
+class TestStatementCount(TestPR):
+    """
+    The number of SQL statements executed by a service must not depend on the
+    number of identities (and of their biometric/document data) of a person.
+    """
+    PERSONS = {'SQLC-1': 1, 'SQLC-5': 5}
+
+    def setUp(self):
+        for person_id, nb in self.PERSONS.items():
+            with requests.post(self.url+'v1/persons/'+person_id, json={"status": "ACTIVE", "physicalStatus": "ALIVE"}, params={'transactionId': 'TSQLC'}, **get_ssl_context()) as r:
+                assert 201 == r.status_code
+            for i in range(nb):
+                with requests.post(self.url+'v1/persons/%s/identities/%03d' % (person_id, i), json=identity(i), params={'transactionId': 'TSQLC'}, **get_ssl_context()) as r:
+                    assert 201 == r.status_code
+            with requests.put(self.url+'v1/persons/%s/identities/000/reference' % person_id, params={'transactionId': 'TSQLC'}, **get_ssl_context()) as r:
+                assert 204 == r.status_code
+
+    def tearDown(self):
+        for person_id in self.PERSONS:
+            with requests.delete(self.url+'v1/persons/'+person_id, params={'transactionId': 'TSQLC'}, **get_ssl_context()) as r:
+                assert 204 == r.status_code
+
+    def count(self, method, path, **kw):
+        ret = []
+        for person_id in self.PERSONS:
+            pr.server.REFERENCE_CACHE.clear()
+            with StatementCounter() as counter:
+                with requests.request(method, self.url+path.format(person_id), **kw, **get_ssl_context()) as r:
+                    assert r.status_code < 300
+            ret.append(counter.count)
+        # same number of statements for 1 or 5 identities
+        assert ret[0] == ret[1], "{} {}: {}".format(method, path, ret)
+        return ret[0]
+
+    def test_read(self):
+        # person, identities, galleries, biometric data, missing, document data, parts
+        assert self.count('GET', 'v1/persons/{}/identities', params={'transactionId': 'TSQLC'}) <= 7
+        assert self.count('GET', 'v1/persons/{}/identities/000', params={'transactionId': 'TSQLC'}) <= 7
+        assert self.count('GET', 'v1/persons/{}/reference', params={'transactionId': 'TSQLC'}) <= 7
+        # person, identities, galleries
+        assert self.count('GET', 'v1/persons/{}', params={'attributeNames': ['firstName']}) <= 3
+        assert self.count('POST', 'v1/persons/{}/match', json={'firstName': 'John0'}) <= 3
+        assert self.count('POST', 'v1/persons/{}/verify', json=[{'attributeName': 'firstName', 'operator': '=', 'value': 'John0'}]) <= 3
+        # parts, then one chunk for each of the 2 parts
+        assert self.count('GET', 'v1/persons/{}/document', params={'doctype': 'FORM', 'format': 'png'}) <= 3
+
+    def test_write(self):
+        assert self.count('PUT', 'v1/persons/{}/identities/000/status', params={'transactionId': 'TSQLC', 'status': 'VALID'}) <= 4
+        # identity, flags of the identities, reference of the person
+        assert self.count('PUT', 'v1/persons/{}/identities/000/reference', params={'transactionId': 'TSQLC'}) <= 3
+
+    def test_update(self):
+        data = identity(0)
+        data['status'] = 'CLAIMED'
+        for person_id in self.PERSONS:
+            with requests.post(self.url+'v1/persons/%s/identities/100' % person_id, json=data, params={'transactionId': 'TSQLC'}, **get_ssl_context()) as r:
+                assert 201 == r.status_code
+        with pr.engine.connect() as conn:
+            rows = conn.execute(sa.select(pr.model.BiometricData.id).order_by(pr.model.BiometricData.id)).all()
+
+        # one attribute changed: the rows of the identity are read, and only the identity is updated
+        data['biographicData']['firstName'] = 'Jack'
+        assert self.count('PUT', 'v1/persons/{}/identities/100', json=data, params={'transactionId': 'TSQLC'}) <= 8
+
+        # the biometric data were not rewritten
+        with pr.engine.connect() as conn:
+            assert rows == conn.execute(sa.select(pr.model.BiometricData.id).order_by(pr.model.BiometricData.id)).all()
+        with requests.get(self.url+'v1/persons/SQLC-1/identities/100', params={'transactionId': 'TSQLC'}, **get_ssl_context()) as r:
+            assert 200 == r.status_code
+            assert r.json()['biographicData']['firstName'] == 'Jack'
+            assert len(r.json()['biometricData']) == 2
+
+    def test_list(self):
+        # identities only, whatever the number of results
+        with StatementCounter() as counter:
+            with requests.post(self.url+'v1/persons', json=[{'attributeName': 'lastName', 'operator': '=', 'value': 'SqlCount'}], params={'transactionId': 'TSQLC'}, **get_ssl_context()) as r:
+                assert 200 == r.status_code
+                assert len(r.json()) == 6
+        assert counter.count == 1
+        with StatementCounter() as counter:
+            with requests.get(self.url+'v1/galleries/SQLCOUNT', params={'transactionId': 'TSQLC'}, **get_ssl_context()) as r:
+                assert 200 == r.status_code
+                assert len(r.json()) == 6
+        assert counter.count == 1
+        with StatementCounter() as counter:
+            with requests.get(self.url+'v1/persons', params={'lastName': 'SqlCount', 'names': ['firstName']}, **get_ssl_context()) as r:
+                assert 200 == r.status_code
+                assert len(r.json()) == 2
+        # identities, galleries
+        assert counter.count <= 2
+
+    def test_merge_move(self):
+        # the identities are moved with UPDATE statements, whatever their number
+        counts = []
+        for person_id, nb in self.PERSONS.items():
+            target = 'MRG-%d' % nb
+            with requests.post(self.url+'v1/persons/'+target, json={"status": "ACTIVE", "physicalStatus": "ALIVE"}, params={'transactionId': 'TSQLC'}, **get_ssl_context()) as r:
+                assert 201 == r.status_code
+            with requests.post(self.url+'v1/persons/%s/identities/100' % target, json=identity(100), params={'transactionId': 'TSQLC'}, **get_ssl_context()) as r:
+                assert 201 == r.status_code
+            with requests.put(self.url+'v1/persons/%s/identities/100/reference' % target, params={'transactionId': 'TSQLC'}, **get_ssl_context()) as r:
+                assert 204 == r.status_code
+            with StatementCounter() as counter:
+                with requests.post(self.url+'v1/persons/%s/merge/%s' % (target, person_id), params={'transactionId': 'TSQLC'}, **get_ssl_context()) as r:
+                    assert 204 == r.status_code
+            counts.append(counter.count)
+
+            # the identities of the source are after the ones of the target, the reference is kept
+            with requests.get(self.url+'v1/persons/%s/identities' % target, params={'transactionId': 'TSQLC'}, **get_ssl_context()) as r:
+                assert 200 == r.status_code
+                assert ['100'] + ['%03d' % i for i in range(nb)] == [x['identityId'] for x in r.json()]
+            with requests.get(self.url+'v1/persons/%s/reference' % target, params={'transactionId': 'TSQLC'}, **get_ssl_context()) as r:
+                assert 200 == r.status_code
+                assert '100' == r.json()['identityId']
+
+            # move the identities back
+            with requests.post(self.url+'v1/persons/'+person_id, json={"status": "ACTIVE", "physicalStatus": "ALIVE"}, params={'transactionId': 'TSQLC'}, **get_ssl_context()) as r:
+                assert 201 == r.status_code
+            for i in range(nb):
+                with StatementCounter() as counter:
+                    with requests.post(self.url+'v1/persons/%s/move/%s/identities/%03d' % (person_id, target, i), params={'transactionId': 'TSQLC'}, **get_ssl_context()) as r:
+                        assert 204 == r.status_code
+                counts.append(counter.count)
+            with requests.post(self.url+'v1/persons/%s/move/%s/identities/100' % (person_id, target), params={'transactionId': 'TSQLC'}, **get_ssl_context()) as r:
+                assert 204 == r.status_code
+            # the moved identity is not the reference of the target anymore
+            with requests.get(self.url+'v1/persons/%s/reference' % target, params={'transactionId': 'TSQLC'}, **get_ssl_context()) as r:
+                assert 404 == r.status_code
+            with requests.delete(self.url+'v1/persons/'+target, params={'transactionId': 'TSQLC'}, **get_ssl_context()) as r:
+                assert 204 == r.status_code
+
+        # merge: persons, conflicts, position, identities, source person
+        assert counts[0] == counts[2] and counts[0] <= 5, counts
+        # move: persons, identity, conflicts, position, identity, source person
+        assert len(set(counts[1:2] + counts[3:])) == 1 and counts[1] <= 6, counts
+
+    def test_batch(self):
+        # one query for all the persons
+        items = []
+        for person_id in self.PERSONS:
+            items += [
+                dict(uin=person_id, op='read', attributes=['firstName', 'operator']),
+                dict(uin=person_id, op='match', attributes={'firstName': 'John0', 'lastName': 'Doo'}),
+                dict(uin=person_id, op='verify', attributes=[dict(attributeName='nationality', operator='=', value='FRA')]),
+                # compared with the type of the attribute
+                dict(uin=person_id, op='verify', attributes=[dict(attributeName='dateOfBirth', operator='<', value='1990-01-01'),
+                                                             dict(attributeName='dateOfBirth', operator='=', value='1985-11-30')]),
+                dict(uin=person_id, op='verify', attributes=[dict(attributeName='dateOfBirth', operator='>', value='1990-01-01')]),
+            ]
+        pr.server.REFERENCE_CACHE.clear()
+        with StatementCounter() as counter:
+            with requests.post(self.url+'v1/persons:batch', json=items, **get_ssl_context()) as r:
+                assert 200 == r.status_code
+                res = r.json()
+        assert counter.count == 1
+        assert [200]*10 == [x['status'] for x in res]
+        assert {'firstName': 'John0', 'operator': 'OPE'} == res[5]['result']
+        assert [{'attributeName': 'lastName', 'errorCode': 1}] == res[6]['result']
+        assert res[7]['result'] is True
+        assert res[8]['result'] is True
+        assert res[9]['result'] is False
+
+        # the attributes that are not columns are read with the identities,
+        # in the same number of statements as for one person
+        single = self.count('GET', 'v1/persons/{}', params={'attributeNames': ['galleries']})
+        items += [dict(uin=person_id, op='read', attributes=['galleries']) for person_id in self.PERSONS]
+        pr.server.REFERENCE_CACHE.clear()
+        with StatementCounter() as counter:
+            with requests.post(self.url+'v1/persons:batch', json=items, **get_ssl_context()) as r:
+                assert 200 == r.status_code
+                assert {'galleries': ['SQLCOUNT', 'SQLCOUNT-0']} == r.json()[-1]['result']
+        assert counter.count == single + 1
+
+    def test_projection(self):
+        # only the requested columns of the identities are read
+        names = ['firstName', 'lastName', 'nationality', 'operator', 'status']
+        expected = {'firstName': 'John0', 'lastName': 'SqlCount', 'nationality': 'FRA', 'operator': 'OPE', 'status': 'VALID'}
+        pr.server.REFERENCE_CACHE.clear()
+        with StatementCounter() as counter:
+            with requests.get(self.url+'v1/persons/SQLC-5', params={'attributeNames': names}, **get_ssl_context()) as r:
+                assert 200 == r.status_code
+                assert expected == r.json()
+        assert counter.count == 1
+        with StatementCounter() as counter:
+            with requests.get(self.url+'v1/persons', params={'lastName': 'SqlCount', 'names': names}, **get_ssl_context()) as r:
+                assert 200 == r.status_code
+                assert [expected, expected] == r.json()
+        assert counter.count == 1
+        assert not any('BIOMETRIC' in s or 'DOCUMENT' in s or 'GALLERY' in s for s in counter.statements)
+
+        # unknown names are rejected without reading the database
+        with StatementCounter() as counter:
+            with requests.get(self.url+'v1/persons', params={'lastName': 'SqlCount', 'names': ['firstName', 'undefined']}, **get_ssl_context()) as r:
+                assert 400 == r.status_code
+        assert counter.count == 0
+
+        # the attributes that are not columns are read from the identities
+        with requests.get(self.url+'v1/persons', params={'lastName': 'SqlCount', 'names': ['firstName', 'galleries']}, **get_ssl_context()) as r:
+            assert 200 == r.status_code
+            assert [{'firstName': 'John0', 'galleries': ['SQLCOUNT', 'SQLCOUNT-0']}]*2 == r.json()
+        with requests.get(self.url+'v1/persons/SQLC-1', params={'attributeNames': ['firstName', 'galleries']}, **get_ssl_context()) as r:
+            assert 200 == r.status_code
+            assert {'firstName': 'John0', 'galleries': ['SQLCOUNT', 'SQLCOUNT-0']} == r.json()
+
+
+#_______________________________________________________________________________
+class TestPhonetic(TestPR):
+    """
+    The 'phonetic' operator finds the names pronounced alike.
+    """
+    NAMES = {'PHO-1': ('Robert', 'Smith'), 'PHO-2': ('Rupert', 'Smyth'), 'PHO-3': ('Robert', 'Jones')}
+
+    def setUp(self):
+        for person_id, (first_name, last_name) in self.NAMES.items():
+            with requests.post(self.url+'v1/persons/'+person_id, json={"status": "ACTIVE", "physicalStatus": "ALIVE"}, params={'transactionId': 'TPHO'}, **get_ssl_context()) as r:
+                assert 201 == r.status_code
+            data = {"status": "CLAIMED", "identityType": "TEST", "biographicData": {"firstName": first_name, "lastName": last_name}}
+            with requests.post(self.url+'v1/persons/%s/identities/001' % person_id, json=data, params={'transactionId': 'TPHO'}, **get_ssl_context()) as r:
+                assert 201 == r.status_code
+
+    def tearDown(self):
+        for person_id in self.NAMES:
+            with requests.delete(self.url+'v1/persons/'+person_id, params={'transactionId': 'TPHO'}, **get_ssl_context()) as r:
+                assert 204 == r.status_code
+
+    def find(self, expressions):
+        with requests.post(self.url+'v1/persons', json=expressions, params={'transactionId': 'TPHO', 'group': 'true'}, **get_ssl_context()) as r:
+            assert 200 == r.status_code
+            return [x['personId'] for x in r.json() if x['personId'].startswith('PHO-')]
+
+    def test_phonetic(self):
+        assert ['PHO-1', 'PHO-2'] == self.find([{'attributeName': 'lastName', 'operator': 'phonetic', 'value': 'Smithe'}])
+        assert ['PHO-2'] == self.find([{'attributeName': 'lastName', 'operator': 'phonetic', 'value': 'Smid'},
+                                       {'attributeName': 'firstName', 'operator': '=', 'value': 'Rupert'}])
+        assert ['PHO-1', 'PHO-2', 'PHO-3'] == self.find([{'attributeName': 'firstName', 'operator': 'phonetic', 'value': 'Rubert'}])
+        assert [] == self.find([{'attributeName': 'lastName', 'operator': 'phonetic', 'value': '--'}])
+
+        # the key is updated with the attribute
+        data = {"status": "CLAIMED", "identityType": "TEST", "biographicData": {"firstName": "Robert", "lastName": "Johns"}}
+        with requests.put(self.url+'v1/persons/PHO-1/identities/001', json=data, params={'transactionId': 'TPHO'}, **get_ssl_context()) as r:
+            assert 204 == r.status_code
+        assert ['PHO-1', 'PHO-3'] == self.find([{'attributeName': 'lastName', 'operator': 'phonetic', 'value': 'Jonas'}])
+        with requests.patch(self.url+'v1/persons/PHO-3/identities/001', json={"biographicData": {"lastName": "Smit"}}, params={'transactionId': 'TPHO'}, **get_ssl_context()) as r:
+            assert 204 == r.status_code
+        assert ['PHO-2', 'PHO-3'] == self.find([{'attributeName': 'lastName', 'operator': 'phonetic', 'value': 'Smith'}])
+
+        # the key is not part of the identity
+        with requests.get(self.url+'v1/persons/PHO-3/identities/001', params={'transactionId': 'TPHO'}, **get_ssl_context()) as r:
+            assert 200 == r.status_code
+            assert not any(k.startswith('pho_') for k in r.json())
+            assert 'Smit' == r.json()['biographicData']['lastName']
+
+        # only on the attributes with a phonetic key
+        with requests.post(self.url+'v1/persons', json=[{'attributeName': 'nationality', 'operator': 'phonetic', 'value': 'FRA'}], params={'transactionId': 'TPHO'}, **get_ssl_context()) as r:
+            assert 400 == r.status_code
+
+        if pr.engine.dialect.name == 'sqlite':
+            # the index of the key is used
+            sel = pr.server._build_predicate([{'attributeName': 'lastName', 'operator': 'phonetic', 'value': 'Smith'}], False, None, True, None, None)
+            with pr.engine.connect() as conn:
+                plan = conn.execute(sa.text('EXPLAIN QUERY PLAN ' + str(sel.compile(pr.engine, compile_kwargs={'literal_binds': True})))).all()
+            assert any('ix_pho_lastName' in x[-1] for x in plan)
+
+
+#_______________________________________________________________________________
+class TestSubstring(TestPR):
+    """
+    The 'startsWith' and 'contains' operators use the trigram index.
+    """
+    NAMES = {'SUB-1': 'Dupont', 'SUB-2': 'DUPOND', 'SUB-3': 'Martin-Dupuis', 'SUB-4': 'Du_Pas'}
+
+    def setUp(self):
+        for person_id, last_name in self.NAMES.items():
+            with requests.post(self.url+'v1/persons/'+person_id, json={"status": "ACTIVE", "physicalStatus": "ALIVE"}, params={'transactionId': 'TSUB'}, **get_ssl_context()) as r:
+                assert 201 == r.status_code
+            # only SUB-2 has a reference identity
+            data = {"status": "VALID" if person_id == 'SUB-2' else "CLAIMED", "identityType": "TEST", "biographicData": {"firstName": "Jean", "lastName": last_name}}
+            with requests.post(self.url+'v1/persons/%s/identities/001' % person_id, json=data, params={'transactionId': 'TSUB'}, **get_ssl_context()) as r:
+                assert 201 == r.status_code
+        with requests.put(self.url+'v1/persons/SUB-2/identities/001/reference', params={'transactionId': 'TSUB'}, **get_ssl_context()) as r:
+            assert 204 == r.status_code
+
+    def tearDown(self):
+        for person_id in self.NAMES:
+            with requests.delete(self.url+'v1/persons/'+person_id, params={'transactionId': 'TSUB'}, **get_ssl_context()) as r:
+                assert 204 == r.status_code
+
+    def find(self, operator, value):
+        with requests.post(self.url+'v1/persons', json=[{'attributeName': 'lastName', 'operator': operator, 'value': value}], params={'transactionId': 'TSUB', 'group': 'true'}, **get_ssl_context()) as r:
+            assert 200 == r.status_code
+            return [x['personId'] for x in r.json() if x['personId'].startswith('SUB-')]
+
+    def test_substring(self):
+        assert ['SUB-1', 'SUB-2'] == self.find('startsWith', 'dupon')
+        assert ['SUB-1', 'SUB-2', 'SUB-4'] == self.find('startsWith', 'Du')
+        assert ['SUB-1', 'SUB-2', 'SUB-3'] == self.find('contains', 'UPo') + self.find('contains', 'tin-')
+        assert ['SUB-3'] == self.find('contains', 'dupuis')
+        assert [] == self.find('startsWith', 'upon')
+        # the wildcards are searched as is
+        assert ['SUB-4'] == self.find('contains', '_p')
+        assert [] == self.find('contains', '%')
+
+        # the index follows the updates
+        data = {"status": "CLAIMED", "identityType": "TEST", "biographicData": {"firstName": "Jean", "lastName": "Durand"}}
+        with requests.put(self.url+'v1/persons/SUB-1/identities/001', json=data, params={'transactionId': 'TSUB'}, **get_ssl_context()) as r:
+            assert 204 == r.status_code
+        assert ['SUB-2'] == self.find('startsWith', 'dupon')
+        assert ['SUB-1'] == self.find('contains', 'rand')
+
+        # queryPersonList
+        with requests.get(self.url+'v1/persons', params={'lastName:contains': 'upo', 'names': ['lastName']}, **get_ssl_context()) as r:
+            assert 200 == r.status_code
+            assert [{'lastName': 'DUPOND'}] == r.json()
+        with requests.get(self.url+'v1/persons', params={'lastName:like': 'upo'}, **get_ssl_context()) as r:
+            assert 400 == r.status_code
+
+        # only on the attributes with a substring index
+        with requests.post(self.url+'v1/persons', json=[{'attributeName': 'nationality', 'operator': 'startsWith', 'value': 'FRA'}], params={'transactionId': 'TSUB'}, **get_ssl_context()) as r:
+            assert 400 == r.status_code
+
+        if pr.engine.dialect.name == 'sqlite':
+            # the trigram index is used
+            sel = pr.server._build_predicate([{'attributeName': 'lastName', 'operator': 'contains', 'value': 'upo'}], False, None, True, None, None)
+            with pr.engine.connect() as conn:
+                plan = conn.execute(sa.text('EXPLAIN QUERY PLAN ' + str(sel.compile(pr.engine, compile_kwargs={'literal_binds': True})))).all()
+                assert any('VIRTUAL TABLE INDEX' in x[-1] for x in plan), plan
+                conn.execute(sa.text('INSERT INTO "IDENTITY_SEARCH"("IDENTITY_SEARCH") VALUES (\'integrity-check\')'))
+
+
+if __name__ == '__main__':
+    unittest.main(argv=['-v'])
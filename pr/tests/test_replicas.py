@@ -0,0 +1,123 @@
+import unittest
+import asyncio
+import threading
+
+import sqlalchemy as sa
+import requests
+
+import pr
+import pr.model
+import pr.server
+import pr.replicas
+
+from . import TestPR
+
+def run(coro):
+    # run in the loop of the server
+    from . import LOOP
+    return asyncio.run_coroutine_threadsafe(coro, LOOP).result()
+
+def get_ssl_context():
+    kw = {}
+    kw['verify'] = False
+    return kw
+
+#_______________________________________________________________________________
+class TestReplicas(TestPR):
+    """
+    The replica is another engine on the same (in-memory) database: the tests
+    check which engine is used by the services.
+    """
+    def setUp(self):
+        self.engine = pr.model.create_replica_engines([pr.args.database_url])[0]
+        self.count = 0
+        self.lock = threading.Lock()
+        sa.event.listen(self.engine.sync_engine, 'before_cursor_execute', self.on_execute)
+        pr.server.REPLICAS.setup(pr.aengine, [self.engine])
+        with requests.post(self.url+'v1/persons/REPLICA-1', json={"status": "ACTIVE", "physicalStatus": "ALIVE"}, params={'transactionId': 'TREP'}, **get_ssl_context()) as r:
+            assert 201 == r.status_code
+            # no commit position with SQLite
+            assert pr.server.COMMIT_POSITION_HEADER not in r.headers
+
+    def tearDown(self):
+        pr.server.REPLICAS.setup(pr.aengine, [])
+        with requests.delete(self.url+'v1/persons/REPLICA-1', params={'transactionId': 'TREP'}, **get_ssl_context()) as r:
+            assert 204 == r.status_code
+        run(self.engine.dispose())
+
+    def on_execute(self, *args):
+        with self.lock:
+            self.count += 1
+
+    def read(self, **kw):
+        with requests.get(self.url+'v1/persons/REPLICA-1', params={'transactionId': 'TREP'}, **kw, **get_ssl_context()) as r:
+            return r.status_code
+
+    def test_routing(self):
+        # the read-only services use the replica
+        assert 200 == self.read()
+        assert self.count > 0
+
+        # the write services use the primary
+        count = self.count
+        with requests.put(self.url+'v1/persons/REPLICA-1', json={"status": "INACTIVE", "physicalStatus": "ALIVE"}, params={'transactionId': 'TREP'}, **get_ssl_context()) as r:
+            assert 204 == r.status_code
+        assert count == self.count
+
+        # unhealthy replica: the primary is used
+        pr.server.REPLICAS.replicas[0].healthy = False
+        assert 200 == self.read()
+        assert count == self.count
+
+        # the health is restored by the periodic checks
+        run(pr.server.REPLICAS.check())
+        assert pr.server.REPLICAS.replicas[0].healthy
+        assert 200 == self.read()
+        assert count < self.count
+
+    def test_failover(self):
+        # the replica stops between two checks
+        run(self.engine.dispose())
+        def refuse(*args, **kw):
+            import sqlite3
+            raise sqlite3.OperationalError('unable to open database file')
+        sa.event.listen(self.engine.sync_engine, 'do_connect', refuse)
+        try:
+            # the request is processed again on the primary
+            assert 200 == self.read()
+            assert not pr.server.REPLICAS.replicas[0].healthy
+            assert 200 == self.read()
+            # a post read-only service (the person has no reference)
+            pr.server.REPLICAS.replicas[0].healthy = True
+            with requests.post(self.url+'v1/persons/REPLICA-1/match', json={'status': 'ACTIVE'}, **get_ssl_context()) as r:
+                assert 404 == r.status_code
+            assert not pr.server.REPLICAS.replicas[0].healthy
+        finally:
+            sa.event.remove(self.engine.sync_engine, 'do_connect', refuse)
+        # the replica is back after the next check
+        run(pr.server.REPLICAS.check())
+        assert pr.server.REPLICAS.replicas[0].healthy
+        count = self.count
+        assert 200 == self.read()
+        assert count < self.count
+
+    def test_read_your_writes(self):
+        # the position of the replica is unknown: the primary is used
+        assert 200 == self.read(headers={pr.server.COMMIT_POSITION_HEADER: '0/16B3748'})
+        assert 0 == self.count
+
+        # the replica has replayed the position
+        pr.server.REPLICAS.replicas[0].position = 0x16B3748
+        assert 200 == self.read(headers={pr.server.COMMIT_POSITION_HEADER: '0/16B3748'})
+        assert self.count > 0
+
+        # invalid position
+        assert 400 == self.read(headers={pr.server.COMMIT_POSITION_HEADER: 'XXX'})
+
+    def test_positions(self):
+        assert 0x16B3748 == pr.replicas.parse_position('0/16B3748')
+        assert '16/B374D848' == pr.replicas.format_position(pr.replicas.parse_position('16/B374D848'))
+
+
+if __name__ == '__main__':
+    unittest.main(argv=['-v'])
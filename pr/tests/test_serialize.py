@@ -0,0 +1,146 @@
+import unittest
+import asyncio
+import copy
+
+import marshmallow
+import requests
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import pr
+import pr.model
+import pr.serialize
+
+from . import TestPR
+
+def run(coro):
+    # run in the loop of the server
+    from . import LOOP
+    return asyncio.run_coroutine_threadsafe(coro, LOOP).result()
+
+def get_ssl_context():
+    kw = {}
+    kw['verify'] = False
+    return kw
+
+IDENTITY = {
+    "status": "CLAIMED",
+    "identityType": "TEST",
+    "galleries": ["G1", "G2"],
+    "clientData": "Q0xJRU5U",
+    "biographicData": {
+        "firstName": "John",
+        "lastName": "Doo",
+        "dateOfBirth": "1985-01-01",
+        "gender": "M",
+        "nationality": "FRA",
+        "fByte": "Qnl0ZQ==",
+        "fBoolean": False,
+        "fInteger32": 0,
+        "fInteger64": 12345678901,
+        "fNumberFloat": 1.5,
+        "fNumberDouble": -2.25,
+    },
+    "contextualData": {
+        "operator": "OPE",
+        "operationDateTime": "2020-03-01T12:30:45.123000+00:00",
+        "device": {"name": "D1", "brand": "B"},
+    },
+    "biometricData": [
+        {
+            "biometricType": "FINGER",
+            "biometricSubType": "RIGHT_INDEX",
+            "image": "SU1BR0U=",
+            "template": "VEVNUExBVEU=",
+            "width": 500,
+            "height": 500,
+            "mimeType": "image/png",
+            "metadata": "META",
+            "missing": [{"biometricSubType": "RIGHT_THUMB", "presence": "BANDAGED"}],
+        },
+        {
+            "biometricType": "FACE",
+            "imageRef": "http://server/face.png",
+        },
+    ],
+    "documentData": [
+        {
+            "documentType": "FORM",
+            "parts": [
+                {"pages": [1, 2], "data": "UEFSVA==", "mimeType": "image/png"},
+                {"pages": [3], "dataRef": "http://server/part.png"},
+            ],
+        },
+    ],
+}
+
+#_______________________________________________________________________________
+class TestSerialize(TestPR):
+    """
+    The compiled serializer must give the same results as the schemas.
+    """
+    def setUp(self):
+        with requests.post(self.url+'v1/persons/SER-1', json={"status": "ACTIVE", "physicalStatus": "ALIVE"}, params={'transactionId': 'TSER'}, **get_ssl_context()) as r:
+            assert 201 == r.status_code
+        with requests.post(self.url+'v1/persons/SER-1/identities/SER-ID1', json=IDENTITY, params={'transactionId': 'TSER'}, **get_ssl_context()) as r:
+            assert 201 == r.status_code
+        with requests.post(self.url+'v1/persons/SER-1/identities/SER-ID2', json={"status": "CLAIMED", "identityType": "TEST", "biographicData": {"firstName": "A", "lastName": "B"}}, params={'transactionId': 'TSER'}, **get_ssl_context()) as r:
+            assert 201 == r.status_code
+
+    def tearDown(self):
+        with requests.delete(self.url+'v1/persons/SER-1', params={'transactionId': 'TSER'}, **get_ssl_context()) as r:
+            assert 204 == r.status_code
+
+    def test_dump(self):
+        async def read():
+            async with AsyncSession(pr.aengine) as session, session.begin():
+                sel = pr.model.select(pr.model.Identity).where(pr.model.Identity.personId == 'SER-1').options(*pr.model.IDENTITY_FULL)
+                ret = []
+                for ident in (await session.execute(sel)).scalars():
+                    schema = pr.serialize.IdentitySchema()
+                    ret.append((schema.dump(ident), pr.serialize.IDENTITY.dump(ident)))
+                    exclude = ['biometricData', 'documentData']
+                    schema = pr.serialize.IdentitySchema(exclude=exclude)
+                    ret.append((schema.dump(ident), pr.serialize.IDENTITY.dump(ident, exclude=exclude)))
+                return ret
+        dumps = run(read())
+        assert 4 == len(dumps)
+        for expected, data in dumps:
+            assert expected == data
+
+        with requests.get(self.url+'v1/persons/SER-1/identities', params={'transactionId': 'TSER'}, **get_ssl_context()) as r:
+            assert 200 == r.status_code
+            res = {i['identityId']: i for i in r.json()}
+            assert IDENTITY['biographicData'] == res['SER-ID1']['biographicData']
+            assert IDENTITY['galleries'] == res['SER-ID1']['galleries']
+            assert IDENTITY['biometricData'][0]['image'] == res['SER-ID1']['biometricData'][0]['image']
+            assert {} == res['SER-ID2']['contextualData']
+
+    def test_load(self):
+        def load(data):
+            try:
+                return pr.serialize.IdentitySchema().dump(pr.serialize.IdentitySchema().load(copy.deepcopy(data), transient=True))
+            except marshmallow.ValidationError as exc:
+                return exc.messages
+
+        def compiled_load(data):
+            try:
+                return pr.serialize.IdentitySchema().dump(pr.serialize.IDENTITY.load(data))
+            except marshmallow.ValidationError as exc:
+                return exc.messages
+
+        invalid_biometric = copy.deepcopy(IDENTITY)
+        invalid_biometric['biometricData'][1]['image'] = 'abc'
+        for data in [
+            IDENTITY,
+            {"status": "CLAIMED", "identityType": "TEST", "biographicData": {"firstName": "A", "lastName": "B", "fInteger32": "12"}},
+            {"status": "CLAIMED", "identityType": "TEST", "biographicData": {"firstName": "A"}},
+            {"status": None, "identityType": "TEST", "biographicData": {"firstName": "A", "lastName": "B"}},
+            {"status": "UNKNOWN", "identityType": "TEST", "foo": 1, "identityId": "X"},
+            {"status": "CLAIMED", "identityType": "TEST", "biographicData": {"firstName": "A", "lastName": "B", "dateOfBirth": "01/01/1985"}},
+            invalid_biometric,
+        ]:
+            assert load(data) == compiled_load(data), data
+
+
+if __name__ == '__main__':
+    unittest.main(argv=['-v'])
@@ -1,6 +1,8 @@
 import unittest
 import sys
 import os
+import json
+import base64
 
 import pr.model
 
@@ -459,6 +461,15 @@ class TestNominal(TestPR):
         with requests.patch(self.url+'v1/persons/P0002/identities/001', json=data, params={'transactionId': 'T0002'},**get_ssl_context()) as r:
             assert 400 == r.status_code
 
+        # Update identity - bad type is still detected in partial mode
+        data = {
+            "biographicData": {
+                "firstName": 12
+            }
+        }
+        with requests.patch(self.url+'v1/persons/P0002/identities/001', json=data, params={'transactionId': 'T0002'},**get_ssl_context()) as r:
+            assert 400 == r.status_code
+
         # Update identity
         data = {
             "biographicData": {
@@ -791,6 +802,56 @@ class TestNominal(TestPR):
                 # {'personId': 'P0003-2', 'identityId': '002'}
                 ]
 
+        # limit & cursor
+        for params in [{}, {'orderBy': 'firstName'}, {'group': 'true'}]:
+            res = []
+            cursor = None
+            while True:
+                p = dict(transactionId='T0003', limit='2', **params)
+                if cursor:
+                    p['cursor'] = cursor
+                with requests.post(self.url+'v1/persons', json=data, params=p,**get_ssl_context()) as r:
+                    assert 200 == r.status_code
+                    res.extend(r.json())
+                    cursor = r.headers.get('X-Next-Cursor')
+                    if not cursor:
+                        break
+            if 'group' in params:
+                assert res == [{'personId': 'P0003-1'}, {'personId': 'P0003-2'}]
+            else:
+                assert res == [
+                    {'personId': 'P0003-1', 'identityId': '001'},
+                    {'personId': 'P0003-2', 'identityId': '001'},
+                    {'personId': 'P0003-2', 'identityId': '002'}
+                    ]
+
+        # NDJSON streaming
+        headers = {'Accept': 'application/x-ndjson'}
+        with requests.post(self.url+'v1/persons', json=data, params={'transactionId': 'T0003', 'gallery':'TESTA'}, headers=headers, stream=True, **get_ssl_context()) as r:
+            assert 200 == r.status_code
+            assert r.headers['Content-Type'].startswith('application/x-ndjson')
+            res = [json.loads(x) for x in r.iter_lines() if x]
+            assert res == [
+                {'personId': 'P0003-1', 'identityId': '001'},
+                {'personId': 'P0003-2', 'identityId': '001'}
+                ]
+        with requests.post(self.url+'v1/persons', json=data, params={'transactionId': 'T0003', 'group':'true'}, headers=headers, stream=True, **get_ssl_context()) as r:
+            assert 200 == r.status_code
+            res = [json.loads(x) for x in r.iter_lines() if x]
+            assert res == [{'personId': 'P0003-1'}, {'personId': 'P0003-2'}]
+
+        # bad cursor
+        with requests.post(self.url+'v1/persons', json=data, params={'transactionId': 'T0003', 'cursor':'XXXX'},**get_ssl_context()) as r:
+            assert 400 == r.status_code
+        # well formed cursors with values of the wrong type
+        for params, values in [({}, [123]), ({'orderBy': 'firstName'}, [{}, 'P0003-1', 1]), ({'orderBy': 'firstName'}, ['John', 'P0003-1', 'X'])]:
+            cursor = base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+            with requests.post(self.url+'v1/persons', json=data, params=dict(params, transactionId='T0003', cursor=cursor),**get_ssl_context()) as r:
+                assert 400 == r.status_code
+        # orderBy on a non indexed attribute
+        with requests.post(self.url+'v1/persons', json=data, params={'transactionId': 'T0003', 'orderBy':'gender'},**get_ssl_context()) as r:
+            assert 400 == r.status_code
+
         # delete the person
         with requests.delete(self.url+'v1/persons/P0003-1', params={'transactionId': 'T0003'},**get_ssl_context()) as r:
             assert 204 == r.status_code
@@ -1116,6 +1177,22 @@ class TestNominal(TestPR):
                 # {'personId': 'P0006-2', 'identityId': '999'}
                 ]
 
+        # test NDJSON streaming
+        with requests.get(self.url+'v1/galleries/TESTA', params={'transactionId': 'T0006', 'limit': 0}, headers={'Accept': 'application/x-ndjson'}, stream=True, **get_ssl_context()) as r:
+            assert 200 == r.status_code
+            res = [json.loads(x) for x in r.iter_lines() if x]
+            assert res == [ {'personId': 'P0006-1', 'identityId': '001'}, {'personId': 'P0006-2', 'identityId': '001'}, {'personId': 'P0006-2', 'identityId': '999'}]
+
+        # test limit & cursor
+        with requests.get(self.url+'v1/galleries/TESTA', params={'transactionId': 'T0006', 'limit': 2},**get_ssl_context()) as r:
+            assert 200 == r.status_code
+            assert r.json() == [ {'personId': 'P0006-1', 'identityId': '001'}, {'personId': 'P0006-2', 'identityId': '001'}]
+            cursor = r.headers['X-Next-Cursor']
+        with requests.get(self.url+'v1/galleries/TESTA', params={'transactionId': 'T0006', 'limit': 2, 'cursor': cursor},**get_ssl_context()) as r:
+            assert 200 == r.status_code
+            assert r.json() == [ {'personId': 'P0006-2', 'identityId': '999'}]
+            assert 'X-Next-Cursor' not in r.headers
+
         # clean up data
         with requests.delete(self.url+'v1/persons/P0006-1', params={'transactionId': 'T0006'},**get_ssl_context()) as r:
             assert 204 == r.status_code
@@ -1220,6 +1297,77 @@ class TestNominal(TestPR):
             assert 200 == r.status_code
             assert 0 == r.json()
 
+    def test_bulk(self):
+        identity = {
+            "status":"VALID",
+            "identityType": "TEST",
+            "galleries":["TESTBULK"],
+            "biographicData": {
+                "firstName": "John",
+                "lastName": "Doo"
+            }
+        }
+        records = [
+            # nominal, with a reference identity
+            dict(personId='P0008-1', person=dict(status='ACTIVE', physicalStatus='ALIVE'),
+                 identities=[dict(identityId='001', **identity), dict(identityId='002', **identity)],
+                 reference='002'),
+            # nominal, no identity
+            dict(personId='P0008-2', person=dict(status='ACTIVE', physicalStatus='ALIVE')),
+            # duplicate personId
+            dict(personId='P0008-1', person=dict(status='ACTIVE', physicalStatus='ALIVE')),
+            # bad input
+            dict(personId='P0008-3', person=dict(status='UNDEFINED', physicalStatus='ALIVE')),
+            # unknown reference
+            dict(personId='P0008-4', person=dict(status='ACTIVE', physicalStatus='ALIVE'),
+                 identities=[identity], reference='002'),
+        ]
+        body = "\n".join([json.dumps(x) for x in records]) + "\nnot a JSON\n"
+        with requests.post(self.url+'v1/persons:bulk', data=body.encode('utf-8'), params={'transactionId': 'T0008'}, headers={'Content-Type': 'application/x-ndjson'}, **get_ssl_context()) as r:
+            assert 200 == r.status_code
+            res = [json.loads(x) for x in r.iter_lines() if x]
+            assert [(x['line'], x.get('personId'), x['status']) for x in res] == [
+                (1, 'P0008-1', 201),
+                (2, 'P0008-2', 201),
+                (3, 'P0008-1', 409),
+                (4, 'P0008-3', 400),
+                (5, 'P0008-4', 400),
+                (6, None, 400),
+            ]
+
+        with requests.get(self.url+'v1/persons/P0008-1/identities', params={'transactionId': 'T0008'},**get_ssl_context()) as r:
+            assert 200 == r.status_code
+            assert ['001', '002'] == [x['identityId'] for x in r.json()]
+        with requests.get(self.url+'v1/persons/P0008-1/reference', params={'transactionId': 'T0008'},**get_ssl_context()) as r:
+            assert 200 == r.status_code
+            assert '002' == r.json()['identityId']
+        with requests.get(self.url+'v1/galleries/TESTBULK', params={'transactionId': 'T0008'},**get_ssl_context()) as r:
+            assert 200 == r.status_code
+            assert 2 == len(r.json())
+        with requests.get(self.url+'v1/persons/P0008-4', params={'transactionId': 'T0008'},**get_ssl_context()) as r:
+            assert 404 == r.status_code
+
+        # without the JSON validation, the records which are not objects are rejected
+        import pr.server
+        api_file, validators = pr.args.api_file, dict(pr.server.VALIDATORS)
+        pr.args.api_file = None
+        pr.server.VALIDATORS.clear()
+        try:
+            body = '[]\n"x"\n{"personId": 1}\n{"personId": "P0008-5", "person": {"status": "ACTIVE", "physicalStatus": "ALIVE"}, "identities": [1]}\n'
+            with requests.post(self.url+'v1/persons:bulk', data=body.encode('utf-8'), params={'transactionId': 'T0008'}, headers={'Content-Type': 'application/x-ndjson'}, **get_ssl_context()) as r:
+                assert 200 == r.status_code
+                res = [json.loads(x) for x in r.iter_lines() if x]
+                assert [(x['line'], x['status']) for x in res] == [(1, 400), (2, 400), (3, 400), (4, 400)]
+        finally:
+            pr.args.api_file = api_file
+            pr.server.VALIDATORS.update(validators)
+
+        # clean up data
+        with requests.delete(self.url+'v1/persons/P0008-1', params={'transactionId': 'T0008'},**get_ssl_context()) as r:
+            assert 204 == r.status_code
+        with requests.delete(self.url+'v1/persons/P0008-2', params={'transactionId': 'T0008'},**get_ssl_context()) as r:
+            assert 204 == r.status_code
+
     def test_no_transaction_id(self):
         data = {
             "status": "INACTIVE",
@@ -1228,6 +1376,56 @@ class TestNominal(TestPR):
         with requests.post(self.url+'v1/persons/P0001', json=data, **get_ssl_context()) as r:
             assert 400 == r.status_code
 
+    def test_counters(self):
+        import asyncio
+        import pr.server
+        from . import LOOP
+        with requests.get(self.url+'monitoring/v1/metrics/gauges/nb_persons/count') as r:
+            assert 200 == r.status_code
+            nb_persons = r.json()
+        # the counters are reconciled with the database by a background task
+        pr.server.COUNTERS['nb_persons'] += 10
+        asyncio.run_coroutine_threadsafe(pr.server.reconcile_counters(), LOOP).result()
+        with requests.get(self.url+'monitoring/v1/metrics/gauges/nb_persons/count') as r:
+            assert 200 == r.status_code
+            assert nb_persons == r.json()
+
+        # objects committed while the rows are counted: retried later
+        deltas = iter([{'nb_persons': 0}, {'nb_persons': 1}])
+        async def read_deltas():
+            return next(deltas)
+        assert asyncio.run_coroutine_threadsafe(pr.server.count_rows(read_deltas), LOOP).result() is None
+
+    def test_pool(self):
+        import asyncio
+        import tempfile
+        import sqlalchemy as sa
+        with requests.get(self.url+'monitoring/v1/metrics/gauges/db_pool_checkedout/count') as r:
+            assert 200 == r.status_code
+        # the pool options are applied to both engines, except for the in-memory databases
+        waits = []
+        on_pool_wait, pr.model.on_pool_wait = pr.model.on_pool_wait, waits.append
+        try:
+            with tempfile.TemporaryDirectory() as root:
+                engine, aengine = pr.model.create_engines('sqlite:///'+os.path.join(root, 'pool.db'))
+                try:
+                    for e in [engine.pool, aengine.pool]:
+                        assert isinstance(e, sa.pool.QueuePool)
+                        assert pr.args.db_pool_size == e.size()
+                        assert pr.args.db_pool_timeout == e._timeout
+                    with engine.connect() as conn:
+                        conn.execute(sa.text('select 1'))
+                    async def aselect():
+                        async with aengine.connect() as conn:
+                            await conn.execute(sa.text('select 1'))
+                        await aengine.dispose()
+                    asyncio.run(aselect())
+                    assert 2 == len(waits)
+                finally:
+                    engine.dispose()
+        finally:
+            pr.model.on_pool_wait = on_pool_wait
+
 # XXX test insert with all fields and check all fields are returned
 # XXX test update with all fields and check all fields are returned modified
 
@@ -0,0 +1,239 @@
+import unittest
+import sys
+import os
+import time
+import signal
+import tempfile
+import subprocess
+
+import requests
+
+import pr.cache
+import pr.workers
+
+#_______________________________________________________________________________
+class TestMerge(unittest.TestCase):
+    def test_meters(self):
+        m = pr.workers.merge_meters([
+            {'readPerson': {'200': dict(mean=1., count=2, rate1=0.5, rate5=0.1, rate15=0.)}},
+            {'readPerson': {'200': dict(mean=1., count=3, rate1=0.5, rate5=0.1, rate15=0.),
+                            '404': dict(mean=1., count=1, rate1=0., rate5=0., rate15=0.)}},
+        ])
+        assert 5 == m['readPerson']['200']['count']
+        assert 1. == m['readPerson']['200']['rate1']
+        assert 1 == m['readPerson']['404']['count']
+
+    def test_gauges(self):
+        g = pr.workers.merge_gauges([
+            {'db_pool_checkedout': dict(min=0, max=2, count=1), 'reference_cache_hit_rate': dict(min=0, max=1., count=0.5)},
+            {'db_pool_checkedout': dict(min=0, max=3, count=2), 'reference_cache_hit_rate': dict(min=0, max=1., count=0.25)},
+        ])
+        assert 3 == g['db_pool_checkedout']['count']
+        assert 0.375 == g['reference_cache_hit_rate']['count']
+
+    def test_histograms(self):
+        h = pr.workers.merge_histograms([
+            {'readPerson': dict(count=1, min=1., max=1., mean=1., stddev=0., quantiles={'0.5': 1.}, distribution=[1])},
+            {'readPerson': dict(count=3, min=2., max=4., mean=3., stddev=0.5, quantiles={'0.5': 3.}, distribution=[1, 1, 1]),
+             'readIdentity': dict(count=0, min=0, max=0, mean=0, stddev=0, quantiles={}, distribution=[])},
+        ])
+        assert 4 == h['readPerson']['count']
+        assert 1. == h['readPerson']['min']
+        assert 4. == h['readPerson']['max']
+        assert 2.5 == h['readPerson']['mean']
+        assert 2.5 == h['readPerson']['quantiles']['0.5']
+        assert 4 == sum(h['readPerson']['distribution'])
+        assert 0 == h['readIdentity']['count']
+
+#_______________________________________________________________________________
+class TestSharedVersions(unittest.TestCase):
+    def test_invalidate(self):
+        # the caches of two workers
+        shared = pr.cache.SharedVersions()
+        c1, c2 = pr.cache.LRUCache(10), pr.cache.LRUCache(10)
+        c1.shared = c2.shared = shared
+        c1.put('P1', 'A')
+        c2.put('P1', 'A')
+        generation = c1.generation
+        c2.invalidate('P1')
+        assert c1.get('P1') is None
+        assert c2.get('P1') is None
+        # read from the database before the invalidation
+        c1.put('P1', 'A', generation)
+        assert c1.get('P1') is None
+        c1.put('P1', 'B', c1.generation)
+        assert 'B' == c1.get('P1')
+
+#_______________________________________________________________________________
+class TestWorkers(unittest.TestCase):
+    PORT = 8097
+    MONITORING_PORT = 8098
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.process = subprocess.Popen([sys.executable, '-m', 'pr',
+                                         '--workers', '2',
+                                         '--port', str(self.PORT),
+                                         '--monitoring-port', str(self.MONITORING_PORT),
+                                         '--database-url', 'sqlite:///'+os.path.join(self.directory.name, 'workers.db'),
+                                         '--custo-filename', os.path.join(os.path.dirname(__file__), 'custo.yaml')],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # ready when all the workers are ready
+        self.wait_ready()
+
+    def wait_ready(self):
+        for i in range(50):
+            try:
+                with requests.get('http://localhost:%d/monitoring/v1/is_ready' % self.MONITORING_PORT) as r:
+                    if r.status_code == 200:
+                        return
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.2)
+        raise AssertionError('not ready')
+
+    def children(self):
+        with open('/proc/%d/task/%d/children' % (self.process.pid, self.process.pid)) as f:
+            return {int(pid) for pid in f.read().split()}
+
+    def monitoring_process(self):
+        # the child listening on the monitoring port
+        with open('/proc/net/tcp') as f:
+            inodes = {line.split()[9] for line in f.readlines()[1:]
+                      if line.split()[1].endswith(':%04X' % self.MONITORING_PORT) and line.split()[3] == '0A'}
+        for pid in self.children():
+            for fd in os.listdir('/proc/%d/fd' % pid):
+                try:
+                    if os.readlink('/proc/%d/fd/%s' % (pid, fd)) in ['socket:[%s]' % i for i in inodes]:
+                        return pid
+                except FileNotFoundError:
+                    pass
+        return None
+
+    def tearDown(self):
+        self.process.send_signal(signal.SIGTERM)
+        self.process.wait(10)
+        self.directory.cleanup()
+
+    def test_workers(self):
+        url = 'http://localhost:%d/' % self.PORT
+        for i in range(10):
+            with requests.post(url+'v1/persons/WORKER-%d' % i, json={"status": "ACTIVE", "physicalStatus": "ALIVE"}, params={'transactionId': 'TW'}) as r:
+                assert 201 == r.status_code
+        for i in range(10):
+            with requests.get(url+'v1/persons/WORKER-%d' % i, params={'transactionId': 'TW'}) as r:
+                assert 200 == r.status_code
+
+        # the metrics of all the workers are aggregated
+        url = 'http://localhost:%d/' % self.MONITORING_PORT
+        with requests.get(url+'monitoring/v1/metrics/meters/createPerson/201/count') as r:
+            assert 200 == r.status_code
+            assert 10 == r.json()
+        with requests.get(url+'monitoring/v1/metrics/histograms/readPerson/count') as r:
+            assert 200 == r.status_code
+            assert 10 == r.json()
+        with requests.get(url+'monitoring/v1/metrics/gauges/db_pool_size/count') as r:
+            assert 200 == r.status_code
+            assert 10 == r.json()
+        with requests.get(url+'metrics', headers={'Accept': 'text/plain'}) as r:
+            assert 200 == r.status_code
+            assert 'createPerson_201_total 10' in r.text
+
+    def test_counters(self):
+        # the inserts and the deletes are spread over the workers
+        url = 'http://localhost:%d/' % self.PORT
+        for i in range(10):
+            with requests.post(url+'v1/persons/COUNTER-%d' % i, json={"status": "ACTIVE", "physicalStatus": "ALIVE"}, params={'transactionId': 'TW'}) as r:
+                assert 201 == r.status_code
+        for i in range(3):
+            with requests.delete(url+'v1/persons/COUNTER-%d' % i, params={'transactionId': 'TW'}) as r:
+                assert 204 == r.status_code
+        with requests.get('http://localhost:%d/monitoring/v1/metrics/gauges/nb_persons/count' % self.MONITORING_PORT) as r:
+            assert 200 == r.status_code
+            assert 7 == r.json()
+
+    def test_reference(self):
+        # the reads of the reference are load-balanced on the workers
+        url = 'http://localhost:%d/' % self.PORT
+        params = {'transactionId': 'TW'}
+        with requests.post(url+'v1/persons/WORKER-REF', json={"status": "ACTIVE", "physicalStatus": "ALIVE"}, params=params) as r:
+            assert 201 == r.status_code
+        identity = {"status": "VALID", "identityType": "TEST", "biographicData": {"firstName": "John", "lastName": "Doo"}}
+        with requests.post(url+'v1/persons/WORKER-REF/identities/001', json=identity, params=params) as r:
+            assert 201 == r.status_code
+        with requests.put(url+'v1/persons/WORKER-REF/identities/001/reference', params=params) as r:
+            assert 204 == r.status_code
+
+        def read_status():
+            statuses = set()
+            for i in range(40):
+                with requests.get(url+'v1/persons/WORKER-REF', params={'attributeNames': 'status'}) as r:
+                    assert 200 == r.status_code
+                    statuses.add(r.json()['status'])
+            return statuses
+
+        assert {'VALID'} == read_status()
+        # the reference is cached by the workers, the invalidations are shared
+        with requests.get('http://localhost:%d/monitoring/v1/metrics/gauges/reference_cache_size/count' % self.MONITORING_PORT) as r:
+            assert 200 == r.status_code
+            assert r.json() >= 1
+        with requests.put(url+'v1/persons/WORKER-REF/identities/001/status', params=dict(params, status='REVOKED')) as r:
+            assert 204 == r.status_code
+        assert {'REVOKED'} == read_status()
+
+    def test_restart(self):
+        # the processes which exit are restarted
+        url = 'http://localhost:%d/' % self.PORT
+        for i in range(5):
+            with requests.post(url+'v1/persons/RESTART-%d' % i, json={"status": "ACTIVE", "physicalStatus": "ALIVE"}, params={'transactionId': 'TW'}) as r:
+                assert 201 == r.status_code
+        children = self.children()
+        assert 3 == len(children)
+        monitoring = self.monitoring_process()
+        assert monitoring in children
+        worker = min(children - {monitoring})
+        os.kill(worker, signal.SIGKILL)
+        for i in range(50):
+            if len(self.children()) == 3 and worker not in self.children():
+                break
+            time.sleep(0.2)
+        assert 3 == len(self.children())
+        assert worker not in self.children()
+        self.wait_ready()
+        for i in range(10):
+            with requests.get(url+'v1/persons/RESTART-%d' % (i % 5), params={'transactionId': 'TW'}) as r:
+                assert 200 == r.status_code
+        # the counters are reconciled with the database
+        for i in range(20):
+            with requests.get('http://localhost:%d/monitoring/v1/metrics/gauges/nb_persons/count' % self.MONITORING_PORT) as r:
+                assert 200 == r.status_code
+                if r.json() == 5:
+                    break
+            time.sleep(0.2)
+        assert 5 == r.json()
+
+        # and the monitoring process
+        os.kill(monitoring, signal.SIGKILL)
+        for i in range(50):
+            if len(self.children()) == 3 and monitoring not in self.children():
+                break
+            time.sleep(0.2)
+        assert monitoring not in self.children()
+        self.wait_ready()
+
+
+#_______________________________________________________________________________
+class TestWorkersDatabase(unittest.TestCase):
+    PORT = 8107
+
+    def test_memory_database(self):
+        # the workers must share the database
+        ret = subprocess.run([sys.executable, '-m', 'pr', '--workers', '2', '--port', str(self.PORT),
+                              '--custo-filename', os.path.join(os.path.dirname(__file__), 'custo.yaml')],
+                             capture_output=True, timeout=20)
+        assert ret.returncode != 0
+        assert b'in-memory databases cannot be used' in ret.stderr
+
+
+if __name__ == '__main__':
+    unittest.main(argv=['-v'])
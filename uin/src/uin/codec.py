@@ -0,0 +1,45 @@
+import json
+import logging
+
+from aiohttp import web
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+#______________________________________________________________________________
+# JSON codec
+# The encoding and the decoding of the JSON documents (requests, responses,
+# columns) use the codec selected with --json-codec. dumps returns bytes
+# (UTF-8) and loads accepts bytes or str.
+#______________________________________________________________________________
+def _json_dumps(data):
+    return json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+def _orjson_dumps(data):
+    return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+CODECS = {
+    'json': (_json_dumps, json.loads),
+}
+if orjson:
+    CODECS['orjson'] = (_orjson_dumps, orjson.loads)
+
+dumps, loads = CODECS['orjson' if orjson else 'json']
+
+def setup(name):
+    global dumps, loads
+    if name not in CODECS:
+        logging.warning("JSON codec [%s] not available, using json", name)
+        name = 'json'
+    dumps, loads = CODECS[name]
+    logging.info("JSON codec [%s]", name)
+
+async def read_json(request):
+    """Decode the body of the request"""
+    return loads(await request.read())
+
+def json_response(data, status=200, **kw):
+    """Same as aiohttp.web.json_response, using the codec"""
+    return web.Response(body=dumps(data), status=status, content_type='application/json', **kw)
@@ -7,6 +7,7 @@ import aiohttp
 from aiohttp import web
 
 import uin
+from uin import codec
 
 import livemetrics
 import livemetrics.publishers.aiohttp
@@ -34,7 +35,7 @@ async def error_middleware(request, handler):
         raise
     except Exception as exc:
         logging.exception("Exception caught in middleware: [%s]", str(exc))
-        return web.json_response(dict(code=0, message=str(exc)), status=500)
+        return codec.json_response(dict(code=0, message=str(exc)), status=500)
 
 
 # _____________________________________________________________________________
@@ -104,11 +105,11 @@ def serve():
 async def generateUIN(request):
     transaction_id = request.query['transactionId']
     logging.info('[%s] - generateUIN', transaction_id)
-    data = await request.json()
+    data = await codec.read_json(request)
 
     G = {'M':'1', 'F': '2'}.get(data.get('gender','M'), '3')
     D = data.get('dateOfBirth','2000-01-01').replace('-','')[2:6]    # Note: not extensive tests on the format of the date
     uin = G+D+''.join(secrets.choice('0123456789') for unused in range(5))
     logging.info('[%s] - UIN generated: %s', transaction_id, uin)
-    return web.json_response(data=uin, status=200)
+    return codec.json_response(data=uin, status=200)
 